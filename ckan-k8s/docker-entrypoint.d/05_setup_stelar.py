@@ -1,20 +1,30 @@
 import os
 import subprocess
 import logging
-from kubernetes import config, client
-import yaml 
-import base64
+import sys
+from kubernetes import config
+
+# The shared bootstrap modules are installed in the application directory
+sys.path.insert(0, os.environ.get("APP_DIR", "/srv/app"))
+import k8s_apply
+from k8s_apply import Applier, ApplyError
+from timeline import Ledger
 
 config.load_incluster_config()
 
 KUBE_NAMESPACE = os.getenv("KUBE_NAMESPACE",'default')
 
+# The Secrets and ConfigMaps produced by the setup, applied together at its end
+k8s_objects = Applier()
+
 
 # A convenient wrapper for logging
+# (the wrapped callables are also timed in a ledger, if one is given)
 class StackLogger(logging.LoggerAdapter):
-    def __init__(self, logger, extra={}):
+    def __init__(self, logger, extra={}, ledger=None):
         super().__init__(logger, extra)
         self.stack = ['__main__']
+        self.ledger = ledger
     def process(self, msg, kwargs):
         return f"[{self.stack[-1]}] {msg}", kwargs
     def wrap(self, c):
@@ -26,7 +36,10 @@ class StackLogger(logging.LoggerAdapter):
             def wrapped_callable(*args, **kwargs):
                 try:
                     self.stack.append(cname)
-                    return c(*args, **kwargs)
+                    if self.ledger is None:
+                        return c(*args, **kwargs)
+                    with self.ledger.step(cname):
+                        return c(*args, **kwargs)
                 finally:
                     self.stack.pop()
             return wrapped_callable
@@ -34,8 +47,11 @@ class StackLogger(logging.LoggerAdapter):
             return c
 
 
+# The timings of the setup steps, published to the bootstrap timeline
+ledger = Ledger("ckan-setup")
+
 # The logger object
-logger = StackLogger(None)
+logger = StackLogger(None, ledger=ledger)
 
 # Global variable, used for convenience
 ckan_ini = os.environ.get("CKAN_INI", "/srv/app/ckan.ini")
@@ -200,85 +216,45 @@ def generate_k8s_configmap(configmap_name, namespace, data_dict):
     Returns:
         dict: ConfigMap structure.
     """
-    # Define the ConfigMap structure
-    configmap = {
-        "apiVersion": "v1",
-        "kind": "ConfigMap",
-        "metadata": {
-            "name": configmap_name,
-            "namespace": namespace,
-        },
-        "data": data_dict,
-    }
-
-    # Output YAML for verification
-    # print("Generated Kubernetes ConfigMap YAML:")
-    # print(yaml.dump(configmap))
-    return configmap
+    return k8s_apply.config_map(configmap_name, namespace, data_dict)
 
 @logger.wrap
 def create_k8s_secret(secret_name, data_dict):
-    # Encode data to base64 as required by Kubernetes secrets
-    encoded_data = {k: base64.b64encode(v.encode("utf-8")).decode("utf-8") for k, v in data_dict.items()}
-
-    # Define the secret structure
-    secret = {
-        "apiVersion": "v1",
-        "kind": "Secret",
-        "metadata": {
-            "name": secret_name,
-            "namespace": KUBE_NAMESPACE,
-        },
-        "type": "Opaque",
-        "data": encoded_data,
-    }
-
+    secret = k8s_apply.secret(secret_name, KUBE_NAMESPACE, data_dict)
     logger.info("Generated Kubernetes Secret YAML for CKAN Admin Token")
-    
     return secret
 
 @logger.wrap
 def apply_secret_to_cluster(secret):
-    v1 = client.CoreV1Api()
-
-    # Create the secret in the specified namespace
-    try:
-        v1.create_namespaced_secret(
-            namespace=KUBE_NAMESPACE,
-            body=secret
-        )
-        logger.info(f"Secret created in namespace ''.")
-    except client.exceptions.ApiException as e:
-        if e.status == 409:
-            logger.error(f"Secret 'CKAN_ADMIN_TOKEN' already exists.")
-        else:
-            logger.error(f"Failed to create secret: {e}")
+    """
+    Collects a Secret, to be applied along with the other objects of the setup.
+    """
+    k8s_objects.add(secret)
 
 @logger.wrap
 def apply_configmap_to_k8s_cluster(configmap):
     """
-    Applies a Kubernetes ConfigMap to the specified namespace.
-    
-    Args:
-        configmap (dict): ConfigMap structure to apply.
+    Collects a ConfigMap, to be applied along with the other objects of the setup.
+    """
+    k8s_objects.add(configmap)
+
+@logger.wrap
+def apply_k8s_objects():
+    """
+    Applies the collected Secrets and ConfigMaps; only new or changed ones are sent.
         
     Logs:
-        Success or failure message for ConfigMap creation.
+        Failure message for every object that could not be applied.
+
+    Raises:
+        ApplyError: If some objects could not be applied, e.g., the API token Secret.
     """
-    # Initialize Kubernetes client
-    v1 = client.CoreV1Api()
-    # Create the ConfigMap in the specified namespace
     try:
-        v1.create_namespaced_config_map(
-            namespace=configmap["metadata"]["namespace"],
-            body=configmap
-        )
-        logger.info(f"ConfigMap '{configmap['metadata']['name']}' created in namespace '{configmap['metadata']['namespace']}'.")
-    except client.exceptions.ApiException as e:
-        if e.status == 409:
-            logger.info(f"ConfigMap '{configmap['metadata']['name']}' already exists.")
-        else:
-            logger.error(f"Failed to create ConfigMap: {e}")
+        k8s_objects.apply()
+    except ApplyError as e:
+        for kind, namespace, name in e.failed:
+            logger.error(f"Failed to apply {kind} '{name}' in namespace '{namespace}'.")
+        raise
 
 
 if __name__ == '__main__':
@@ -286,8 +262,12 @@ if __name__ == '__main__':
     logging.info(f"Configuring {ckan_ini} for STELAR extensions.")
     logger.logger = logging.getLogger("stelar")
 
-    setup_root_path()
-    setup_keycloak()
-    setup_spatial()
-    create_ckanini_configmap()
-    issue_api_token()
+    try:
+        setup_root_path()
+        setup_keycloak()
+        setup_spatial()
+        create_ckanini_configmap()
+        issue_api_token()
+        apply_k8s_objects()
+    finally:
+        ledger.publish(KUBE_NAMESPACE)
@@ -1,7 +1,11 @@
+import argparse
 import json
+import os
 import re
-from shapely.geometry import Polygon, mapping
-from stelar.client import Client
+from profiling import Profiler, add_profile_arguments
+from publisher import STATE_DIR, Publisher
+from sharding import RunReport, Shard, add_shard_arguments
+from tag_normalizer import TagNormalizer
 import pycountry
 from difflib import get_close_matches
 
@@ -10,6 +14,9 @@ from difflib import get_close_matches
 # https://geoservice.dlr.de/data-assets/
 ##############################################################################
 
+# DLR records carry their theme (additionalType); keywords only become tags
+TAGS = TagNormalizer()
+
 def get_timespan(temporalCoverage):
     """ Extract the start and end of the given temporal coverage.
     Args:
@@ -65,13 +72,32 @@ def slugify_title(title: str) -> str:
 
 def bbox(left, bottom, right, top):
     """Return GeoJSON dict for bounding box in EPSG:4326."""
+    from shapely.geometry import Polygon, mapping
     poly = Polygon([[left, bottom], [left, top], [right, top], [right, bottom]])
     return mapping(poly)
 
 
-def ingest_dlr_metadata(json_file: str, c: Client):
-    """Ingest DLR metadata JSON into CKAN via STELAR client."""
+def dlr_source_id(data: dict, json_file: str = None) -> str:
+    """Return the identifier of a DLR record (JSON-LD id, landing page, else the file name)."""
+    return data.get('@id') or data.get('url') or os.path.basename(json_file or '')
+
+
+def load_dlr_record(json_file: str) -> dict:
+    """Load a DLR metadata JSON file, keeping its identifier within the record."""
     data = json.load(open(json_file))
+    # Keep the identifier within the record, so that it can be replayed on its own
+    data['@id'] = dlr_source_id(data, json_file)
+    return data
+
+
+def ingest_dlr_metadata(json_file: str, publisher: Publisher):
+    """Ingest DLR metadata JSON file into CKAN via the given publisher."""
+    return ingest_dlr_record(load_dlr_record(json_file), publisher)
+
+
+def ingest_dlr_record(data: dict, publisher: Publisher):
+    """Ingest a parsed DLR metadata record into CKAN via the given publisher."""
+    source_id = dlr_source_id(data)
 
     # Truncate notes
     notes = data.get('description') or ''
@@ -79,13 +105,7 @@ def ingest_dlr_metadata(json_file: str, c: Client):
         notes = notes[:997] + '...'
 
     # Tags
-    raw_tags = [t.strip() for t in (data.get('keywords') or '').split(',') if t]
-    conforming, custom = [], []
-    for t in raw_tags:
-        if re.match(r'^[A-Za-z0-9 _\-.]+$', t):
-            conforming.append(t)
-        else:
-            custom.append(t)
+    conforming, custom, _ = TAGS.partition((data.get('keywords') or '').split(','))
 
     # DOI
     ident = data.get('identifier') or {}
@@ -130,26 +150,62 @@ def ingest_dlr_metadata(json_file: str, c: Client):
     }
     # drop None
     spec = {k: v for k, v in spec.items() if v is not None}
-    spec['organization'] = c.organizations.get('stelar-klms')
-    c.datasets.create(**spec)
-
-
-def main():
+    try:
+        return publisher.publish(source_id, spec, record=data)
+    except Exception as e:
+        print(f'Error publishing DLR record {source_id}: {e}')
+        return None, None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Harvest DLR data assets into the Data Catalog.')
+    add_profile_arguments(parser)
+    add_shard_arguments(parser)
+    args = parser.parse_args(argv)
+    profiler = Profiler.from_args('dlr', args)
+    shard = Shard.from_args(args)
+    report = RunReport('dlr', shard)
+
+    # The STELAR client (and pandas with it) is imported only when actually harvesting
+    from stelar.client import Client
     c = Client(context='default')
 
+    # Name collisions are resolved locally, unchanged records are skipped on re-harvest
+    # and failed records are kept for replay (see dead_letters.py)
+    with profiler.stage('index'):
+        publisher = Publisher.for_harvester(c, 'dlr', shard)
+
     # Scan the directory for JSON files
-    import os
     json_dir = './dlr'
 
-    for filename in os.listdir(json_dir):
-        if filename.endswith('.json'):
-            json_file = os.path.join(json_dir, filename)
-            print(f'Ingesting {json_file}...')
-            try:
-                ingest_dlr_metadata(json_file, c)
-                print('Done.')
-            except Exception as e:
-                print(f'Error ingesting {json_file}: {e}')
+    with profiler.stage('ingest'):
+        for filename in os.listdir(json_dir):
+            if filename.endswith('.json'):
+                json_file = os.path.join(json_dir, filename)
+                try:
+                    data = load_dlr_record(json_file)
+                except Exception as e:
+                    # Unreadable files are reported by the shard owning their name
+                    if shard.owns(filename):
+                        print(f'Error ingesting {json_file}: {e}')
+                        publisher.record_failure(filename, e)
+                    continue
+                # Only the records of this worker's shard, if the harvest is split among several workers
+                if not shard.owns(data['@id']):
+                    report.skip()
+                    continue
+                print(f'Ingesting {json_file}...')
+                try:
+                    pid, _ = ingest_dlr_record(data, publisher)
+                except Exception as e:
+                    # Failed before publishing (e.g., parsing the record)
+                    print(f'Error ingesting {json_file}: {e}')
+                    publisher.record_failure(data['@id'], e, record=data)
+                    continue
+                if pid is not None:
+                    print('Done.')
+
+    print('Run report written to', report.write(publisher, STATE_DIR))
 
 if __name__ == '__main__':
     main()
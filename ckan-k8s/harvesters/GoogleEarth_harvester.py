@@ -1,18 +1,13 @@
  
-import os
-import pandas as pd
-import geopandas as gpd
-import math
-import numpy as np
-import collections
-
+import argparse
 import urllib.request
 import json
 import re
-import requests
-import shapely
-from shapely.geometry import shape, Polygon
-from stelar.client import Client, Dataset
+from profiling import Profiler, add_profile_arguments
+from publisher import STATE_DIR, Publisher
+from sharding import RunReport, Shard, add_shard_arguments
+from spec_mirror import MIRROR_BUCKET
+from tag_normalizer import TagNormalizer
 #####################################################
 # Applicable to harvest these EO data sources:
 
@@ -71,6 +66,18 @@ GEE_mappings = {
     'sar':'SAR'
 }
 
+def gee_themes(tag):
+    """ Map a GEE tag to STAC theme(s). """
+    if tag in GEE_mappings:
+        return [GEE_mappings[tag]]
+    if tag.title() in STAC_themes:
+        return [tag.title()]
+    return []
+
+
+# Verdicts on keywords are cached across the records of a harvest
+TAGS = TagNormalizer(themes=gee_themes)
+
 def slugify_title(title: str) -> str:
     """
     Convert a string into a URL-friendly “slug”:
@@ -98,6 +105,9 @@ def bbox(left, bottom, right, top):
     Returns:
         A GeoJson representing the given bounding box in WGS84.
     """
+    # Imported here rather than at module level, since shapely pulls in numpy
+    from shapely.geometry import Polygon, mapping
+
     # Create a shapely geometry from the given coordinates    
     poly = Polygon([
         (left, bottom),
@@ -108,24 +118,22 @@ def bbox(left, bottom, right, top):
     ])
 
     # Return a native Python dict (GeoJSON) so the CKAN client can serialize it properly
-    return shapely.geometry.mapping(poly)
+    return mapping(poly)
 
 
-def ingest_earthengine_metadata(input_dict, c: Client):
-    """ Ingest a data source from Google Earth Engine into the Data Catalog (CKAN) according to the given metadata (JSON).
+def earthengine_spec(input_dict):
+    """ Transform the metadata of a data source from Google Earth Engine into the specification of a CKAN package.
     
     Args:
         input_dict (dict): JSON dictionary containing the metadata as obtained from Google Earth Engine.
         
     Returns:
-        The identifier of the published item in the Data Catalog; None, if publishing failed.
+        A pair with the dataset and the resource (or None) properties; None, if the data source is deprecated.
     """
-    pid = None
-
     # Skip any deprecated items
     if input_dict.get('deprecated'):
         print(f"Skipping deprecated dataset: {input_dict['title']}")
-        return None, None
+        return None
     
     # Description about this data source
     notes = input_dict['title'] # Initially set to the title
@@ -146,21 +154,10 @@ def ingest_earthengine_metadata(input_dict, c: Client):
     # else:
     #     title = input_dict['title'] + ' (' + owner_org + ')'
     
-    # Check if tags conform to CKAN rules
-    # CKAN tags can only contain alphanumeric characters, spaces ( ), hyphens (-), underscores (_) or dots (.)
-    if 'keywords' in input_dict:
-        themes = []  # Assign theme(s) according to tags; also handle special cases not directly associated to STAC themes
-        tags = [t.strip() for t in input_dict['keywords'].split(',')]
-        for tag in tags:
-            if tag in GEE_mappings:
-                themes.append(GEE_mappings[tag])
-            elif tag.title() in STAC_themes:
-                themes.append(tag.title())
-    else:
-        tags = ['Imagery']  # Assign ad-hoc tags; at least one must be specified
-
-    # Remove duplicates
-    themes = list(dict.fromkeys(themes))   
+    # Keep the keywords conforming to CKAN tag rules as tags, and the rest as custom tags
+    # Assign theme(s) according to tags; also handle special cases not directly associated to STAC themes
+    keywords = input_dict['keywords'].split(',') if 'keywords' in input_dict else ['Imagery']  # At least one tag must be specified
+    tags, custom_tags, themes = TAGS.partition(keywords)
 
     # Extract spatial coverage
     if 'bbox' in input_dict:
@@ -204,6 +201,7 @@ def ingest_earthengine_metadata(input_dict, c: Client):
         "license": next((value for key,value in input_dict.items() if key == 'license'), None),
         "private": False,
         "tags": tags,
+        "custom_tags": custom_tags or None,
         "alternate_identifier": next((value for key,value in input_dict.items() if key == 'id'), None),
         'theme': themes,
         'language': ['en'],   # Ad-hoc language assigned for metadata
@@ -219,56 +217,134 @@ def ingest_earthengine_metadata(input_dict, c: Client):
     }
 
 
+    # STAGE #2: Also publish the original JSON metadata as a resource
+    resource = None
+    if json_href:
+        resource = {
+            "name": input_dict['title'] + ' specifications',
+            "description": 'Specifications about ' + input_dict['title'] + 'in JSON format',
+            "format": "JSON",
+            "license": next((value for key,value in input_dict.items() if key == 'license'), None),
+            "resource_type": "service",
+            "url": json_href,
+            "relation": "reference",
+        }
+
+    return spec, resource
+
+
+def ingest_earthengine_metadata(input_dict, publisher: Publisher):
+    """ Ingest a data source from Google Earth Engine into the Data Catalog (CKAN) according to the given metadata (JSON).
+    
+    Args:
+        input_dict (dict): JSON dictionary containing the metadata as obtained from Google Earth Engine.
+        publisher (Publisher): The publisher creating or patching the dataset in the Data Catalog.
+        
+    Returns:
+        The identifier of the published item in the Data Catalog; None, if publishing failed.
+    """
+    specs = earthengine_spec(input_dict)
+    if specs is None:
+        return None, None
+    spec, resource = specs
+
     try:
-        spec["organization"] = c.organizations["stelar-klms"]
-        d = c.datasets.create(**spec)
-        pid = str(d.id)
+        pid, rid = publisher.publish(input_dict['id'], spec, resource, record=input_dict)
     except Exception as e:
-        print(f"Error while publishing DLR metadata: {input_dict['title']} : {e}")
-        return None
+        print(f"Error while publishing GEE metadata: {input_dict['title']} : {e}")
+        return None, None
+    return pid, rid
+
+
+async def ingest_earthengine_async(records, publisher: Publisher, max_in_flight=100):
+    """ Ingest many data sources from Google Earth Engine concurrently, from a single event loop.
     
-        
-    # STAGE #2: Also publish the original JSON metadata as a resource
-    rid = None
-    if pid != None and json_href:
+    Args:
+        records (list): JSON dictionaries containing the metadata as obtained from Google Earth Engine.
+        publisher (Publisher): The publisher whose state (names, snapshots, dead letters) is used.
+        max_in_flight (int): Maximum number of records being published at the same time.
+    """
+    import asyncio
+    from async_publisher import AsyncPublisher
 
+    async def ingest(record, ap):
         try:
-            r = d.add_resource(**{
-                "name": input_dict['title'] + ' specifications',
-                "description": 'Specifications about ' + input_dict['title'] + 'in JSON format',
-                "format": "JSON",
-                "license": next((value for key,value in input_dict.items() if key == 'license'), None),
-                "resource_type": "service",
-                "url": json_href,
-                "relation": "reference",
-            })
-            rid = str(r.id)
+            # The full description is fetched with blocking I/O, so keep it off the event loop
+            specs = await asyncio.to_thread(earthengine_spec, record)
         except Exception as e:
-            print(f"Error while publishing DLR metadata: {e}")
-            return None
-    return pid, rid
+            print(f"Error while harvesting GEE metadata: {record.get('title')} : {e}")
+            publisher.record_failure(record.get('id'), e, record=record)
+            return
+        if specs is None:
+            return
+        try:
+            await ap.publish(record['id'], *specs, record=record)
+            print(f"Ingested record: {record['title']}")
+        except Exception as e:
+            print(f"Error while publishing GEE metadata: {record['title']} : {e}")
 
+    async with AsyncPublisher(publisher, max_in_flight=max_in_flight) as ap:
+        await asyncio.gather(*(ingest(record, ap) for record in records))
 
 
-def main():
-    """ Main function to harvest DLR metadata and publish it to the Data Catalog.
+def main(argv=None):
+    """ Main function to harvest GEE metadata and publish it to the Data Catalog.
     This function is called when the script is executed directly.
     """
+    parser = argparse.ArgumentParser(description='Harvest the Google Earth Engine catalog into the Data Catalog.')
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='Publish asynchronously, keeping up to this many records in flight')
+    parser.add_argument('--mirror-specs', nargs='?', const=MIRROR_BUCKET, default=None, metavar='BUCKET',
+                        help=f'Copy the specification documents into MinIO (default bucket: {MIRROR_BUCKET})')
+    add_profile_arguments(parser)
+    add_shard_arguments(parser)
+    args = parser.parse_args(argv)
+    profiler = Profiler.from_args('gee', args)
+    shard = Shard.from_args(args)
+    report = RunReport('gee', shard)
+
     # Initialize the STELAR client, using context file. Credentials can be also hardcoded here like
     # c = Client(base_url="https://klms.stelar.gr", username='your_username', password='your_password')
+    from stelar.client import Client
     c = Client(context='default')
     
     # Path to the JSON file containing DLR metadata
     json_file = './Google/gee_catalog.json'
 
     # Load the JSON file containing the metadata
-    with open(json_file, 'r') as f:
+    with profiler.stage('load'), open(json_file, 'r') as f:
         records = json.load(f)
 
+    # Only the records of this worker's shard, if the harvest is split among several workers
+    if shard.sharded:
+        owned = [record for record in records if shard.owns(record.get('id'))]
+        report.skipped = len(records) - len(owned)
+        records = owned
+        print(f'Shard {shard}: harvesting {len(records)} record(s)')
+
+    # Name collisions are resolved locally, unchanged records are skipped on re-harvest
+    # and failed records are kept for replay (see dead_letters.py)
+    with profiler.stage('index'):
+        publisher = Publisher.for_harvester(c, 'gee', shard, mirror_bucket=args.mirror_specs)
+
     # Iterate through each record and ingest the metadata
-    for record in records:
-        ingest_earthengine_metadata(record, c)
-        print(f"Ingested record: {record['title']}")
+    with profiler.stage('ingest'):
+        if args.concurrency:
+            import asyncio
+            asyncio.run(ingest_earthengine_async(records, publisher, args.concurrency))
+        else:
+            for record in records:
+                try:
+                    pid, _ = ingest_earthengine_metadata(record, publisher)
+                except Exception as e:
+                    # Failed before publishing (e.g., fetching the description or parsing the record)
+                    print(f"Error while harvesting GEE metadata: {record.get('title')} : {e}")
+                    publisher.record_failure(record.get('id'), e, record=record)
+                    continue
+                if pid is not None:
+                    print(f"Ingested record: {record['title']}")
+
+    print('Run report written to', report.write(publisher, STATE_DIR))
 
 
 if __name__ == "__main__":
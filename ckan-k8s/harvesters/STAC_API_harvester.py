@@ -1,17 +1,12 @@
-import os
-import pandas as pd
-import geopandas as gpd
-import math
-import numpy as np
-import collections
-from iso639 import Lang, iter_langs
+from iso639 import iter_langs
 
+import argparse
 import json
 import re
-import requests
-import shapely
-from shapely.geometry import shape, Polygon
-from stelar.client import Client
+from profiling import Profiler, add_profile_arguments
+from publisher import Publisher
+from spec_mirror import MIRROR_BUCKET
+from tag_normalizer import TagNormalizer
 
 ##############################################################################
 # Applicable to harvest these EO data sources:
@@ -39,6 +34,25 @@ STAC_API='https://openeo.eodc.eu/openeo/1.1.0/collections'
 STAC_themes = ['Air Quality','Biodiversity','Biomass','Vegetation','Climate','DEM','Demographics','Fire','Imagery','Infrastructure','Land Use','Land Cover','SAR','Snow','Soils','Solar','Temperature','Water','Weather']
 
 
+def stac_themes(tag):
+    """ Map a tag to STAC theme(s); also handle special cases not directly associated to STAC themes. """
+    if tag in STAC_themes or tag.title() in STAC_themes:
+        return [tag]
+    if tag in ('Satellite', 'landsat', 'sentinel', 'COG', 'HREA', 'Remote Sensing', 'Precipitation'):
+        return ['Imagery']
+    if tag == 'Wetlands':
+        return ['Water', 'Biodiversity']
+    if tag.lower().startswith('air'):
+        return ['Air Quality']
+    if tag.lower().startswith('building'):
+        return ['Land Use']
+    return []
+
+
+# Verdicts on keywords are cached across the collections of a harvest
+TAGS = TagNormalizer(themes=stac_themes)
+
+
 def get_timespan(temporalCoverage):
     """ Extract the start and end of the given temporal coverage.
     
@@ -91,11 +105,14 @@ def bbox(left, bottom, right, top):
     Returns:
         A GeoJson representing the given bounding box in WGS84.
     """
+    # shapely is only imported once a bounding box is needed, keeping start-up fast
+    from shapely.geometry import Polygon, mapping
+
     # Create a shapely geometry from the given coordinates    
     poly = Polygon([[left, bottom], [left, top], [right, top], [right, bottom]]) 
 
     # Covert it to GeoJSON as required by CKAN
-    return json.dumps(shapely.geometry.mapping(poly))
+    return json.dumps(mapping(poly))
 
 
 def slugify_title(title: str) -> str:
@@ -114,19 +131,16 @@ def slugify_title(title: str) -> str:
     return slug
 
 
-def ingest_stac_metadata(input_dict, c: Client):
+def ingest_stac_metadata(input_dict, publisher: Publisher):
     """ Ingest a data source conforming to STAC into the Data Catalog (CKAN) according to the given metadata (JSON).
     
     Args:
         input_dict (dict): JSON dictionary containing the metadata as obtained from STAC API.
-        owner_org (string): The organization account name as used by CKAN (to allow dataset names from different providers).
-        headers (dict): Headers for connecting to the CKAN API (including the CKAN token).
+        publisher (Publisher): The publisher creating or patching the dataset in the Data Catalog.
         
     Returns:
         The identifier of the published item in the Data Catalog; None, if publishing failed.
     """
-    pid = None
-    
     # # Include provider in the title to avoid conflicts with existing CKAN resources
     # # CKAN supports up to 100 characters in title; trim exceeding characters
     # if len(input_dict['title']) + len(' (' + owner_org + ')')> 200:
@@ -140,43 +154,10 @@ def ingest_stac_metadata(input_dict, c: Client):
     else:
         notes = input_dict['description']
         
-    # Check if tags conform to CKAN rules
-    # CKAN tags can only contain alphanumeric characters, spaces ( ), hyphens (-), underscores (_) or dots (.)
-    if 'keywords' in input_dict:
-        tags = [t.strip() for t in input_dict['keywords']]
-        # Keep all remaining tags in the extras
-        custom_tags = []
-        for t in tags:
-            if not re.match('[a-zA-Z\-\_\.\s]+$', t):
-                custom_tags.append(t)
-        # Remove not-conforming tags        
-        tags = [t for t in tags if t not in custom_tags]
-        if not custom_tags:
-            custom_tags = None
-    else:
-        tags = ['Remote Sensing']  # Assign ad-hoc tags; at least one must be specified
-        custom_tags = None
-
-    # Assign theme(s) according to tags; also handle special cases not directly associated to STAC themes
-    themes = []
-    for t in tags:
-        if t in STAC_themes:
-            themes.append(t)
-        elif t.title() in STAC_themes:
-            themes.append(t)
-        elif t == 'Satellite' or t=='landsat' or t=='sentinel' or t=='COG' or t=='HREA' or t=='Remote Sensing':
-            themes.append('Imagery')
-        elif t == 'Precipitation':
-            themes.append('Imagery')
-        elif t == 'Wetlands':
-            themes.append('Water')
-            themes.append('Biodiversity')
-        elif t.lower().startswith('air'):
-            themes.append('Air Quality')
-        elif t.lower().startswith('building'):
-            themes.append('Land Use')
-    # Remove duplicates
-    themes = list(dict.fromkeys(themes))
+    # Keep the keywords conforming to CKAN tag rules as tags, and the rest as custom tags (in the extras)
+    # Assign theme(s) according to tags; at least one tag must be specified
+    tags, custom_tags, themes = TAGS.partition(input_dict.get('keywords') or ['Remote Sensing'])
+    custom_tags = custom_tags or None
     if not themes:  # Assign ad-hoc theme
         themes.append('Remote Sensing')
             
@@ -259,7 +240,7 @@ def ingest_stac_metadata(input_dict, c: Client):
 
     spec = {
         "title": truncated_title,
-        "name": slugify_title(truncated_title),
+        "name": slugify_title(truncated_title),   # Preferred name; collisions are resolved by the publisher
         "notes": notes,
         "url": url,
         "private": False,  # Dataset metadata will be publicly accessible/searchable
@@ -278,48 +259,53 @@ def ingest_stac_metadata(input_dict, c: Client):
     }
     
 
+    # STAGE #2: Also publish the original JSON metadata as a resource
+    resource = None
+    if json_href:
+        resource = {
+            "title": input_dict['title'] + ' specifications',
+            "description": 'Specifications about ' + input_dict['title'] + ' data in JSON format',
+            "format": 'JSON',
+            "license": license,
+            "resource_type": 'other',
+            "url": json_href,
+        }
+
     try:
-        spec["organization"] = c.organizations["stelar-klms"]
-        d = c.datasets.create(**spec)
-        print('Created new dataset with ID:', d.id)
-        pid = str(d.id)
+        pid, rid = publisher.publish(input_dict['id'], spec, resource, record=input_dict)
+        print('Published dataset with ID:', pid)
     except Exception as e:
-        print('Error while preparing metadata for STAC item:', input_dict['title'], 'Error:', str(e))
+        print('Error while publishing STAC item:', input_dict['title'], 'Error:', str(e))
         return None, None
 
-
-    # STAGE #2: Also publish the original JSON metadata as a resource
-    rid = None
-    if pid != None and json_href:
-        # Put the details regarding the resource into a dictionary:
-        try:
-            r = d.add_resource(
-                title=input_dict['title'] + ' specifications',
-                description='Specifications about ' + input_dict['title'] + ' data in JSON format',
-                format='JSON',
-                license=license,
-                resource_type='other',
-                url=json_href
-            )
-            rid = str(r.id)
-        except Exception as e:
-            print('Error while creating resource for STAC item:', input_dict['title'], 'Error:', str(e))
-            return pid, None
-    
     return pid, rid
 
 
-def main():
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Harvest a STAC collection into the Data Catalog.')
+    parser.add_argument('--mirror-specs', nargs='?', const=MIRROR_BUCKET, default=None, metavar='BUCKET',
+                        help=f'Copy the specification documents into MinIO (default bucket: {MIRROR_BUCKET})')
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+    profiler = Profiler.from_args('stac_api', args)
+
     # Initialize the STELAR client, using context file. Credentials can be also hardcoded here like
     # c = Client(base_url="https://klms.stelar.gr", username='your_username', password='your_password')
+    from stelar.client import Client
     c = Client(context='staging')
     # Path to the JSON file containing DLR metadata
     json_file = 'path/to/dlr_metadata.json'
 
-    ingest_stac_metadata(
-        input_dict=json.load(open(json_file, 'r')),
-        c=c
-    )
+    # Name collisions are resolved locally, unchanged records are skipped on re-harvest
+    # and failed records are kept for replay (see dead_letters.py)
+    with profiler.stage('index'):
+        publisher = Publisher.for_harvester(c, 'stac_api', mirror_bucket=args.mirror_specs)
+
+    with profiler.stage('ingest'):
+        ingest_stac_metadata(
+            input_dict=json.load(open(json_file, 'r')),
+            publisher=publisher
+        )
 
 if __name__ == "__main__":
     main()
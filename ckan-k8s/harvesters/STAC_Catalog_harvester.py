@@ -1,16 +1,12 @@
-import os
-import pandas as pd
-import geopandas as gpd
-import math
-import numpy as np
-import collections
-from iso639 import Lang, iter_langs
-
-import json
+from iso639 import iter_langs
+
+import argparse
 import re
-import requests
-import shapely
-from shapely.geometry import shape, Polygon
+from urllib.parse import urljoin
+from profiling import Profiler, add_profile_arguments
+from publisher import STATE_DIR, Publisher
+from sharding import RunReport, Shard, add_shard_arguments
+from tag_normalizer import TagNormalizer
 
 ###################################################
 # Applicable to harvest these EO data sources:
@@ -26,6 +22,9 @@ from shapely.geometry import shape, Polygon
 # List of STAC themes
 STAC_themes = ['Air Quality','Biodiversity','Biomass','Vegetation','Climate','DEM','Demographics','Fire','Imagery','Infrastructure','Land Use','Land Cover','SAR','Snow','Soils','Solar','Temperature','Water','Weather']
 
+# Some themes depend on the title of a collection, so only the tag verdicts are shared
+TAGS = TagNormalizer()
+
 def get_timespan(temporalCoverage):
     """ Extract the start and end of the given temporal coverage.
     
@@ -78,28 +77,70 @@ def bbox(left, bottom, right, top):
     Returns:
         A GeoJson representing the given bounding box in WGS84.
     """
+    # shapely is only imported once a bounding box is needed, keeping start-up fast
+    from shapely.geometry import Polygon, mapping
+
     # Create a shapely geometry from the given coordinates    
     poly = Polygon([[left, bottom], [left, top], [right, top], [right, bottom]]) 
 
-    # Covert it to GeoJSON as required by CKAN
-    return json.dumps(shapely.geometry.mapping(poly))
+    # Return a native Python dict (GeoJSON) so the CKAN client can serialize it properly
+    return mapping(poly)
+
 
+def slugify_title(title: str) -> str:
+    """Convert string to URL-friendly slug."""
+    slug = title.lower().strip()
+    slug = re.sub(r'[^a-z0-9\s]', '', slug)
+    return re.sub(r'\s+', '-', slug)
 
-def ingest_stac_metadata(input_dict, base_url, stac_url, owner_org, headers):
+
+def load_stac_collections(base_url, stac_url, owner_org):
+    """ Fetch the collections listed in a static STAC catalog.
+
+    Every collection keeps the details of its catalog (under '_catalog') and its
+    identifier in the harvest (under '@id'), so that it can be replayed on its own.
+
+    Args:
+        base_url (string): The URL of the STAC catalog (ending with '/').
+        stac_url (string): The publicly accessible URL of the STAC catalog.
+        owner_org (string): The name of the provider, appended to the titles.
+
+    Returns:
+        A list with the JSON dictionary of every collection.
+    """
+    import requests
+
+    catalog = requests.get(urljoin(base_url, 'catalog.json'), timeout=60)
+    catalog.raise_for_status()
+    collections = []
+    for link in catalog.json().get('links', []):
+        if link.get('rel') != 'child':
+            continue
+        href = urljoin(base_url, link['href'])
+        response = requests.get(href, timeout=60)
+        response.raise_for_status()
+        collection = response.json()
+        collection['_catalog'] = {'base_url': base_url, 'stac_url': stac_url, 'owner_org': owner_org}
+        collection['@id'] = base_url + collection['id'] + '/collection.json'
+        collections.append(collection)
+    return collections
+
+
+def ingest_stac_metadata(input_dict, publisher: Publisher):
     """ Ingest a data source conforming to STAC into the Data Catalog (CKAN) according to the given metadata (JSON).
     
     Args:
-        input_dict (dict): JSON dictionary containing the metadata as obtained from the STAC Catalog.
-        base_url (string): The URL of the organization.
-        stac_url (string): The publicly accessile STAC URL of the organization.
-        owner_org (string): The organization account name as used by CKAN (to allow dataset names from different providers).
-        headers (dict): Headers for connecting to the CKAN API (including the CKAN token).
+        input_dict (dict): JSON dictionary containing the metadata as obtained from the STAC Catalog,
+            with the details of its catalog (see load_stac_collections).
+        publisher (Publisher): The publisher creating or patching the dataset in the Data Catalog.
         
     Returns:
-        The identifier of the published item in the Data Catalog; None, if publishing failed.
+        A pair with the identifiers of the published dataset and resource; None, if publishing failed.
     """
-    pid = None
-    
+    base_url = input_dict['_catalog']['base_url']
+    stac_url = input_dict['_catalog']['stac_url']
+    owner_org = input_dict['_catalog']['owner_org']
+
     # Include provider in the title to avoid conflicts with existing CKAN resources
     # CKAN supports up to 200 characters in title; trim exceeding characters
     if len(input_dict['title']) + len(' (' + owner_org + ')')> 200:
@@ -113,22 +154,9 @@ def ingest_stac_metadata(input_dict, base_url, stac_url, owner_org, headers):
     else:
         notes = input_dict['description']
         
-    # Check if tags conform to CKAN rules
-    # CKAN tags can only contain alphanumeric characters, spaces ( ), hyphens (-), underscores (_) or dots (.)
-    if 'keywords' in input_dict:
-        tags = [t.strip() for t in input_dict['keywords']]
-        # Keep all remaining tags in the extras
-        custom_tags = []
-        for t in tags:
-            if not re.match('[a-zA-Z\-\_\.\s]+$', t):
-                custom_tags.append(t)
-        # Remove not-conforming tags        
-        tags = [t for t in tags if t not in custom_tags]
-        if not custom_tags:
-            custom_tags = None
-    else:
-        tags = ['Remote Sensing']  # Assign ad-hoc tags; at least one must be specified
-        custom_tags = None
+    # Keep the keywords conforming to CKAN tag rules as tags, and the rest as custom tags
+    tags, custom_tags, _ = TAGS.partition(input_dict.get('keywords') or ['Remote Sensing'])  # At least one tag must be specified
+    custom_tags = custom_tags or None
 
     # Assign theme(s) according to tags; also handle special cases not directly associated to STAC themes
     themes = []
@@ -180,6 +208,7 @@ def ingest_stac_metadata(input_dict, base_url, stac_url, owner_org, headers):
     temporal_start, temporal_end = get_timespan(input_dict['extent']['temporal'])
 
     # Extract spatial coverage
+    spatial = None
     geom = input_dict['extent']['spatial']
     if geom['bbox']:
         bounds = geom['bbox'][0]   # Considering the first bounding box only
@@ -196,43 +225,84 @@ def ingest_stac_metadata(input_dict, base_url, stac_url, owner_org, headers):
                 if 'processor' in provider['roles']:
                     publisher_url = provider['url']
 
-    # Construct a JSON for each data source (CKAN package)
-    # IMPORTANT! NO CKAN resources will be associated with each package
-    pub_metadata = {
-        'basic_metadata': {
-            'title': title,
-            'notes': notes,  # CKAN supports up to 10000 characters
-            'url': url,
-            'version': next((value for key,value in input_dict.items() if key == 'version'), None),
-    #        'license_id': 'other-closed',         # No generic CKAN license for STAC
-            'private' : False,  # Dataset metadata will be publicly accessible/searchable
-            'tags': tags  # Original keywords conforming to CKAN rules
-        },
-        'extra_metadata': {
-#            'alternate_identifier': alt_href,
-            'documentation': doc,
-            'license': next((value for key,value in input_dict.items() if key == 'license'), None),  # Specify here the license (may be a URL, link to a PDF, etc.)
-            'theme': themes,
-            'language': ['en'],   # Ad-hoc language assigned for metadata
-            'spatial': spatial,
-            'temporal_start': temporal_start,
-            'temporal_end': temporal_end,
-            'contact_name': next((value for key,value in input_dict.items() if key == 'contact_name'), None),
-            'contact_email': next((value for key,value in input_dict.items() if key == 'contact_email'), None),
-            'custom_tags': custom_tags   # Any original keywords NOT conforming to CKAN rules
-            }
-        }
-
-    # Publish this collection as a CKAN package
-    # Make a POST request to the KLMS API with the package metadata
-    pub_response = requests.post(KLMS_API+'catalog/publish', json=pub_metadata, headers=headers)
-
-    response_dict = pub_response.json()
-    if ('success' in response_dict) and (response_dict['success'] is True):
-        # Extract the ID of the newly created package
-        pid = response_dict['result'][0]['result']['id']
-        print('Status Code:', pub_response.status_code,'. New data source', title, 'published in CKAN with ID:' + pid)
-    else:
-        print('Status Code:', pub_response.text,'. Data source ', title, 'not published in CKAN.')
-    
-    return pid
+    # The dataset properties; no resources are associated with each package
+    spec = {
+        'title': title,
+        'name': slugify_title(title),   # Preferred name; collisions are resolved by the publisher
+        'notes': notes,  # CKAN supports up to 10000 characters
+        'url': url,
+        'version': next((value for key,value in input_dict.items() if key == 'version'), None),
+#        'license_id': 'other-closed',         # No generic CKAN license for STAC
+        'private' : False,  # Dataset metadata will be publicly accessible/searchable
+        'tags': tags,  # Original keywords conforming to CKAN rules
+#        'alternate_identifier': alt_href,
+        'documentation': doc,
+        'license': next((value for key,value in input_dict.items() if key == 'license'), None),  # Specify here the license (may be a URL, link to a PDF, etc.)
+        'theme': themes,
+        'language': ['en'],   # Ad-hoc language assigned for metadata
+        'spatial': spatial,
+        'temporal_start': temporal_start,
+        'temporal_end': temporal_end,
+        'contact_name': next((value for key,value in input_dict.items() if key == 'contact_name'), None),
+        'contact_email': next((value for key,value in input_dict.items() if key == 'contact_email'), None),
+        'custom_tags': custom_tags   # Any original keywords NOT conforming to CKAN rules
+    }
+    spec = {k: v for k, v in spec.items() if v is not None}
+
+    try:
+        pid, rid = publisher.publish(input_dict['@id'], spec, record=input_dict)
+        print('New data source', title, 'published in CKAN with ID:', pid)
+    except Exception as e:
+        print('Data source', title, 'not published in CKAN. Error:', str(e))
+        return None, None
+    return pid, rid
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Harvest the collections of a static STAC catalog into the Data Catalog.')
+    parser.add_argument('base_url', help="The URL of the STAC catalog, e.g., https://s3.eu-central-1.wasabisys.com/stac/odse/")
+    parser.add_argument('--stac-url', default=None,
+                        help='The publicly accessible URL of the catalog, for the documentation links (default: base_url)')
+    parser.add_argument('--owner-org', required=True, help='The name of the provider, appended to the titles')
+    add_profile_arguments(parser)
+    add_shard_arguments(parser)
+    args = parser.parse_args(argv)
+    profiler = Profiler.from_args('stac_catalog', args)
+    shard = Shard.from_args(args)
+    report = RunReport('stac_catalog', shard)
+    base_url = args.base_url if args.base_url.endswith('/') else args.base_url + '/'
+    stac_url = args.stac_url or base_url
+
+    # The STELAR client (and pandas with it) is imported only when actually harvesting
+    from stelar.client import Client
+    c = Client(context='default')
+
+    with profiler.stage('load'):
+        records = load_stac_collections(base_url, stac_url, args.owner_org)
+
+    # Only the records of this worker's shard, if the harvest is split among several workers
+    if shard.sharded:
+        owned = [record for record in records if shard.owns(record['@id'])]
+        report.skipped = len(records) - len(owned)
+        records = owned
+        print(f'Shard {shard}: harvesting {len(records)} record(s)')
+
+    # Name collisions are resolved locally, unchanged records are skipped on re-harvest
+    # and failed records are kept for replay (see dead_letters.py)
+    with profiler.stage('index'):
+        publisher = Publisher.for_harvester(c, 'stac_catalog', shard)
+
+    with profiler.stage('ingest'):
+        for record in records:
+            try:
+                ingest_stac_metadata(record, publisher)
+            except Exception as e:
+                # Failed before publishing (e.g., parsing the record)
+                print(f"Error while harvesting STAC collection: {record.get('title')} : {e}")
+                publisher.record_failure(record['@id'], e, record=record)
+
+    print('Run report written to', report.write(publisher, STATE_DIR))
+
+
+if __name__ == '__main__':
+    main()
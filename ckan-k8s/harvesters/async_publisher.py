@@ -0,0 +1,239 @@
+import asyncio
+import email.utils
+import os
+import ssl
+from datetime import datetime, timezone
+from urllib.parse import urljoin
+
+import aiohttp
+from stelar.client import Dataset, Resource
+
+from publisher import Publisher
+
+##############################################################################
+# Asyncio-native publishing of harvested records into the Data Catalog.
+#
+# The AsyncPublisher runs the publication plan of the Publisher (name allocation,
+# snapshots and field-level patches, dead letters), but performs its operations
+# over a pooled aiohttp session, so that a single event loop can keep hundreds
+# of writes in flight. Properties are converted to entities by the STELAR client
+# classes, exactly as the synchronous client does; the client itself is used
+# only for authentication and for the (cached) organization lookup.
+##############################################################################
+
+# Responses worth retrying, after the delay suggested by the server (if any)
+RETRY_STATUS = {429, 502, 503, 504}
+
+
+class APIError(RuntimeError):
+    """ An unsuccessful response of the STELAR API. """
+
+    def __init__(self, method, endpoint, status, error):
+        super().__init__(f'{method} {endpoint} failed with status {status}: {error}')
+        self.status = status
+        self.error = error
+
+
+def ssl_argument(verify):
+    """ Return the 'ssl' argument of aiohttp verifying the server as the STELAR client does.
+
+    Args:
+        verify (bool or string): As the 'tls_verify' of the client (and 'verify' of requests):
+            whether to verify the server, or the CA bundle (file or directory) to verify it with.
+    """
+    if isinstance(verify, (str, os.PathLike)):
+        if os.path.isdir(verify):
+            return ssl.create_default_context(capath=verify)
+        return ssl.create_default_context(cafile=verify)
+    return bool(verify)
+
+
+def client_token(c):
+    """ Return a function giving the access token of a STELAR client (blocking).
+
+    The function re-authenticates the client first if its token has expired, or if
+    called with refresh=True.
+    """
+    def token(refresh=False):
+        if refresh or c.token_expired():
+            c.reauthenticate()
+        return c.token
+    return token
+
+
+def retry_delay(retry_after, default):
+    """ Return the delay (seconds) asked by a Retry-After header, in seconds or as an HTTP date.
+
+    Returns:
+        The delay asked, or the default if the header is missing or invalid.
+    """
+    if retry_after is None:
+        return default
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return default
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class AsyncPublisher:
+    """ Publish harvested records concurrently from a single event loop.
+
+    Use as an asynchronous context manager:
+
+        async with AsyncPublisher(Publisher.for_harvester(c, 'gee'), max_in_flight=200) as ap:
+            await ap.publish_all(jobs)
+
+    Args:
+        publisher (Publisher): The synchronous publisher providing the client and the harvest state.
+        max_in_flight (int): Maximum number of records being published at the same time.
+        retries (int): Number of retries of throttled or unavailable requests.
+        verify (bool or string): Whether to verify the TLS certificate of the server, or the CA
+            bundle to verify it with; pass the 'tls_verify' the client was created with.
+        token (callable): A blocking function token(refresh=False) returning the access token;
+            by default, that of the client (see client_token).
+    """
+
+    def __init__(self, publisher: Publisher, max_in_flight=100, retries=5, verify=True, token=None):
+        self.publisher = publisher
+        self.client = publisher.client
+        self.verify = verify
+        self.token = token if token is not None else client_token(publisher.client)
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self._session = None
+        self._slots = None
+        self._auth_lock = None
+        self._org_task = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight, ssl=ssl_argument(self.verify))
+        self._session = aiohttp.ClientSession(connector=connector)
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._auth_lock = asyncio.Lock()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+
+    async def _token(self, refresh=False):
+        async with self._auth_lock:
+            return await asyncio.to_thread(self.token, refresh)
+
+    async def request(self, method, endpoint, json=None):
+        """ Call the STELAR API and return the 'result' of a successful response.
+
+        Throttled requests (429) and unavailable servers are retried with backoff;
+        an expired token is refreshed once.
+
+        Raises:
+            APIError: If the request fails, or the response is not a successful API response
+                (e.g., an error page of a proxy).
+        """
+        url = urljoin(self.client.api_url, endpoint)
+        token = await self._token()
+        refreshed = False
+        attempt = 0
+        while True:
+            headers = {'Authorization': f'Bearer {token}'}
+            async with self._session.request(method, url, json=json, headers=headers) as resp:
+                if resp.status == 401 and not refreshed:
+                    token = await self._token(refresh=True)
+                    refreshed = True
+                    continue
+                if resp.status in RETRY_STATUS and attempt < self.retries:
+                    delay = retry_delay(resp.headers.get('Retry-After'), 0.5 * 2 ** attempt)
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                    continue
+                if resp.content_type != 'application/json':
+                    raise APIError(method, endpoint, resp.status, await resp.text())
+                body = await resp.json()
+            if resp.status < 400 and isinstance(body, dict) and body.get('success'):
+                return body['result']
+            raise APIError(method, endpoint, resp.status,
+                           body.get('error') if isinstance(body, dict) else body)
+
+    async def organization(self):
+        # Resolved once for all records; concurrent callers await the same lookup
+        if self._org_task is None:
+            self._org_task = asyncio.ensure_future(
+                asyncio.to_thread(lambda: self.publisher.organization))
+        return await self._org_task
+
+    async def publish(self, source_id, spec, resource=None, record=None):
+        """ Publish a harvested record; see Publisher.publish for the semantics. """
+        async with self._slots:
+            return await self.run_plan(self.publisher.plan(source_id, spec, resource, record))
+
+    async def run_plan(self, steps):
+        """ Run a publication plan (see Publisher.plan), as publisher.run_plan does. """
+        result, error = None, None
+        while True:
+            try:
+                operation = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as done:
+                return done.value
+            try:
+                result, error = await self.perform(*operation), None
+            except Exception as e:
+                result, error = None, e
+
+    async def perform(self, operation, *args):
+        """ Perform an operation of a publication plan (see Publisher.plan) over the session. """
+        return await getattr(self, f'_{operation}')(*args)
+
+    async def publish_all(self, jobs):
+        """ Publish many records concurrently.
+
+        Args:
+            jobs: An iterable of (source_id, spec, resource, record) tuples.
+
+        Returns:
+            A list with the (pid, rid) pair of every job, or the exception that made it fail.
+        """
+        return await asyncio.gather(*(self.publish(*job) for job in jobs), return_exceptions=True)
+
+    async def _mirror(self, resource):
+        return await asyncio.to_thread(self.publisher.mirror.mirror_resource, resource)
+
+    async def _recover(self, source_id, spec, resource):
+        return await asyncio.to_thread(self.publisher.recover_snapshot, source_id, spec, resource)
+
+    async def _create(self, spec):
+        entity = self._entity(Dataset, **spec, organization=await self.organization())
+        return str((await self.request('POST', 'v2/dataset', entity))['id'])
+
+    async def _update(self, pid, old, new):
+        await self.request('PATCH', f'v2/dataset/{pid}', self._entity_patch(Dataset, old, new))
+
+    async def _add_resource(self, pid, resource):
+        return str((await self.request('POST', 'v2/resource', self._resource_entity(pid, resource)))['id'])
+
+    async def _update_resource(self, pid, rid, old, resource):
+        # Resources are updated as a whole, as the synchronous client does
+        await self.request('PUT', f'v2/resource/{rid}', self._resource_entity(pid, resource))
+
+    def _entity(self, proxy_type, **fields):
+        # Validate and convert the properties through an unsynced creation proxy,
+        # which is how the synchronous client builds the entities it sends
+        return proxy_type.new(self.client, autosync=False, **fields).proxy_to_entity()
+
+    def _resource_entity(self, pid, resource):
+        # The client validates package references only as proxies; the id is set directly
+        return dict(self._entity(Resource, **resource), package_id=pid)
+
+    def _entity_patch(self, proxy_type, old, new):
+        # Convert both versions to entities, so that the patch carries exactly the entity
+        # fields that changed, under the names and in the form the API expects
+        old_entity = self._entity(proxy_type, **old)
+        new_entity = self._entity(proxy_type, **new)
+        patch = {key: value for key, value in new_entity.items() if old_entity.get(key) != value}
+        patch.update({key: None for key in old_entity if key not in new_entity})
+        return patch
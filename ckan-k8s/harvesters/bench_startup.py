@@ -0,0 +1,135 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from harvest import discover
+
+##############################################################################
+# Cold-start benchmark of the harvesters.
+#
+# Imports the harvester CLI and every harvester module in fresh interpreters,
+# measuring the import time and the peak RSS, and checks them against the
+# start-up budget; exits with status 1 if a budget is exceeded (e.g., because
+# a heavy dependency is imported at module level again):
+#
+#   python bench_startup.py --runs 5 --importtime
+##############################################################################
+
+# Start-up budget (seconds, MB of peak RSS) of importing each kind of module
+CLI_BUDGET = (0.1, 40)
+HARVESTER_BUDGET = (0.5, 80)
+
+# The STELAR client is needed by every harvest, but lies outside the harvesters; it is reported only
+REFERENCE_MODULES = ['stelar.client']
+
+_PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+__import__(sys.argv[1])
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  'modules': len(sys.modules)}))
+"""
+
+
+def probe(module, importtime=False):
+    """ Import a module in a fresh interpreter.
+
+    Returns:
+        The measurements (seconds, rss_mb, modules), and the output of -X importtime if requested;
+        None if the module cannot be imported.
+    """
+    cmd = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', _PROBE, module]
+    proc = subprocess.run(cmd, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if proc.returncode != 0:
+        print(f'{module}: cannot be imported: {proc.stderr.strip().splitlines()[-1]}')
+        return None, None
+    return json.loads(proc.stdout.strip().splitlines()[-1]), proc.stderr
+
+
+def slowest_imports(importtime_output, module, top=10):
+    """ Return the direct imports of a module with the highest cumulative time (microseconds).
+
+    Args:
+        importtime_output (string): The output of -X importtime.
+        module (string): The module imported by the probe.
+    """
+    lines = []
+    for line in importtime_output.splitlines():
+        if line.startswith('import time:') and 'cumulative' not in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            lines.append((int(cumulative), name[1:]))
+
+    # A module is reported after its own imports, which are indented one level deeper
+    imports = []
+    for cumulative, name in reversed(lines[:[name for _, name in lines].index(module)]):
+        if not name.startswith(' '):
+            break
+        if not name.startswith('   '):
+            imports.append((cumulative, name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def measure(module, runs, importtime=False):
+    samples = []
+    for _ in range(runs):
+        result, _ = probe(module)
+        if result is None:
+            return None
+        samples.append(result)
+    measured = {
+        'module': module,
+        'seconds': statistics.median(s['seconds'] for s in samples),
+        'rss_mb': max(s['rss_mb'] for s in samples),
+        'modules': samples[-1]['modules'],
+    }
+    if importtime:
+        _, output = probe(module, importtime=True)
+        measured['slowest_imports'] = slowest_imports(output or '', module)
+    return measured
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the cold-start time and memory of the harvesters.')
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters per module (the median time is kept)')
+    parser.add_argument('--importtime', action='store_true', help='List the slowest imports of every module')
+    parser.add_argument('--json', default=None, help='Also write the measurements to this file')
+    args = parser.parse_args(argv)
+
+    targets = [('harvest', CLI_BUDGET)]
+    targets += [(plugin.module, HARVESTER_BUDGET) for plugin in discover().values()]
+    targets += [(module, None) for module in REFERENCE_MODULES]
+
+    results, failed = [], []
+    print(f'{"module":<26} {"time (ms)":>10} {"RSS (MB)":>9} {"modules":>8}  budget')
+    for module, budget in targets:
+        measured = measure(module, args.runs, args.importtime)
+        if measured is None:
+            failed.append(module)
+            continue
+        verdict = ''
+        if budget is not None:
+            max_seconds, max_rss = budget
+            within = measured['seconds'] <= max_seconds and measured['rss_mb'] <= max_rss
+            verdict = f"{'ok' if within else 'EXCEEDED'} ({max_seconds * 1000:.0f} ms, {max_rss} MB)"
+            if not within:
+                failed.append(module)
+        print(f"{module:<26} {measured['seconds'] * 1000:>10.1f} {measured['rss_mb']:>9.1f} "
+              f"{measured['modules']:>8}  {verdict}")
+        for cumulative, name in measured.get('slowest_imports', []):
+            print(f'    {cumulative / 1000:>8.1f} ms  {name}')
+        results.append(dict(measured, budget=budget))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if failed:
+        print('Failed to import, or exceeded the start-up budget:', ', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
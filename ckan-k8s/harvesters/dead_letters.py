@@ -0,0 +1,212 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from harvest import discover, load
+from sharding import Shard, add_shard_arguments
+
+##############################################################################
+# Dead-letter store for harvested records that could not be published.
+#
+# Every failure is kept (record, specification, error class, attempt count) in
+# a small SQLite database in the harvester state directory, and can be retried
+# later without a full re-harvest:
+#
+#   python dead_letters.py list gee
+#   python dead_letters.py replay gee --workers 8
+##############################################################################
+
+def _dumps(value):
+    return None if value is None else json.dumps(value, default=str)
+
+
+def _loads(value):
+    return None if value is None else json.loads(value)
+
+
+def _describe(error):
+    # Some client exceptions fail to render; the failure must still be recorded
+    try:
+        return str(error)
+    except Exception:
+        return type(error).__name__
+
+
+class DeadLetterStore:
+    """ Persistent store of the harvested records whose publishing failed.
+
+    Args:
+        path (string): The SQLite database file.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS dead_letters (
+                    source_id TEXT PRIMARY KEY,
+                    record TEXT,
+                    spec TEXT,
+                    resource TEXT,
+                    error_class TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL,
+                    first_failed REAL NOT NULL,
+                    last_failed REAL NOT NULL
+                )""")
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM dead_letters").fetchone()[0]
+
+    def add(self, source_id, error, record=None, spec=None, resource=None):
+        """ Record a failure of the given record; repeated failures increase its attempt count.
+
+        Args:
+            source_id (string): The identifier of the record in the harvested catalog.
+            error (Exception): The error that caused the failure.
+            record (dict): The record as obtained from the harvested catalog, if known.
+            spec (dict): The dataset properties, if the record was transformed successfully.
+            resource (dict): The resource properties, if any.
+        """
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("""
+                INSERT INTO dead_letters VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?)
+                ON CONFLICT(source_id) DO UPDATE SET
+                    record = COALESCE(excluded.record, record),
+                    spec = COALESCE(excluded.spec, spec),
+                    resource = COALESCE(excluded.resource, resource),
+                    error_class = excluded.error_class,
+                    error = excluded.error,
+                    attempts = attempts + 1,
+                    last_failed = excluded.last_failed
+                """,
+                (str(source_id), _dumps(record), _dumps(spec), _dumps(resource),
+                 type(error).__name__, _describe(error), now, now))
+
+    def discard(self, source_id):
+        """ Forget the given record, typically after it has been published successfully. """
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM dead_letters WHERE source_id = ?", (str(source_id),))
+
+    def attempts(self, source_id):
+        """ Return the number of failures recorded for the given record (0 if none). """
+        with self._lock:
+            row = self._db.execute("SELECT attempts FROM dead_letters WHERE source_id = ?",
+                                   (str(source_id),)).fetchone()
+        return 0 if row is None else row[0]
+
+    def entries(self, max_attempts=None):
+        """ Return the stored failures as dictionaries, oldest first.
+
+        Args:
+            max_attempts (int): If given, skip records that already failed this many times.
+        """
+        query = "SELECT * FROM dead_letters"
+        params = ()
+        if max_attempts is not None:
+            query += " WHERE attempts < ?"
+            params = (max_attempts,)
+        with self._lock:
+            cursor = self._db.execute(query + " ORDER BY first_failed", params)
+            columns = [d[0] for d in cursor.description]
+            rows = cursor.fetchall()
+        entries = []
+        for row in rows:
+            entry = dict(zip(columns, row))
+            for key in ('record', 'spec', 'resource'):
+                entry[key] = _loads(entry[key])
+            entries.append(entry)
+        return entries
+
+
+def replay(harvester, publisher, workers=8, max_attempts=None):
+    """ Retry publishing the records in the dead-letter store of the publisher, in parallel.
+
+    Records whose specification is known are published again as they are. Records
+    that failed before being transformed are passed to the harvester once more; if
+    the harvester fails again, the attempt is counted, and if it skips the record
+    on purpose (e.g., a deprecated data source), the record is discarded.
+
+    Args:
+        harvester (string): The harvester key (see harvest.py).
+        publisher (Publisher): A publisher with a dead-letter store.
+        workers (int): Number of records in flight.
+        max_attempts (int): If given, skip records that already failed this many times.
+
+    Returns:
+        A pair with the number of records retried and the number still failing.
+    """
+    plugin = discover()[harvester]
+    entries = publisher.dead_letters.entries(max_attempts)
+
+    def retry(entry):
+        source_id = entry['source_id']
+        try:
+            if entry['spec'] is not None:
+                publisher.publish(source_id, entry['spec'], entry['resource'], record=entry['record'])
+                return True
+            if entry['record'] is None:
+                print('Nothing to replay for', source_id)
+                return False
+            # The harvester module is only needed for records never transformed
+            ingest = load(plugin, plugin.ingest)
+            pid, _ = ingest(entry['record'], publisher)
+            if pid is not None:
+                return True
+            # A failure to publish is recorded by the publisher; otherwise the record was skipped
+            if publisher.dead_letters.attempts(source_id) == entry['attempts']:
+                print('Skipped by the harvester, discarding', source_id)
+                publisher.dead_letters.discard(source_id)
+                return True
+            return False
+        except Exception as e:
+            print('Replay failed for', source_id, 'Error:', str(e))
+            # Failures of the harvester itself (e.g., transforming the record) are not recorded by the publisher
+            if publisher.dead_letters.attempts(source_id) == entry['attempts']:
+                publisher.record_failure(source_id, e, record=entry['record'])
+            return False
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        outcomes = list(executor.map(retry, entries))
+    return len(outcomes), outcomes.count(False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect or replay the failed records of a harvester.')
+    parser.add_argument('command', choices=['list', 'replay'])
+    parser.add_argument('harvester', choices=sorted(discover()))
+    parser.add_argument('--context', default='default', help='The STELAR client context')
+    parser.add_argument('--workers', type=int, default=8, help='Number of records replayed in parallel')
+    parser.add_argument('--max-attempts', type=int, default=None, help='Skip records failed this many times')
+    add_shard_arguments(parser)
+    args = parser.parse_args(argv)
+
+    from publisher import Publisher, state_path
+
+    # Every shard of a sharded harvest keeps its own dead letters
+    shard = Shard.from_args(args)
+    if args.command == 'list':
+        store = DeadLetterStore(state_path(f'{shard.state_key(args.harvester)}_dead_letters.db'))
+        for entry in store.entries(args.max_attempts):
+            print(f"{entry['source_id']}\t{entry['attempts']}\t{entry['error_class']}: {entry['error']}")
+        print(f'{len(store)} failed record(s).')
+        return
+
+    from stelar.client import Client
+
+    publisher = Publisher.for_harvester(Client(context=args.context), args.harvester, shard)
+    retried, failed = replay(args.harvester, publisher, args.workers, args.max_attempts)
+    print(f'Replayed {retried} record(s): {retried - failed} published, {failed} still failing.')
+
+
+if __name__ == '__main__':
+    main()
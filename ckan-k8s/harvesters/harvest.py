@@ -0,0 +1,89 @@
+import argparse
+import importlib
+import sys
+from collections import namedtuple
+
+##############################################################################
+# Single command-line entry point of the harvesters:
+#
+#   python harvest.py list
+#   python harvest.py gee --concurrency 100
+#
+# Source plugins are discovered without being imported; the module of a
+# harvester (and its heavy dependencies: the STELAR client, shapely, ...) is
+# only imported once it is run. Besides the built-in harvesters, any installed
+# package may contribute plugins through the 'stelar.harvesters' entry point
+# group, e.g., in its pyproject.toml:
+#
+#   [project.entry-points."stelar.harvesters"]
+#   my_source = "my_package.my_harvester"
+#
+# The plugin module must provide main(argv), and may provide the function
+# ingesting a single record (see dead_letters.py) as ingest_record.
+##############################################################################
+
+ENTRY_POINT_GROUP = 'stelar.harvesters'
+
+# module: the module of the harvester; ingest: the function publishing a single record
+HarvesterPlugin = namedtuple('HarvesterPlugin', ['key', 'module', 'ingest', 'description'])
+
+BUILTIN_PLUGINS = [
+    HarvesterPlugin('stac_api', 'STAC_API_harvester', 'ingest_stac_metadata', 'A collection of a STAC API'),
+    HarvesterPlugin('stac_catalog', 'STAC_Catalog_harvester', 'ingest_stac_metadata', 'A static STAC catalog'),
+    HarvesterPlugin('gee', 'GoogleEarth_harvester', 'ingest_earthengine_metadata', 'The Google Earth Engine catalog'),
+    HarvesterPlugin('dlr', 'DLR_harvester', 'ingest_dlr_record', 'The data assets of DLR'),
+]
+
+
+def discover():
+    """ Find the available harvester plugins, without importing any of them.
+
+    Returns:
+        A dictionary of the plugins by key; installed plugins override built-in ones of the same key.
+    """
+    plugins = {plugin.key: plugin for plugin in BUILTIN_PLUGINS}
+    from importlib.metadata import entry_points
+    for ep in entry_points(group=ENTRY_POINT_GROUP):
+        plugins[ep.name] = HarvesterPlugin(ep.name, ep.value.split(':')[0], 'ingest_record',
+                                           f'Installed from {ep.value}')
+    return plugins
+
+
+def load(plugin: HarvesterPlugin, attribute):
+    """ Import the module of a plugin and return one of its functions.
+
+    Raises:
+        LookupError: If the module does not provide the function.
+    """
+    module = importlib.import_module(plugin.module)
+    if not hasattr(module, attribute):
+        raise LookupError(f'Harvester {plugin.key} ({plugin.module}) does not provide {attribute}()')
+    return getattr(module, attribute)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    plugins = discover()
+
+    parser = argparse.ArgumentParser(
+        description='Harvest a data source into the Data Catalog.',
+        epilog='The options of a harvester are listed with: harvest.py <harvester> --help')
+    parser.add_argument('harvester', choices=['list'] + sorted(plugins),
+                        help="The harvester to run, or 'list' to list the available ones")
+    args = parser.parse_args(argv[:1])
+
+    if args.harvester == 'list':
+        for plugin in plugins.values():
+            print(f'{plugin.key:<14} {plugin.description} ({plugin.module})')
+        return
+
+    # Only the selected harvester is imported; it parses the rest of the command line
+    try:
+        run = load(plugins[args.harvester], 'main')
+    except LookupError as e:
+        parser.error(str(e))
+    run(argv[1:])
+
+
+if __name__ == '__main__':
+    main()
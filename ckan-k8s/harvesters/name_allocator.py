@@ -0,0 +1,163 @@
+import hashlib
+import threading
+
+##############################################################################
+# Collision-aware allocation of CKAN package names for the harvesters.
+#
+# The set of existing package names is loaded once from the catalog; every
+# subsequent check is an in-memory lookup, so resolving a collision costs no
+# network round trip. Names are reserved under a lock, so several worker
+# threads of the same harvest can share a single allocator.
+#
+# Every harvested package records the source id of its record (SOURCE_ID_FIELD),
+# and the harvested packages are indexed by it: a record published before keeps
+# its package, even when the harvest state has been lost.
+##############################################################################
+
+# CKAN limits package names to 100 characters
+MAX_NAME_LENGTH = 100
+
+# Initial number of hex digits of the source id hash used as a suffix
+SUFFIX_LENGTH = 8
+
+# The extra property of a harvested package holding the source id of its record
+SOURCE_ID_FIELD = 'harvest_source_id'
+
+
+def stable_hash(source_id: str) -> str:
+    """ Compute a hash of a source identifier which is stable across runs and hosts.
+
+    Args:
+        source_id (string): The identifier of the record in the harvested catalog.
+
+    Returns:
+        The hex digest (SHA-1) of the identifier.
+    """
+    return hashlib.sha1(str(source_id).encode('utf-8')).hexdigest()
+
+
+def load_package_names(c, page_size=1000):
+    """ Fetch the names of all packages currently in the Data Catalog.
+
+    Args:
+        c (Client): The STELAR client.
+        page_size (int): Number of names fetched per request.
+
+    Returns:
+        A set with the names of all existing packages.
+    """
+    names = set()
+    offset = 0
+    while True:
+        page = c.datasets.fetch_list(limit=page_size, offset=offset)
+        names.update(page)
+        if len(page) < page_size:
+            break
+        offset += page_size
+    return names
+
+
+def load_harvested_packages(c, page_size=1000):
+    """ Fetch the packages of the Data Catalog which record the source id of a harvested record.
+
+    Args:
+        c (Client): The STELAR client.
+        page_size (int): Number of packages fetched per request.
+
+    Returns:
+        A dictionary mapping the source id of every harvested package to its (id, name).
+    """
+    # CKAN indexes the extra properties of the packages as extras_<property>
+    key = 'extras_' + SOURCE_ID_FIELD
+    packages = {}
+    offset = 0
+    while True:
+        page = c.datasets.search(fq=[f'{key}:*'], fl=['id', 'name', key],
+                                 limit=page_size, offset=offset)['results']
+        for p in page:
+            source_id = p.get(key) or (p.get('extras') or {}).get(SOURCE_ID_FIELD)
+            if source_id is not None:
+                packages[str(source_id)] = (str(p['id']), p['name'])
+        if len(page) < page_size:
+            break
+        offset += page_size
+    return packages
+
+
+class NameAllocator:
+    """ Assign unique CKAN package names to harvested records.
+
+    A record already in the catalog keeps the name of its package. A new record
+    takes the slug of its title whenever that is free; otherwise, a suffix taken
+    from the stable hash of its source id is appended.
+
+    Args:
+        existing_names (iterable): The names of the packages in the catalog.
+        packages (dict): The (id, name) of the harvested packages in the catalog, by source id.
+        always_suffix (bool): Append the suffix to every new name, e.g., when several
+            allocators (the workers of a sharded harvest) name records independently.
+    """
+
+    def __init__(self, existing_names=(), packages=None, always_suffix=False):
+        self._taken = set(existing_names)
+        self._packages = dict(packages or {})
+        self.always_suffix = always_suffix
+        self._allocated = {}   # source id -> allocated name
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_client(cls, c, always_suffix=False):
+        """ Create an allocator indexing the packages already in the Data Catalog. """
+        packages = load_harvested_packages(c)
+        return cls(load_package_names(c) | {name for _, name in packages.values()}, packages, always_suffix)
+
+    def package_of(self, source_id):
+        """ Return the (id, name) of the package of a record in the catalog, or None. """
+        return self._packages.get(str(source_id))
+
+    def __contains__(self, name):
+        return name in self._taken
+
+    def allocate(self, base_name: str, source_id: str) -> str:
+        """ Reserve a unique package name for the given record.
+
+        Args:
+            base_name (string): The preferred name (typically the slug of the title).
+            source_id (string): The identifier of the record in the harvested catalog.
+
+        Returns:
+            The reserved name; repeated calls for the same source id return the same name,
+            and a record already in the catalog is given the name of its package.
+        """
+        with self._lock:
+            if source_id in self._allocated:
+                return self._allocated[source_id]
+            if str(source_id) in self._packages:
+                name = self._packages[str(source_id)][1]
+                self._allocated[source_id] = name
+                return name
+
+            base_name = base_name[:MAX_NAME_LENGTH].strip('-')
+            name = base_name
+            if self.always_suffix or name in self._taken:
+                digest = stable_hash(source_id)
+                length = SUFFIX_LENGTH
+                while True:
+                    suffix = '-' + digest[:length]
+                    name = base_name[:MAX_NAME_LENGTH - len(suffix)].strip('-') + suffix
+                    if name not in self._taken or length >= len(digest):
+                        break
+                    length += 4
+                if name in self._taken:
+                    raise ValueError(f'Could not allocate a unique package name for {source_id}')
+
+            self._taken.add(name)
+            self._allocated[source_id] = name
+            return name
+
+    def release(self, source_id: str):
+        """ Drop the reservation of a record whose package could not be created. """
+        with self._lock:
+            name = self._allocated.pop(source_id, None)
+            if name is not None and str(source_id) not in self._packages:
+                self._taken.discard(name)
@@ -0,0 +1,176 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+##############################################################################
+# Opt-in profiling of harvester runs.
+#
+# Every harvester accepts '--profile sample' or '--profile cprofile'. The run
+# is split in stages (e.g., 'load', 'index', 'ingest'), and for every stage
+# the profiler writes into the profile directory:
+#
+#   <run>-<stage>.collapsed   Collapsed stacks (sample mode), to be rendered with
+#                             flamegraph.pl or speedscope
+#   <run>-<stage>.prof        Raw cProfile statistics (cprofile mode)
+#   <run>-<stage>.top.txt     The top-N hot functions
+#
+# cProfile only sees the thread enabling it, so in cprofile mode every thread
+# started during a stage (e.g., the workers of an executor) gets a profiler of
+# its own, and the statistics of all of them are merged. Threads started before
+# the stage are not profiled; sample mode sees all threads.
+##############################################################################
+
+PROFILE_MODES = ('sample', 'cprofile')
+
+
+def add_profile_arguments(parser):
+    """ Add the profiling options to the argument parser of a harvester. """
+    parser.add_argument('--profile', choices=PROFILE_MODES, default=None,
+                        help='Profile the run with a sampling profiler or cProfile')
+    parser.add_argument('--profile-dir', default='./profiles',
+                        help='Directory receiving the profiling output')
+    parser.add_argument('--profile-top', type=int, default=30,
+                        help='Number of hot functions listed per stage')
+    parser.add_argument('--profile-interval', type=float, default=0.005,
+                        help='Sampling interval in seconds (sample mode)')
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class _Sampler(threading.Thread):
+    """ Periodically record the stacks of all other threads of the process. """
+
+    def __init__(self, interval):
+        super().__init__(name='profiling-sampler', daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class _ThreadProfiles:
+    """ A thread profiling hook (see threading.setprofile) giving every new thread its own cProfile. """
+
+    def __init__(self):
+        self.profiles = []
+        self._lock = threading.Lock()
+
+    def __call__(self, frame, event, arg):
+        # Called on the first event of a new thread; the profiler enabled replaces the hook
+        profile = cProfile.Profile()
+        with self._lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+
+class Profiler:
+    """ Profile the stages of a harvester run; a profiler without a mode does nothing.
+
+    Args:
+        run (string): Name of the run, used as a prefix of the output files.
+        mode (string): One of 'sample', 'cprofile', or None to disable profiling.
+        out_dir (string): Directory receiving the output.
+        top (int): Number of hot functions listed per stage.
+        interval (float): Sampling interval in seconds.
+    """
+
+    def __init__(self, run, mode=None, out_dir='./profiles', top=30, interval=0.005):
+        if mode not in (None,) + PROFILE_MODES:
+            raise ValueError(f'Unknown profiling mode: {mode}')
+        self.run = run
+        self.mode = mode
+        self.out_dir = out_dir
+        self.top = top
+        self.interval = interval
+
+    @classmethod
+    def from_args(cls, run, args):
+        """ Create the profiler requested on the command line (see add_profile_arguments). """
+        return cls(run, args.profile, args.profile_dir, args.profile_top, args.profile_interval)
+
+    @contextmanager
+    def stage(self, name):
+        """ Profile the enclosed block as the given stage of the run. """
+        if self.mode is None:
+            yield
+            return
+
+        os.makedirs(self.out_dir, exist_ok=True)
+        prefix = os.path.join(self.out_dir, f'{self.run}-{name}')
+        start = time.perf_counter()
+        if self.mode == 'cprofile':
+            profile = cProfile.Profile()
+            threads = _ThreadProfiles()
+            previous = threading.getprofile()
+            threading.setprofile(threads)
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                threading.setprofile(previous)
+                self._write_cprofile(prefix, name, [profile] + threads.profiles, time.perf_counter() - start)
+        else:
+            sampler = _Sampler(self.interval)
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                self._write_samples(prefix, name, sampler.stacks, time.perf_counter() - start)
+
+    def _write_cprofile(self, prefix, name, profiles, elapsed):
+        out = io.StringIO()
+        stats = pstats.Stats(*profiles, stream=out)
+        stats.dump_stats(prefix + '.prof')
+        out.write(f'Stage {name}: {elapsed:.3f}s, {len(profiles)} threads profiled\n')
+        stats.sort_stats('tottime').print_stats(self.top)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        with open(prefix + '.top.txt', 'w') as f:
+            f.write(out.getvalue())
+        print(f'[profile] Stage {name} took {elapsed:.3f}s; statistics written to {prefix}.prof')
+
+    def _write_samples(self, prefix, name, stacks, elapsed):
+        with open(prefix + '.collapsed', 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+        # Self samples count the innermost frame only; total samples count every frame once per stack
+        own, total = Counter(), Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        samples = sum(stacks.values()) or 1
+
+        with open(prefix + '.top.txt', 'w') as f:
+            f.write(f'Stage {name}: {elapsed:.3f}s, {samples} samples every {self.interval * 1000:.1f}ms\n\n')
+            f.write(f'{"self %":>8} {"total %":>8}  function\n')
+            for frame, count in own.most_common(self.top):
+                f.write(f'{100 * count / samples:8.1f} {100 * total[frame] / samples:8.1f}  {frame}\n')
+        print(f'[profile] Stage {name} took {elapsed:.3f}s; flamegraph stacks written to {prefix}.collapsed')
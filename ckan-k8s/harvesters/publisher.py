@@ -0,0 +1,396 @@
+import glob
+import json
+import os
+import threading
+from collections import Counter
+from functools import cached_property
+
+from dead_letters import DeadLetterStore
+from name_allocator import SOURCE_ID_FIELD, NameAllocator
+from spec_mirror import SpecMirror
+
+##############################################################################
+# Publishing of harvested records into the Data Catalog (CKAN).
+#
+# The publisher remembers a normalized snapshot of what it last sent for every
+# harvested record. When a record is harvested again, only the fields that
+# differ from the snapshot are sent as a patch; unchanged records cost nothing.
+##############################################################################
+
+# Directory holding the state kept by the harvesters between runs
+STATE_DIR = os.getenv('HARVEST_STATE_DIR', './.harvest')
+
+# Properties holding unordered collections; their order is irrelevant to the diff
+UNORDERED_FIELDS = {'tags', 'theme', 'language', 'custom_tags'}
+
+
+def state_path(filename):
+    """ Return the path of a file kept in the harvester state directory. """
+    return os.path.join(STATE_DIR, filename)
+
+
+def normalize_spec(spec):
+    """ Bring a dataset or resource specification into a canonical, JSON-compatible form.
+
+    Args:
+        spec (dict): The properties as passed to the STELAR client.
+
+    Returns:
+        A new dictionary without empty (None) values and without the organization
+        (which is resolved at publishing time), with unordered fields sorted.
+    """
+    normalized = {}
+    for key, value in spec.items():
+        if value is None or key == 'organization':
+            continue
+        value = json.loads(json.dumps(value, sort_keys=True, default=str))
+        if key in UNORDERED_FIELDS and isinstance(value, list):
+            value = sorted(value, key=str)
+        normalized[key] = value
+    return normalized
+
+
+def diff_specs(old, new):
+    """ Compute the field-level difference between two normalized specifications.
+
+    Args:
+        old (dict): The specification last sent.
+        new (dict): The specification to be sent now.
+
+    Returns:
+        A dictionary with the changed or added fields and their new values. Fields
+        removed since the last time map to Ellipsis, which the STELAR client treats
+        as a request to delete the property.
+    """
+    changes = {key: value for key, value in new.items() if old.get(key) != value}
+    changes.update({key: ... for key in old if key not in new})
+    return changes
+
+
+def entity_value(proxy_type, entity, key):
+    """ Return a property of an entity of the STELAR API, wherever the client puts it. """
+    prop = proxy_type.proxy_schema.properties.get(key)
+    if prop is not None:
+        return entity.get(prop.entity_name)
+    # Properties unknown to the client are extras: kept apart in packages, top-level in resources
+    return (entity.get('extras') or {}).get(key, entity.get(key))
+
+
+def catalog_baseline(c, proxy, spec):
+    """ Rebuild what was last sent for a specification, from the entity in the Data Catalog.
+
+    Properties are compared in the form the client sends them, since the values read
+    from a proxy are not in the form of the specification (e.g., a license entity for
+    a license id, a tuple for a list).
+
+    Args:
+        c (Client): The STELAR client.
+        proxy (Proxy): The dataset or resource in the catalog.
+        spec (dict): The properties to be sent now.
+
+    Returns:
+        A normalized specification: the properties equal in the catalog keep their value,
+        those that differ take the value in the catalog, and those missing are left out.
+    """
+    proxy_type = type(proxy)
+    actual = proxy.proxy_to_entity()
+    wanted = proxy_type.new(c, autosync=False, **spec).proxy_to_entity()
+    baseline = {}
+    for key, value in normalize_spec(spec).items():
+        current = normalize_spec({key: entity_value(proxy_type, actual, key)})
+        if current == normalize_spec({key: entity_value(proxy_type, wanted, key)}):
+            baseline[key] = value
+        elif current:
+            baseline[key] = current[key]
+    return baseline
+
+
+class SnapshotStore:
+    """ Persistent store of the last published snapshot of every harvested record.
+
+    Snapshots are appended to a JSON-lines file as they are produced (the last
+    line of a record wins), so an interrupted harvest loses nothing.
+
+    Args:
+        path (string): The file receiving the snapshots.
+        also_read (list): Other snapshot files of the same harvest (e.g., of other shards)
+            to load at start; the most recently modified file wins.
+        keep (callable): Optional predicate on source ids, selecting the snapshots to load.
+    """
+
+    def __init__(self, path, also_read=(), keep=None):
+        self.path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+        paths = {p for p in also_read if os.path.exists(p)}
+        if os.path.exists(path):
+            paths.add(path)
+        for p in sorted(paths, key=os.path.getmtime):
+            with open(p, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        if keep is None or keep(entry['source_id']):
+                            self._entries[entry['source_id']] = entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, source_id):
+        return self._entries.get(source_id)
+
+    def put(self, source_id, **entry):
+        entry['source_id'] = source_id
+        with self._lock:
+            self._entries[source_id] = entry
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    def compact(self):
+        """ Rewrite the file keeping only the latest snapshot of each record. """
+        with self._lock:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                for entry in self._entries.values():
+                    f.write(json.dumps(entry, sort_keys=True) + '\n')
+            os.replace(tmp, self.path)
+
+
+class Publisher:
+    """ Create or incrementally update datasets (and their specification resource) in the Data Catalog.
+
+    Args:
+        c (Client): The STELAR client.
+        names (NameAllocator): Optional allocator resolving package name collisions.
+        snapshots (SnapshotStore): Optional store of published snapshots; without it,
+            every record is created anew.
+        dead_letters (DeadLetterStore): Optional store collecting the records that failed.
+        organization (string): The name of the organization owning the datasets.
+        mirror (SpecMirror): Optional mirror copying the documents of the resources into MinIO.
+    """
+
+    def __init__(self, c, names: NameAllocator = None, snapshots: SnapshotStore = None,
+                 dead_letters: DeadLetterStore = None, organization='stelar-klms', mirror=None):
+        self.client = c
+        self.names = names
+        self.snapshots = snapshots
+        self.dead_letters = dead_letters
+        self.mirror = mirror
+        self.organization_name = organization
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_harvester(cls, c, harvester, shard=None, mirror_bucket=None):
+        """ Create the publisher of a harvester, with its state kept in the harvester state directory.
+
+        Args:
+            c (Client): The STELAR client.
+            harvester (string): A short key of the harvester (e.g., 'gee'), prefixing its state files.
+            shard (Shard): The shard processed, if the harvest is split among several workers
+                (see sharding.py); each shard keeps its own state files.
+            mirror_bucket (string): If given, the documents of the resources are mirrored
+                into this MinIO bucket (see spec_mirror.py).
+        """
+        sharded = shard is not None and shard.sharded
+        key = shard.state_key(harvester) if sharded else harvester
+        # The snapshots of the records processed now may have been written by another
+        # worker, or by a run with a different number of shards (or none)
+        snapshots = SnapshotStore(
+            state_path(f'{key}_snapshots.jsonl'),
+            also_read=[state_path(f'{harvester}_snapshots.jsonl')]
+                      + glob.glob(state_path(f'{harvester}-*of*_snapshots.jsonl')),
+            keep=shard.owns if sharded else None,
+        )
+        return cls(
+            c,
+            # The workers of a sharded harvest allocate names independently, so new names
+            # are always made unique by the source id
+            names=NameAllocator.from_client(c, always_suffix=sharded),
+            snapshots=snapshots,
+            dead_letters=DeadLetterStore(state_path(f'{key}_dead_letters.db')),
+            mirror=SpecMirror.from_client(c, mirror_bucket) if mirror_bucket else None,
+        )
+
+    @cached_property
+    def organization(self):
+        # Resolved once per run, instead of once per record
+        return self.client.organizations[self.organization_name]
+
+    def count(self, outcome):
+        """ Count the outcome ('created', 'updated', 'unchanged', 'failed') of a record. """
+        with self._lock:
+            self.stats[outcome] += 1
+
+    def record_failure(self, source_id, error, record=None, spec=None, resource=None):
+        """ Keep a failed record in the dead-letter store, if there is one. """
+        if self.dead_letters is not None:
+            self.dead_letters.add(source_id, error, record=record, spec=spec, resource=resource)
+
+    def publish(self, source_id, spec, resource=None, record=None):
+        """ Publish a harvested record, sending only what changed since the last time.
+
+        Args:
+            source_id (string): The identifier of the record in the harvested catalog; it is
+                recorded in the dataset, under SOURCE_ID_FIELD.
+            spec (dict): The dataset properties; 'name' is the preferred package name.
+            resource (dict): Optional properties of a resource to attach to the dataset.
+            record (dict): The original record, kept in the dead-letter store on failure.
+
+        Returns:
+            A pair with the identifiers of the dataset and the resource (or None).
+
+        Raises:
+            Any error raised by the STELAR client; the outcome is counted as 'failed'
+            and the record is kept in the dead-letter store.
+        """
+        return run_plan(self.plan(source_id, spec, resource, record), self.perform)
+
+    def plan(self, source_id, spec, resource=None, record=None):
+        """ Plan the publication of a harvested record, independently of how requests are sent.
+
+        A generator yielding the operations on the Data Catalog (or MinIO), as tuples
+        (operation, *arguments), and receiving their results; its value is the pair of
+        identifiers returned by publish. The Publisher performs the operations with the
+        blocking client (see perform), the AsyncPublisher with its own transport.
+
+        Operations:
+            ('mirror', resource): Mirror the document of a resource; returns the resource.
+            ('recover', source_id, spec, resource): Returns the recovered snapshot, or None.
+            ('create', spec): Create a dataset; returns its id.
+            ('update', pid, old, new): Patch a dataset from the old to the new normalized spec.
+            ('add_resource', pid, resource): Returns the id of the new resource.
+            ('update_resource', pid, rid, old, resource): Update a resource from its normalized snapshot.
+        """
+        spec = dict(spec, **{SOURCE_ID_FIELD: str(source_id)})
+        try:
+            if resource and self.mirror is not None:
+                resource = yield ('mirror', resource)
+            previous = self.snapshots.get(source_id) if self.snapshots is not None else None
+            if previous is None:
+                previous = yield ('recover', source_id, spec, resource)
+            if previous is None:
+                pid, name = yield from self._plan_create(source_id, spec)
+                rid, sent_resource = None, None
+            else:
+                pid, name = yield from self._plan_update(previous, spec)
+                rid, sent_resource = previous['resource_id'], previous['resource']
+            # Remember the dataset before the resource stage, so it is not re-created if that fails
+            self.remember(source_id, pid, rid, name, spec, sent_resource)
+
+            if resource:
+                if rid is None:
+                    rid = yield ('add_resource', pid, resource)
+                elif diff_specs(sent_resource or {}, normalize_spec(resource)):
+                    yield ('update_resource', pid, rid, sent_resource or {}, resource)
+                self.remember(source_id, pid, rid, name, spec, normalize_spec(resource))
+        except Exception as e:
+            self.count('failed')
+            self.record_failure(source_id, e, record=record, spec=spec, resource=resource)
+            raise
+        if self.dead_letters is not None:
+            self.dead_letters.discard(source_id)
+        return pid, rid
+
+    def _plan_create(self, source_id, spec):
+        name = spec['name']
+        if self.names is not None:
+            name = self.names.allocate(name, source_id)
+        try:
+            pid = yield ('create', dict(spec, name=name))
+        except Exception:
+            if self.names is not None:
+                self.names.release(source_id)
+            raise
+        self.count('created')
+        return pid, name
+
+    def _plan_update(self, previous, spec):
+        pid, name = previous['id'], previous['name']
+
+        # The package keeps the name it was created with
+        new = normalize_spec(dict(spec, name=name))
+        if diff_specs(previous['spec'], new):
+            yield ('update', pid, previous['spec'], new)
+            self.count('updated')
+        else:
+            self.count('unchanged')
+        return pid, name
+
+    def perform(self, operation, *args):
+        """ Perform an operation of a publication plan (see plan) with the blocking client. """
+        return getattr(self, f'_{operation}')(*args)
+
+    def recover_snapshot(self, source_id, spec, resource=None):
+        """ Rebuild the lost snapshot of a record from its package in the Data Catalog.
+
+        The snapshot holds the values in the catalog of the fields of the specification
+        (and of the resource with the same URL or name), so that only those differing
+        are patched (see catalog_baseline).
+
+        Returns:
+            The rebuilt snapshot, or None if the record has no package in the catalog.
+        """
+        package = self.names.package_of(source_id) if self.names is not None else None
+        if package is None:
+            return None
+        pid, name = package
+        d = self.client.datasets.get(pid)
+        if d is None:
+            return None
+        rid, sent_resource = None, None
+        if resource:
+            for r in d.resources:
+                if r.url == resource.get('url') or r.name == resource.get('name'):
+                    rid = str(r.id)
+                    sent_resource = catalog_baseline(self.client, r, resource)
+                    break
+        return {'source_id': source_id, 'id': pid, 'resource_id': rid, 'name': name,
+                'spec': catalog_baseline(self.client, d, dict(spec, name=name)), 'resource': sent_resource}
+
+    def remember(self, source_id, pid, rid, name, spec, resource):
+        """ Store the snapshot of what was sent for a record, if there is a snapshot store. """
+        if self.snapshots is not None:
+            self.snapshots.put(
+                source_id, id=pid, resource_id=rid, name=name,
+                spec=normalize_spec(dict(spec, name=name)), resource=resource,
+            )
+
+    def _mirror(self, resource):
+        return self.mirror.mirror_resource(resource)
+
+    def _recover(self, source_id, spec, resource):
+        return self.recover_snapshot(source_id, spec, resource)
+
+    def _create(self, spec):
+        return str(self.client.datasets.create(**spec, organization=self.organization).id)
+
+    def _update(self, pid, old, new):
+        self.client.datasets.get(pid).update(**diff_specs(old, new))
+
+    def _add_resource(self, pid, resource):
+        return str(self.client.datasets.get(pid).add_resource(**resource).id)
+
+    def _update_resource(self, pid, rid, old, resource):
+        self.client.resources.get(rid).update(**diff_specs(old, normalize_spec(resource)))
+
+
+def run_plan(steps, perform):
+    """ Run a publication plan (see Publisher.plan), performing its operations with a function.
+
+    The errors of the operations are raised inside the plan, which may handle them.
+
+    Returns:
+        The value of the plan.
+    """
+    result, error = None, None
+    while True:
+        try:
+            operation = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as done:
+            return done.value
+        try:
+            result, error = perform(*operation), None
+        except Exception as e:
+            result, error = None, e
@@ -0,0 +1,194 @@
+import argparse
+import glob
+import json
+import os
+import time
+
+from name_allocator import stable_hash
+
+##############################################################################
+# Sharded harvesting, e.g., across the pods of a Kubernetes indexed Job.
+#
+# Every worker processes only the records whose source id hashes to its own
+# shard, so N workers split a catalog without any coordination. The shard is
+# taken from JOB_COMPLETION_INDEX (set by Kubernetes for indexed Jobs) and the
+# number of shards from HARVEST_SHARDS, unless given on the command line.
+#
+# Each worker keeps its state (snapshots, dead letters) in its own files and
+# writes a run report into the (shared) harvester state directory. Once all
+# workers are done, the reports are combined with:
+#
+#   python sharding.py merge gee
+##############################################################################
+
+
+def add_shard_arguments(parser):
+    """ Add the sharding options to the argument parser of a harvester. """
+    parser.add_argument('--shards', type=int, default=int(os.getenv('HARVEST_SHARDS', '1')),
+                        help='Number of workers splitting the harvest (default: $HARVEST_SHARDS or 1)')
+    parser.add_argument('--shard-index', type=int, default=int(os.getenv('JOB_COMPLETION_INDEX', '0')),
+                        help='The shard processed by this worker (default: $JOB_COMPLETION_INDEX or 0)')
+    parser.add_argument('--run-id', default=os.getenv('HARVEST_RUN_ID'),
+                        help='Identifier shared by the workers of a run, e.g., the Job name (default: $HARVEST_RUN_ID)')
+
+
+def shard_of(source_id, shards):
+    """ Return the shard of a record, which is the same on every host and in every run.
+
+    Args:
+        source_id (string): The identifier of the record in the harvested catalog.
+        shards (int): The number of shards.
+    """
+    return int(stable_hash(source_id)[:16], 16) % shards
+
+
+class Shard:
+    """ The part of a harvest processed by one worker.
+
+    Args:
+        index (int): The shard of this worker, from 0 to count-1.
+        count (int): The number of shards; a single shard processes every record.
+        run_id (string): Optional identifier shared by the workers of the same run.
+    """
+
+    def __init__(self, index=0, count=1, run_id=None):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f'Invalid shard {index} of {count}')
+        self.index = index
+        self.count = count
+        self.run_id = run_id
+
+    @classmethod
+    def from_args(cls, args):
+        """ Create the shard requested on the command line (see add_shard_arguments). """
+        return cls(args.shard_index, args.shards, args.run_id)
+
+    def __str__(self):
+        return f'{self.index}of{self.count}'
+
+    @property
+    def sharded(self):
+        return self.count > 1
+
+    def owns(self, source_id):
+        """ Check whether the given record is processed by this shard. """
+        return not self.sharded or shard_of(source_id, self.count) == self.index
+
+    def state_key(self, harvester):
+        """ Return the prefix of the state files of this shard (see Publisher.for_harvester). """
+        return f'{harvester}-{self}' if self.sharded else harvester
+
+
+class RunReport:
+    """ Outcome of the run of a harvester on one shard.
+
+    Args:
+        harvester (string): The harvester key (e.g., 'gee').
+        shard (Shard): The shard processed.
+    """
+
+    def __init__(self, harvester, shard: Shard):
+        self.harvester = harvester
+        self.shard = shard
+        self.started = time.time()
+        self.skipped = 0
+
+    def skip(self):
+        """ Count a record left to another shard. """
+        self.skipped += 1
+
+    def write(self, publisher, directory):
+        """ Write the report, with the outcomes counted by the publisher, into the given directory.
+
+        Returns:
+            The path of the report.
+        """
+        finished = time.time()
+        report = {
+            'harvester': self.harvester,
+            'run_id': self.shard.run_id,
+            'shard': self.shard.index,
+            'shards': self.shard.count,
+            'started': self.started,
+            'finished': finished,
+            'elapsed': finished - self.started,
+            'skipped': self.skipped,
+            'stats': dict(publisher.stats),
+            'dead_letters': len(publisher.dead_letters) if publisher.dead_letters is not None else 0,
+        }
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{self.harvester}-{self.shard}_report.json')
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        return path
+
+
+def merge_reports(harvester, directory):
+    """ Combine the run reports of all the shards of a harvester.
+
+    Args:
+        harvester (string): The harvester key (e.g., 'gee').
+        directory (string): The directory holding the reports of the shards.
+
+    Returns:
+        A dictionary with the totals over all shards, listing any shard without a report.
+    """
+    reports = []
+    for path in sorted(glob.glob(os.path.join(directory, f'{harvester}-*_report.json'))):
+        with open(path, 'r') as f:
+            report = json.load(f)
+        if report.get('harvester') == harvester:
+            reports.append(report)
+    if not reports:
+        raise ValueError(f'No run reports of {harvester} found in {directory}')
+
+    # Only the reports of the latest run; earlier runs may have used another number of shards
+    latest = max(reports, key=lambda r: r['finished'])
+    shards = latest['shards']
+    reports = [r for r in reports if r['shards'] == shards and r.get('run_id') == latest.get('run_id')]
+
+    stats = {}
+    for report in reports:
+        for outcome, count in report['stats'].items():
+            stats[outcome] = stats.get(outcome, 0) + count
+    started = min(r['started'] for r in reports)
+    finished = max(r['finished'] for r in reports)
+    records = sum(stats.values())
+    return {
+        'harvester': harvester,
+        'run_id': latest.get('run_id'),
+        'shards': shards,
+        'missing_shards': sorted(set(range(shards)) - {r['shard'] for r in reports}),
+        'started': started,
+        'finished': finished,
+        'elapsed': finished - started,
+        'records': records,
+        'records_per_second': records / (finished - started) if finished > started else None,
+        'stats': stats,
+        'dead_letters': sum(r['dead_letters'] for r in reports),
+        'slowest_shard': max(reports, key=lambda r: r['elapsed'])['shard'],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Combine the run reports of a sharded harvest.')
+    parser.add_argument('command', choices=['merge'])
+    parser.add_argument('harvester', help="The harvester key (e.g., 'gee')")
+    parser.add_argument('--report-dir', default=None, help='Directory of the reports (default: the state directory)')
+    args = parser.parse_args(argv)
+
+    from publisher import STATE_DIR
+
+    directory = args.report_dir or STATE_DIR
+    merged = merge_reports(args.harvester, directory)
+    path = os.path.join(directory, f'{args.harvester}_report.json')
+    with open(path, 'w') as f:
+        json.dump(merged, f, indent=2)
+    print(json.dumps(merged, indent=2))
+    if merged['missing_shards']:
+        print(f"Shards without a report: {merged['missing_shards']}")
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
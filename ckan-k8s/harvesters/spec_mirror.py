@@ -0,0 +1,113 @@
+import hashlib
+import os
+import tempfile
+import threading
+import urllib.request
+
+##############################################################################
+# Mirroring of harvested specification documents into the platform MinIO.
+#
+# The resources of the harvested datasets point at specification documents
+# (e.g., STAC collection JSON) on remote servers. When mirroring is enabled,
+# every document is streamed into a MinIO bucket under the hash of its content,
+# so identical documents are stored once, and the resource points at the copy
+# (s3://<bucket>/<prefix>/<sha256>.json) that tasks read at in-cluster speed.
+##############################################################################
+
+# The bucket receiving the mirrored documents
+MIRROR_BUCKET = os.getenv('HARVEST_MIRROR_BUCKET', 'harvest-specs')
+
+# Documents are streamed through memory up to this size, and through a temporary file beyond it
+SPOOL_SIZE = 4 * 1024 * 1024
+
+CHUNK_SIZE = 64 * 1024
+
+
+class SpecMirror:
+    """ Content-addressed copy of remote documents in a MinIO bucket.
+
+    Args:
+        s3 (Minio): The MinIO client, e.g., the `s3` attribute of the STELAR client.
+        bucket (string): The bucket receiving the documents; it is created if missing.
+        prefix (string): The prefix of the object names.
+        timeout (float): Timeout in seconds of downloading a document.
+    """
+
+    def __init__(self, s3, bucket=MIRROR_BUCKET, prefix='specs', timeout=30):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.timeout = timeout
+        self._mirrored = {}   # url -> s3 url, for documents referenced more than once in a run
+        self._lock = threading.Lock()
+        if not s3.bucket_exists(bucket):
+            s3.make_bucket(bucket)
+
+    @classmethod
+    def from_client(cls, c, bucket=MIRROR_BUCKET):
+        """ Create a mirror into the MinIO of the platform, with the credentials of the STELAR client. """
+        return cls(c.s3, bucket)
+
+    def object_name(self, digest, url):
+        extension = os.path.splitext(url.split('?')[0])[1] or '.json'
+        return f'{self.prefix}/{digest[:2]}/{digest}{extension}'
+
+    def mirror(self, url):
+        """ Copy the document at the given URL into the bucket, unless its content is already there.
+
+        Args:
+            url (string): The URL of the document.
+
+        Returns:
+            The s3:// URL of the copy.
+        """
+        with self._lock:
+            if url in self._mirrored:
+                return self._mirrored[url]
+
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as buffer:
+            # Hash while streaming; the name of the object is only known once the whole document is read
+            digest = hashlib.sha256()
+            with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                content_type = response.headers.get_content_type()
+                while chunk := response.read(CHUNK_SIZE):
+                    digest.update(chunk)
+                    buffer.write(chunk)
+            length = buffer.tell()
+            buffer.seek(0)
+
+            name = self.object_name(digest.hexdigest(), url)
+            if not self._exists(name):
+                self.s3.put_object(self.bucket, name, buffer, length, content_type=content_type,
+                                   metadata={'source-url': url[:1024]})
+
+        s3_url = f's3://{self.bucket}/{name}'
+        with self._lock:
+            self._mirrored[url] = s3_url
+        return s3_url
+
+    def mirror_resource(self, resource):
+        """ Return the properties of a resource, with its remote URL replaced by the mirrored copy.
+
+        The remote URL is kept as 'source_url'. If the document cannot be copied, the
+        resource is returned unchanged, so a harvest does not fail because of the mirror.
+        """
+        url = resource.get('url')
+        if not url or not url.startswith(('http://', 'https://')):
+            return resource
+        try:
+            return dict(resource, url=self.mirror(url), source_url=url)
+        except Exception as e:
+            print(f'Could not mirror {url}, keeping the remote URL: {e}')
+            return resource
+
+    def _exists(self, name):
+        from minio.error import S3Error
+
+        try:
+            self.s3.stat_object(self.bucket, name)
+            return True
+        except S3Error as e:
+            if e.code in ('NoSuchKey', 'NoSuchObject'):
+                return False
+            raise
@@ -0,0 +1,375 @@
+import argparse
+import json
+import math
+import random
+import re
+import signal
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+##############################################################################
+# Local stand-in of the STELAR API, for load testing the harvesters.
+#
+# Implements the subset of the API used by the harvesters (authentication,
+# organization lookup, dataset create/show/patch/list/search, resource
+# create/update), keeping everything in memory. Latency, error and throttling
+# behaviour is configurable, and the timing of every request is recorded:
+#
+#   python stub_api.py --port 8088 --latency lognormal:40,0.5 --throttle-rate 0.02
+#
+# Point a client at it with Client(base_url='http://localhost:8088', username='u', password='p').
+# The statistics are served at /__stats, and printed when the server stops.
+##############################################################################
+
+# Route patterns, relative to the '/stelar' prefix of the API
+ROUTES = [
+    ('POST', re.compile(r'^/api/v1/users/token$'), 'token'),
+    ('GET', re.compile(r'^/help$'), 'help'),
+    ('GET', re.compile(r'^/api/v2/organization/(?P<id>[^/]+)$'), 'organization_show'),
+    ('GET', re.compile(r'^/api/v2/datasets$'), 'dataset_list'),
+    ('POST', re.compile(r'^/api/v2/search/datasets$'), 'dataset_search'),
+    ('POST', re.compile(r'^/api/v2/dataset$'), 'dataset_create'),
+    ('GET', re.compile(r'^/api/v2/dataset/(?P<id>[^/]+)$'), 'dataset_show'),
+    ('PATCH', re.compile(r'^/api/v2/dataset/(?P<id>[^/]+)$'), 'dataset_patch'),
+    ('POST', re.compile(r'^/api/v2/resource$'), 'resource_create'),
+    ('GET', re.compile(r'^/api/v2/resource/(?P<id>[^/]+)$'), 'resource_show'),
+    ('PATCH', re.compile(r'^/api/v2/resource/(?P<id>[^/]+)$'), 'resource_patch'),
+    ('PUT', re.compile(r'^/api/v2/resource/(?P<id>[^/]+)$'), 'resource_update'),
+]
+
+# The fields of the entities returned by the API, with their value when not given
+DATASET_FIELDS = {
+    'title': None, 'url': None, 'version': None, 'spatial': None, 'creator_user_id': None,
+    'private': False, 'groups': [], 'notes': None, 'author': None, 'author_email': None,
+    'maintainer': None, 'maintainer_email': None, 'resources': [], 'relationships_as_subject': [],
+    'relationships_as_object': [], 'state': 'active', 'type': 'dataset', 'extras': [],
+    'tags': [], 'license_id': None,
+}
+RESOURCE_FIELDS = {
+    'url': None, 'format': None, 'description': None, 'hash': None, 'name': None,
+    'resource_type': None, 'mimetype': None, 'mimetype_inner': None, 'cache_url': None,
+    'size': None, 'last_modified': None, 'cache_last_updated': None, 'url_type': None,
+    'state': 'active',
+}
+
+
+def parse_latency(spec):
+    """ Parse a latency distribution given as 'kind:params' (milliseconds).
+
+    Supported kinds: 'fixed:MS', 'uniform:LOW,HIGH', 'normal:MEAN,SD' and
+    'lognormal:MEDIAN,SIGMA'.
+
+    Returns:
+        A function returning a random delay in seconds.
+    """
+    kind, _, params = spec.partition(':')
+    values = [float(v) for v in params.split(',')] if params else []
+    if kind == 'fixed':
+        return lambda: values[0] / 1000
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1]) / 1000
+    if kind == 'normal':
+        return lambda: max(0.0, random.gauss(values[0], values[1])) / 1000
+    if kind == 'lognormal':
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1]) / 1000
+    raise ValueError(f'Unknown latency distribution: {spec}')
+
+
+def _field(entity, field):
+    if field.startswith('extras_'):
+        return (entity.get('extras') or {}).get(field[len('extras_'):])
+    return entity.get(field)
+
+
+def _matches(actual, value):
+    if value == '*':
+        return actual is not None
+    return actual is not None and str(actual) == value.strip('"')
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class StubCatalog:
+    """ In-memory state of the stand-in, with request statistics. """
+
+    def __init__(self, organization='stelar-klms'):
+        self.lock = threading.Lock()
+        self.organization = {
+            'id': str(uuid.uuid4()), 'name': organization, 'title': organization,
+            'description': '', 'image_url': '', 'created': now(), 'state': 'active',
+            'approval_status': 'approved', 'is_organization': True, 'type': 'organization',
+        }
+        self.datasets = {}       # id -> entity
+        self.names = {}          # name -> id
+        self.resources = {}      # id -> entity
+        self.timings = defaultdict(list)   # route -> service times (ms)
+        self.statuses = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def record(self, route, status, elapsed):
+        with self.lock:
+            self.timings[route].append(elapsed * 1000)
+            self.statuses[status] += 1
+
+    def stats(self):
+        with self.lock:
+            routes = {}
+            for route, times in self.timings.items():
+                times = sorted(times)
+                routes[route] = {
+                    'count': len(times),
+                    'p50_ms': round(times[len(times) // 2], 2),
+                    'p95_ms': round(times[int(len(times) * 0.95)], 2),
+                    'p99_ms': round(times[int(len(times) * 0.99)], 2),
+                    'max_ms': round(times[-1], 2),
+                }
+            return {
+                'routes': routes,
+                'statuses': {str(k): v for k, v in self.statuses.items()},
+                'max_in_flight': self.max_in_flight,
+                'datasets': len(self.datasets),
+                'resources': len(self.resources),
+            }
+
+    # The API operations; each returns (status, result or error)
+
+    def token(self, body, query, **kw):
+        return 200, {
+            'token': uuid.uuid4().hex, 'refresh_token': uuid.uuid4().hex,
+            'expires_in': 3600, 'refresh_expires_in': 7200, 'token_type': 'Bearer',
+        }
+
+    def help(self, body, query, **kw):
+        # The client reads the S3 endpoint of the installation from here
+        return 200, {'name': 'STELAR API stand-in', 'version': 'stub', 's3_api': 'http://localhost:9000'}
+
+    def organization_show(self, body, query, id):
+        if id in (self.organization['id'], self.organization['name']):
+            return 200, self.organization
+        return 404, {'message': 'Not found', 'detail': {'entity': 'organization'}}
+
+    def dataset_list(self, body, query, **kw):
+        limit = int(query.get('limit', ['1000'])[0] or 1000)
+        offset = int(query.get('offset', ['0'])[0] or 0)
+        with self.lock:
+            names = sorted(self.names)
+        return 200, names[offset:offset + limit]
+
+    def dataset_search(self, body, query, **kw):
+        # A plain substring match of the query on names and titles, filtered by
+        # field:"value" or field:* queries (extras_<key> matching an extra property)
+        terms = [t.lower() for t in (body.get('q') or '').split() if t != '*:*']
+        filters = [f.split(':', 1) for f in body.get('fq') or []]
+        with self.lock:
+            results = [d for d in self.datasets.values()
+                       if all(t in f"{d.get('name')} {d.get('title')}".lower() for t in terms)
+                       and all(_matches(_field(d, field), value) for field, value in filters)]
+        if body.get('fl'):
+            results = [{field: _field(d, field) for field in body['fl']} for d in results]
+        offset = int(body.get('offset') or 0)
+        limit = int(body.get('limit') or 10)
+        return 200, {'count': len(results), 'results': results[offset:offset + limit]}
+
+    def dataset_create(self, body, query, **kw):
+        with self.lock:
+            if body.get('name') in self.names:
+                return 409, {'message': 'That URL is already in use.', 'name': body.get('name')}
+            entity = json.loads(json.dumps(DATASET_FIELDS))
+            entity.update(body, id=str(uuid.uuid4()), metadata_created=now(), metadata_modified=now())
+            entity.setdefault('owner_org', self.organization['id'])
+            entity['resources'] = []
+            self.datasets[entity['id']] = entity
+            self.names[entity['name']] = entity['id']
+        return 200, entity
+
+    def _dataset(self, id):
+        return self.datasets.get(id) or self.datasets.get(self.names.get(id))
+
+    def dataset_show(self, body, query, id):
+        with self.lock:
+            entity = self._dataset(id)
+        if entity is None:
+            return 404, {'message': 'Not found', 'detail': {'entity': 'dataset'}}
+        return 200, entity
+
+    def dataset_patch(self, body, query, id):
+        with self.lock:
+            entity = self._dataset(id)
+            if entity is None:
+                return 404, {'message': 'Not found', 'detail': {'entity': 'dataset'}}
+            entity.update(body, metadata_modified=now())
+        return 200, entity
+
+    def resource_create(self, body, query, **kw):
+        with self.lock:
+            dataset = self._dataset(body.get('package_id'))
+            if dataset is None:
+                return 404, {'message': 'Not found', 'detail': {'entity': 'dataset'}}
+            entity = dict(RESOURCE_FIELDS)
+            entity.update(body, id=str(uuid.uuid4()), created=now(), metadata_modified=now(),
+                          position=len(dataset['resources']))
+            self.resources[entity['id']] = entity
+            dataset['resources'].append(entity)
+        return 200, entity
+
+    def resource_show(self, body, query, id):
+        with self.lock:
+            entity = self.resources.get(id)
+        if entity is None:
+            return 404, {'message': 'Not found', 'detail': {'entity': 'resource'}}
+        return 200, entity
+
+    def resource_patch(self, body, query, id):
+        with self.lock:
+            entity = self.resources.get(id)
+            if entity is None:
+                return 404, {'message': 'Not found', 'detail': {'entity': 'resource'}}
+            entity.update(body, metadata_modified=now())
+        return 200, entity
+
+    def resource_update(self, body, query, id):
+        with self.lock:
+            entity = self.resources.get(id)
+            if entity is None:
+                return 404, {'message': 'Not found', 'detail': {'entity': 'resource'}}
+            # A full update; the fields not given are reset
+            fixed = {key: entity[key] for key in ('id', 'package_id', 'created', 'position')}
+            entity.clear()
+            entity.update(RESOURCE_FIELDS, **body)
+            entity.update(fixed, metadata_modified=now())
+        return 200, entity
+
+
+def make_handler(catalog, latency, error_rate, throttle_rate, retry_after, max_concurrency, log):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status, payload, headers=()):
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for header in headers:
+                self.send_header(*header)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _handle(self):
+            start = time.perf_counter()
+            url = urlparse(self.path)
+            path = url.path[len('/stelar'):] if url.path.startswith('/stelar') else url.path
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+            if path == '/__stats':
+                return self._reply(200, catalog.stats())
+
+            for method, pattern, route in ROUTES:
+                match = pattern.match(path)
+                if method == self.command and match:
+                    break
+            else:
+                return self._reply(404, {'success': False, 'error': {'message': f'No route {self.command} {path}'}})
+
+            with catalog.lock:
+                catalog.in_flight += 1
+                catalog.max_in_flight = max(catalog.max_in_flight, catalog.in_flight)
+                overloaded = max_concurrency is not None and catalog.in_flight > max_concurrency
+            status = 500
+            try:
+                time.sleep(latency())
+                if overloaded or random.random() < throttle_rate:
+                    status, payload = 429, {'success': False, 'error': {'message': 'Too many requests'}}
+                    headers = [('Retry-After', str(retry_after))]
+                elif random.random() < error_rate:
+                    status, payload = 500, {'success': False, 'error': {'message': 'Injected failure'}}
+                    headers = []
+                else:
+                    status, result = getattr(catalog, route)(body, parse_qs(url.query), **match.groupdict())
+                    if status == 200:
+                        payload = {'success': True, 'result': result}
+                    else:
+                        payload = {'success': False, 'error': result}
+                    headers = []
+                self._reply(status, payload, headers)
+            finally:
+                with catalog.lock:
+                    catalog.in_flight -= 1
+                elapsed = time.perf_counter() - start
+                catalog.record(route, status, elapsed)
+                if log is not None:
+                    with catalog.lock:
+                        log.write(json.dumps({'t': time.time(), 'method': self.command, 'route': route,
+                                              'status': status, 'ms': round(elapsed * 1000, 3)}) + '\n')
+
+        do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = _handle
+
+    return Handler
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+class StubServer(ThreadingHTTPServer):
+    # The default listen backlog (5) resets the connections of a concurrent harvester
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def serve(port=8088, latency='fixed:0', error_rate=0.0, throttle_rate=0.0, retry_after=1,
+          max_concurrency=None, log_file=None, seed=None):
+    """ Run the stand-in until interrupted, then print the request statistics. """
+    if seed is not None:
+        random.seed(seed)
+    catalog = StubCatalog()
+    log = open(log_file, 'a', buffering=1) if log_file else None
+    handler = make_handler(catalog, parse_latency(latency), error_rate, throttle_rate,
+                           retry_after, max_concurrency, log)
+    server = StubServer(('0.0.0.0', port), handler)
+    # Stopped as a container or CI service, the statistics are printed as well
+    signal.signal(signal.SIGTERM, _interrupt)
+    print(f'STELAR API stand-in listening on http://localhost:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if log is not None:
+            log.close()
+        print(json.dumps(catalog.stats(), indent=2))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local stand-in of the STELAR API for harvester load testing.')
+    parser.add_argument('--port', type=int, default=8088)
+    parser.add_argument('--latency', default='fixed:0',
+                        help="Latency distribution in ms: fixed:MS, uniform:LOW,HIGH, normal:MEAN,SD, lognormal:MEDIAN,SIGMA")
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests failing with 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of requests throttled with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After (seconds) of throttled requests')
+    parser.add_argument('--max-concurrency', type=int, default=None,
+                        help='Throttle (429) requests beyond this many in flight')
+    parser.add_argument('--log', default=None, help='Append the timing of every request to this JSON-lines file')
+    parser.add_argument('--seed', type=int, default=None, help='Seed of the random generator, for reproducible runs')
+    args = parser.parse_args(argv)
+    serve(args.port, args.latency, args.error_rate, args.throttle_rate, args.retry_after,
+          args.max_concurrency, args.log, args.seed)
+
+
+if __name__ == '__main__':
+    main()
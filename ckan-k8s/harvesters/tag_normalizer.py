@@ -0,0 +1,72 @@
+from collections import namedtuple
+from functools import lru_cache
+
+##############################################################################
+# Normalization of harvested keywords into CKAN tags, shared by all harvesters.
+#
+# A keyword is a tag if the STELAR client accepts it as a tag name: ASCII
+# letters, digits, spaces, hyphens (-) and underscores (_), with a length of
+# 2 to 100 characters. Any other keyword would fail the whole record on
+# publishing, so it is kept as a custom tag instead. Keyword vocabularies
+# repeat heavily across collections, so the verdict on every distinct keyword
+# is memoized.
+##############################################################################
+
+# Verdict on a keyword: the stripped keyword, whether it is a valid CKAN tag, and the themes it maps to
+TagVerdict = namedtuple('TagVerdict', ['keyword', 'conforming', 'themes'])
+
+
+def is_valid_tag(keyword: str) -> bool:
+    """ Check whether the given (stripped) keyword is a tag name accepted by the STELAR client. """
+    # Imported here, so that loading the harvesters does not import the client
+    from stelar.client.proxy.decl import validate_tagname
+    return validate_tagname(keyword)
+
+
+class TagNormalizer:
+    """ Split harvested keywords into CKAN tags, custom tags and themes.
+
+    Args:
+        themes (callable): Optional function returning the themes (a list) a conforming keyword
+            maps to, according to the vocabulary of the harvested catalog.
+        cache_size (int): Maximum number of distinct keywords whose verdict is remembered.
+    """
+
+    def __init__(self, themes=None, cache_size=4096):
+        self._themes = themes
+        self.classify = lru_cache(maxsize=cache_size)(self._classify)
+
+    def _classify(self, keyword: str) -> TagVerdict:
+        keyword = keyword.strip()
+        if not is_valid_tag(keyword):
+            return TagVerdict(keyword, False, ())
+        themes = tuple(self._themes(keyword)) if self._themes is not None else ()
+        return TagVerdict(keyword, True, themes)
+
+    def partition(self, keywords):
+        """ Partition keywords into CKAN tags and custom tags, in a single pass.
+
+        Args:
+            keywords (list): The keywords of a harvested record.
+
+        Returns:
+            A triple with the conforming tags, the non-conforming (custom) tags and the themes
+            of the conforming tags, each without duplicates and in their original order.
+        """
+        tags, custom_tags, themes = {}, {}, {}
+        for keyword in keywords:
+            if not keyword:
+                continue
+            verdict = self.classify(keyword)
+            if not verdict.keyword:
+                continue
+            if verdict.conforming:
+                tags[verdict.keyword] = None
+                themes.update(dict.fromkeys(verdict.themes))
+            else:
+                custom_tags[verdict.keyword] = None
+        return list(tags), list(custom_tags), list(themes)
+
+    def cache_info(self):
+        """ Return the statistics (hits, misses, size) of the verdict cache. """
+        return self.classify.cache_info()
@@ -0,0 +1,32 @@
+import os
+import sys
+import threading
+
+import pytest
+
+# The harvesters import each other by their plain names, as when run from this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def stub_server():
+    """ The STELAR API stand-in (stub_api.py), served in a thread. """
+    import stub_api
+    handler = stub_api.make_handler(stub_api.StubCatalog(), stub_api.parse_latency('fixed:0'),
+                                    0.0, 0.0, 1, None, None)
+    server = stub_api.StubServer(('localhost', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def stelar_client(stub_server):
+    """ A STELAR client talking to the API stand-in. """
+    client_module = pytest.importorskip('stelar.client')
+    return client_module.Client(base_url=f'http://localhost:{stub_server.server_port}',
+                                username='user', password='password')
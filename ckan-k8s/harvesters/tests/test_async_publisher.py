@@ -0,0 +1,71 @@
+import asyncio
+import email.utils
+import time
+
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('stelar.client')
+
+from async_publisher import AsyncPublisher, retry_delay, ssl_argument
+from name_allocator import NameAllocator
+from publisher import Publisher, SnapshotStore
+
+
+def test_retry_after_in_seconds():
+    assert retry_delay('3', 0.5) == 3.0
+    assert retry_delay('-1', 0.5) == 0.0
+
+
+def test_retry_after_as_an_http_date():
+    when = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 <= retry_delay(when, 0.5) <= 30
+    assert retry_delay('Wed, 21 Oct 2015 07:28:00 GMT', 0.5) == 0.0
+
+
+def test_a_missing_or_invalid_retry_after_falls_back_to_the_backoff():
+    assert retry_delay(None, 0.5) == 0.5
+    assert retry_delay('soon', 2.0) == 2.0
+
+
+def test_the_tls_verification_is_given_explicitly():
+    assert ssl_argument(True) is True
+    assert ssl_argument(False) is False
+
+
+def publish(publisher, jobs, **kwargs):
+    async def run():
+        async with AsyncPublisher(publisher, **kwargs) as ap:
+            return await ap.publish_all(jobs)
+    return asyncio.run(run())
+
+
+JOBS = [(f'S{i}', {'name': f'record-{i}', 'title': f'Record {i}', 'license': 'CC-BY-4.0',
+                   'tags': ['land', 'sea']},
+         {'name': 'Specs', 'url': f'http://example.org/{i}.json', 'format': 'JSON'}, None)
+        for i in range(5)]
+
+
+def test_the_async_publisher_follows_the_plan_of_the_publisher(stelar_client, tmp_path):
+    snapshots = str(tmp_path / 'snapshots.jsonl')
+    publisher = Publisher(stelar_client, names=NameAllocator(), snapshots=SnapshotStore(snapshots))
+    ids = publish(publisher, JOBS, max_in_flight=3)
+    assert all(isinstance(result, tuple) and None not in result for result in ids)
+    assert publisher.stats == {'created': 5}
+
+    again = Publisher(stelar_client, names=NameAllocator(), snapshots=SnapshotStore(snapshots))
+    changed = [JOBS[0]] + [(sid, dict(spec, title='Changed'), res, rec) for sid, spec, res, rec in JOBS[1:]]
+    assert publish(again, changed) == ids
+    assert again.stats == {'unchanged': 1, 'updated': 4}
+    assert stelar_client.datasets.get(ids[1][0]).title == 'Changed'
+
+
+def test_the_token_is_given_explicitly(stelar_client, tmp_path):
+    calls = []
+
+    def token(refresh=False):
+        calls.append(refresh)
+        return stelar_client.token
+    publisher = Publisher(stelar_client, names=NameAllocator())
+    [(pid, rid)] = publish(publisher, JOBS[:1], token=token)
+    assert calls and pid is not None
@@ -0,0 +1,106 @@
+from name_allocator import (MAX_NAME_LENGTH, SOURCE_ID_FIELD, SUFFIX_LENGTH, NameAllocator,
+                            load_harvested_packages, stable_hash)
+
+
+class FakeDatasets:
+    """ The dataset listing and search of the STELAR client, over a list of packages. """
+
+    def __init__(self, packages):
+        self.packages = packages
+        self.searches = []
+
+    def fetch_list(self, limit, offset):
+        return [p['name'] for p in self.packages][offset:offset + limit]
+
+    def search(self, fq, fl, limit, offset):
+        self.searches.append((fq, fl))
+        key = 'extras_' + SOURCE_ID_FIELD
+        found = [{f: p.get(f) for f in fl} for p in self.packages if p.get(key) is not None]
+        return {'count': len(found), 'results': found[offset:offset + limit]}
+
+
+class FakeClient:
+    def __init__(self, packages):
+        self.datasets = FakeDatasets(packages)
+
+
+def test_the_slug_is_kept_when_free():
+    assert NameAllocator(['other']).allocate('land-cover', 'S1') == 'land-cover'
+
+
+def test_two_sources_with_the_same_base_name_get_distinct_names():
+    names = NameAllocator()
+    first = names.allocate('land-cover', 'S1')
+    second = names.allocate('land-cover', 'S2')
+    assert first == 'land-cover'
+    assert second == 'land-cover-' + stable_hash('S2')[:SUFFIX_LENGTH]
+    assert 'land-cover' in names and second in names
+
+
+def test_the_suffix_grows_until_the_name_is_free():
+    digest = stable_hash('S2')
+    taken = ['land-cover', 'land-cover-' + digest[:SUFFIX_LENGTH]]
+    assert NameAllocator(taken).allocate('land-cover', 'S2') == 'land-cover-' + digest[:SUFFIX_LENGTH + 4]
+
+
+def test_names_are_truncated_to_the_ckan_limit_with_their_suffix():
+    names = NameAllocator(['x' * MAX_NAME_LENGTH])
+    name = names.allocate('x' * 150, 'S1')
+    assert len(name) == MAX_NAME_LENGTH
+    assert name.endswith('-' + stable_hash('S1')[:SUFFIX_LENGTH])
+
+
+def test_a_source_allocated_again_keeps_its_name():
+    names = NameAllocator(['land-cover'])
+    name = names.allocate('land-cover', 'S1')
+    assert names.allocate('land-cover', 'S1') == name
+    assert names.allocate('renamed-title', 'S1') == name
+
+
+def test_a_source_harvested_again_reuses_the_name_of_its_package_in_the_catalog():
+    c = FakeClient([
+        {'id': 'p1', 'name': 'land-cover', 'extras_' + SOURCE_ID_FIELD: 'S1'},
+        {'id': 'p2', 'name': 'land-cover-abc', 'extras_' + SOURCE_ID_FIELD: 'S2'},
+        {'id': 'p3', 'name': 'manual-upload'},
+    ])
+    names = NameAllocator.from_client(c)
+    # A lost harvest state (e.g., a restarted pod) must not create a duplicate
+    assert names.allocate('land-cover', 'S1') == 'land-cover'
+    assert names.allocate('land-cover', 'S2') == 'land-cover-abc'
+    assert names.package_of('S1') == ('p1', 'land-cover')
+    assert names.package_of('S3') is None
+    assert names.allocate('manual-upload', 'S3') != 'manual-upload'
+    assert c.datasets.searches[0][0] == ['extras_' + SOURCE_ID_FIELD + ':*']
+
+
+def test_releasing_a_name_frees_it_unless_its_package_exists():
+    c = FakeClient([{'id': 'p1', 'name': 'land-cover', 'extras_' + SOURCE_ID_FIELD: 'S1'}])
+    names = NameAllocator.from_client(c)
+    names.allocate('new', 'S2')
+    names.release('S2')
+    assert 'new' not in names
+    names.allocate('land-cover', 'S1')
+    names.release('S1')
+    assert 'land-cover' in names
+
+
+def test_always_suffix_makes_names_independent_of_other_allocators():
+    # Two shards allocating the same base name for different records, without seeing each other
+    shard0, shard1 = NameAllocator(always_suffix=True), NameAllocator(always_suffix=True)
+    a = shard0.allocate('land-cover', 'S1')
+    b = shard1.allocate('land-cover', 'S2')
+    assert a == 'land-cover-' + stable_hash('S1')[:SUFFIX_LENGTH]
+    assert b == 'land-cover-' + stable_hash('S2')[:SUFFIX_LENGTH]
+    assert a != b
+    assert NameAllocator(always_suffix=True).allocate('land-cover', 'S1') == a
+
+
+def test_always_suffix_keeps_the_names_of_existing_packages():
+    c = FakeClient([{'id': 'p1', 'name': 'land-cover', 'extras_' + SOURCE_ID_FIELD: 'S1'}])
+    assert NameAllocator.from_client(c, always_suffix=True).allocate('land-cover', 'S1') == 'land-cover'
+
+
+def test_harvested_packages_are_indexed_by_source_id_across_pages():
+    c = FakeClient([{'id': f'p{i}', 'name': f'n{i}', 'extras': {SOURCE_ID_FIELD: f'S{i}'},
+                     'extras_' + SOURCE_ID_FIELD: f'S{i}'} for i in range(5)])
+    assert load_harvested_packages(c, page_size=2) == {f'S{i}': (f'p{i}', f'n{i}') for i in range(5)}
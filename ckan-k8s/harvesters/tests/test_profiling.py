@@ -0,0 +1,49 @@
+import pstats
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from profiling import Profiler
+
+
+def busy_in_a_worker():
+    end = time.perf_counter() + 0.05
+    while time.perf_counter() < end:
+        pass
+
+
+def functions(path):
+    return {name for _, _, name in pstats.Stats(str(path)).stats}
+
+
+def test_a_profiler_without_a_mode_writes_nothing(tmp_path):
+    with Profiler('run', None, str(tmp_path)).stage('ingest'):
+        busy_in_a_worker()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_cprofile_mode_profiles_the_threads_started_in_the_stage(tmp_path):
+    profiler = Profiler('run', 'cprofile', str(tmp_path), top=5)
+    with profiler.stage('ingest'):
+        with ThreadPoolExecutor(2) as pool:
+            list(pool.map(lambda _: busy_in_a_worker(), range(4)))
+    assert 'busy_in_a_worker' in functions(tmp_path / 'run-ingest.prof')
+    assert '3 threads profiled' in (tmp_path / 'run-ingest.top.txt').read_text()
+    # The hook is removed with the stage
+    assert threading.getprofile() is None
+
+
+def test_sample_mode_writes_collapsed_stacks(tmp_path):
+    profiler = Profiler('run', 'sample', str(tmp_path), interval=0.001)
+    with profiler.stage('ingest'):
+        worker = threading.Thread(target=busy_in_a_worker)
+        worker.start()
+        worker.join()
+    assert 'busy_in_a_worker' in (tmp_path / 'run-ingest.collapsed').read_text()
+
+
+def test_unknown_modes_are_rejected():
+    with pytest.raises(ValueError):
+        Profiler('run', 'perf')
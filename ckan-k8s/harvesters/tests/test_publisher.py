@@ -0,0 +1,142 @@
+import pytest
+
+from name_allocator import SOURCE_ID_FIELD, NameAllocator
+from publisher import Publisher, SnapshotStore, diff_specs, normalize_spec
+
+
+def test_normalize_spec_drops_empty_values_and_the_organization():
+    spec = {'title': 'T', 'notes': None, 'organization': object(), 'tags': ['b', 'a']}
+    assert normalize_spec(spec) == {'title': 'T', 'tags': ['a', 'b']}
+
+
+def test_diff_specs_returns_the_changed_and_added_fields():
+    old = {'title': 'T', 'notes': 'n'}
+    new = {'title': 'U', 'notes': 'n', 'version': '2'}
+    assert diff_specs(old, new) == {'title': 'U', 'version': '2'}
+
+
+def test_diff_specs_marks_the_removed_fields_with_ellipsis():
+    assert diff_specs({'title': 'T', 'notes': 'n'}, {'title': 'T'}) == {'notes': ...}
+
+
+def test_diff_specs_ignores_the_order_of_unordered_fields():
+    old = normalize_spec({'tags': ['a', 'b']})
+    assert diff_specs(old, normalize_spec({'tags': ['b', 'a']})) == {}
+
+
+class FakeProxy:
+    def __init__(self, id, **fields):
+        self.id = id
+        self.fields = fields
+        self.updates = []
+
+    def update(self, **changes):
+        self.updates.append(changes)
+        self.fields.update(changes)
+
+
+class FakeDatasets:
+    def __init__(self):
+        self.packages = {}
+
+    def create(self, **spec):
+        d = FakeProxy(f'id-{len(self.packages)}', **spec)
+        self.packages[d.id] = d
+        return d
+
+    def get(self, pid):
+        return self.packages.get(pid)
+
+
+class FakeClient:
+    def __init__(self):
+        self.datasets = FakeDatasets()
+        self.organizations = {'stelar-klms': 'the organization'}
+
+
+@pytest.fixture
+def publisher(tmp_path):
+    return Publisher(FakeClient(), names=NameAllocator(),
+                     snapshots=SnapshotStore(str(tmp_path / 'snapshots.jsonl')))
+
+
+SPEC = {'name': 'land-cover', 'title': 'Land cover', 'tags': ['a', 'b']}
+
+
+def test_a_new_record_is_created_with_its_source_id(publisher):
+    pid, rid = publisher.publish('S1', SPEC)
+    d = publisher.client.datasets.get(pid)
+    assert rid is None
+    assert d.fields[SOURCE_ID_FIELD] == 'S1'
+    assert d.fields['organization'] == 'the organization'
+    assert publisher.stats == {'created': 1}
+
+
+def test_a_record_published_again_unchanged_is_not_updated(publisher):
+    pid, _ = publisher.publish('S1', SPEC)
+    assert publisher.publish('S1', dict(SPEC, tags=['b', 'a'])) == (pid, None)
+    assert publisher.client.datasets.get(pid).updates == []
+    assert publisher.stats == {'created': 1, 'unchanged': 1}
+
+
+def test_only_the_changed_fields_of_a_record_are_updated(publisher):
+    pid, _ = publisher.publish('S1', dict(SPEC, notes='n'))
+    publisher.publish('S1', dict(SPEC, title='Renamed', name='renamed'))
+    # The package keeps its name, and the field no longer harvested is removed
+    assert publisher.client.datasets.get(pid).updates == [{'title': 'Renamed', 'notes': ...}]
+    assert publisher.stats == {'created': 1, 'updated': 1}
+
+
+def test_the_snapshots_are_kept_across_runs(publisher, tmp_path):
+    pid, _ = publisher.publish('S1', SPEC)
+    again = Publisher(publisher.client, names=NameAllocator(),
+                      snapshots=SnapshotStore(str(tmp_path / 'snapshots.jsonl')))
+    assert again.publish('S1', SPEC) == (pid, None)
+    assert again.stats == {'unchanged': 1}
+
+
+def test_a_failed_record_is_counted_and_not_remembered(publisher):
+    def fail(**spec):
+        raise RuntimeError('down')
+    publisher.client.datasets.create = fail
+    with pytest.raises(RuntimeError):
+        publisher.publish('S1', SPEC)
+    assert publisher.stats == {'failed': 1}
+    assert publisher.snapshots.get('S1') is None
+    assert 'land-cover' not in publisher.names
+
+
+def test_a_recovered_unchanged_record_is_not_patched(stelar_client, tmp_path):
+    # Fields the client reads back in another form: the license as an entity, the tags as a tuple
+    spec = {'name': 'recovered', 'title': 'Recovered', 'notes': 'n', 'license': 'CC-BY-4.0',
+            'tags': ['Land cover', 'b c'], 'theme': ['Imagery'], 'custom_tags': ['Été']}
+    resource = {'name': 'Specs', 'url': 'http://example.org/specs.json', 'format': 'JSON',
+                'resource_type': 'other', 'license': 'CC'}
+    first = Publisher(stelar_client, names=NameAllocator(),
+                      snapshots=SnapshotStore(str(tmp_path / 'first.jsonl')))
+    pid, rid = first.publish('S1', spec, resource)
+
+    # The snapshots are lost: the package is found again by its source id
+    again = Publisher(stelar_client, names=NameAllocator.from_client(stelar_client),
+                      snapshots=SnapshotStore(str(tmp_path / 'again.jsonl')))
+    previous = again.recover_snapshot('S1', dict(spec, **{SOURCE_ID_FIELD: 'S1'}), resource)
+    assert (previous['id'], previous['resource_id'], previous['name']) == (pid, rid, 'recovered')
+    assert diff_specs(previous['spec'], normalize_spec(dict(spec, **{SOURCE_ID_FIELD: 'S1'}))) == {}
+    assert diff_specs(previous['resource'], normalize_spec(resource)) == {}
+
+    assert again.publish('S1', spec, resource) == (pid, rid)
+    assert again.stats == {'unchanged': 1}
+
+
+def test_a_recovered_changed_record_is_patched_with_the_changes_only(stelar_client, tmp_path):
+    spec = {'name': 'recovered', 'title': 'Recovered', 'license': 'CC-BY-4.0', 'tags': ['land', 'sea']}
+    first = Publisher(stelar_client, names=NameAllocator(),
+                      snapshots=SnapshotStore(str(tmp_path / 'first.jsonl')))
+    first.publish('S1', spec)
+
+    again = Publisher(stelar_client, names=NameAllocator.from_client(stelar_client),
+                      snapshots=SnapshotStore(str(tmp_path / 'again.jsonl')))
+    changed = dict(spec, title='Changed', tags=['sea'], **{SOURCE_ID_FIELD: 'S1'})
+    previous = again.recover_snapshot('S1', changed)
+    assert diff_specs(previous['spec'], normalize_spec(dict(changed, name='recovered'))) == \
+        {'title': 'Changed', 'tags': ['sea']}
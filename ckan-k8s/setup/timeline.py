@@ -0,0 +1,216 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from kubernetes import client, config
+
+import k8s_apply
+from k8s_apply import Applier
+
+################### Bootstrap Timeline ############################
+#
+# Shared by the bootstrap jobs (keycloak_init, registry-init and the CKAN
+# setup), like k8s_apply.py; keycloak_init holds the reference copy.
+#
+# Every job records the start, end and outcome of its steps in a ledger and
+# publishes it under its own key (<job>.json) of one ConfigMap. Each job
+# applies its key with its own field manager, so server-side apply merges
+# the ledgers of all jobs instead of overwriting them. A step names the steps
+# it waited for in its own job, or as "job/step" in other jobs, so that the
+# critical path crosses jobs. To see the timeline of an install and the jobs
+# that held it up:
+#
+#   python timeline.py [namespace]
+###################################################################
+
+TIMELINE_CONFIGMAP = "stelar-bootstrap-timeline"
+
+
+class Ledger:
+    """
+    The timing records of the steps of a bootstrap job.
+
+    Args:
+        job (str): The name of the job, e.g., keycloak-init.
+        after (list): The steps of other jobs ("job/step") the whole job waits for,
+            e.g., those writing the Secrets its pod needs.
+    """
+
+    def __init__(self, job, after=()):
+        self.job = job
+        self.after = list(after)
+        self.records = []
+        self._lock = threading.Lock()
+
+    def record(self, step, start, end, outcome, after=()):
+        """
+        Records a step.
+
+        Args:
+            step (str): The name of the step.
+            start (float): The start time (epoch seconds), None if the step did not run.
+            end (float): The end time (epoch seconds), None if the step did not run.
+            outcome (str): 'ok', 'failed' or 'skipped'.
+            after (list): The steps this step waited for: the name of a step of this job,
+                or "job/step" for a step of another job.
+        """
+        with self._lock:
+            self.records.append({
+                "step": step,
+                "start": start,
+                "end": end,
+                "outcome": outcome,
+                "after": list(after) + self.after,
+            })
+
+    def extend(self, timings):
+        """
+        Records the timings of a task graph (anything with name, start, end, outcome and after).
+        """
+        for t in timings:
+            self.record(t.name, t.start, t.end, t.outcome, t.after)
+
+    @contextmanager
+    def step(self, name, after=()):
+        """
+        Times the enclosed block as a step; it fails if the block raises.
+        """
+        start = time.time()
+        try:
+            yield
+        except BaseException:
+            self.record(name, start, time.time(), "failed", after)
+            raise
+        self.record(name, start, time.time(), "ok", after)
+
+    def wrap(self, fn):
+        """
+        Decorates a function so that every call is recorded as a step named after it.
+        """
+        @wraps(fn)
+        def timed(*args, **kwargs):
+            with self.step(fn.__name__):
+                return fn(*args, **kwargs)
+        return timed
+
+    def config_map(self, namespace, name=TIMELINE_CONFIGMAP):
+        """
+        Returns the ConfigMap carrying the ledger of this job.
+        """
+        with self._lock:
+            records = sorted(self.records, key=lambda r: (r["start"] is None, r["start"] or 0))
+        return k8s_apply.config_map(name, namespace, {f"{self.job}.json": json.dumps(records)})
+
+    def publish(self, namespace, name=TIMELINE_CONFIGMAP):
+        """
+        Writes the ledger of this job to the timeline ConfigMap, next to those of the other jobs.
+
+        A failure is reported but not raised, since the timeline must not fail a bootstrap.
+        """
+        applier = Applier(field_manager=f"{k8s_apply.FIELD_MANAGER}-{self.job}")
+        applier.add(self.config_map(namespace, name))
+        try:
+            applier.apply()
+        except Exception as e:
+            print(f"Could not publish the timeline of {self.job}: {e}")
+            return False
+        return True
+
+
+def merge(data):
+    """
+    Merges the ledgers of a timeline ConfigMap.
+
+    Args:
+        data (dict): The data of the ConfigMap, a JSON list of records for every job.
+
+    Returns:
+        list: The records of all jobs, with their job, in the order they started.
+    """
+    records = []
+    for key, value in (data or {}).items():
+        if not key.endswith(".json"):
+            continue
+        job = key[: -len(".json")]
+        records += [dict(record, job=job) for record in json.loads(value)]
+    return sorted(records, key=lambda r: (r["start"] is None, r["start"] or 0))
+
+
+def dependencies(record, by_key):
+    """
+    Returns the records of the finished steps a step waited for, in its job or in others ("job/step").
+    """
+    deps = []
+    for dep in record["after"]:
+        key = (record["job"], dep)
+        if key not in by_key:
+            key = tuple(dep.split("/", 1))
+        if key in by_key:
+            deps.append(by_key[key])
+    return deps
+
+
+def critical_path(records):
+    """
+    Returns the chain of steps that ended last, across jobs: the last step of the install,
+    the step it waited for that ended last, and so on.
+    """
+    finished = [r for r in records if r["end"] is not None]
+    if not finished:
+        return []
+    by_key = {(r["job"], r["step"]): r for r in finished}
+    path = [max(finished, key=lambda r: r["end"])]
+    seen = {(path[0]["job"], path[0]["step"])}
+    while True:
+        deps = [r for r in dependencies(path[-1], by_key) if (r["job"], r["step"]) not in seen]
+        if not deps:
+            break
+        path.append(max(deps, key=lambda r: r["end"]))
+        seen.add((path[-1]["job"], path[-1]["step"]))
+    return list(reversed(path))
+
+
+def report(records):
+    """
+    Prints the span of every job, the steps of all jobs relative to the first start, and the critical path.
+    """
+    started = [r for r in records if r["start"] is not None]
+    if not started:
+        print("No steps recorded")
+        return
+    origin = min(r["start"] for r in started)
+    end = max(r["end"] for r in started)
+
+    print(f"{'job':<20} {'start (s)':>9} {'end (s)':>9}  failed")
+    for job in sorted({r["job"] for r in started}, key=lambda j: min(r["start"] for r in started if r["job"] == j)):
+        steps = [r for r in records if r["job"] == job]
+        ran = [r for r in steps if r["start"] is not None]
+        failed = sum(r["outcome"] != "ok" for r in steps)
+        print(f"{job:<20} {min(r['start'] for r in ran) - origin:>9.2f} "
+              f"{max(r['end'] for r in ran) - origin:>9.2f}  {failed}")
+    print()
+
+    print(f"{'job':<20} {'step':<36} {'start (s)':>9} {'time (s)':>9}  outcome")
+    for r in records:
+        if r["start"] is None:
+            print(f"{r['job']:<20} {r['step']:<36} {'-':>9} {'-':>9}  {r['outcome']}")
+        else:
+            print(f"{r['job']:<20} {r['step']:<36} {r['start'] - origin:>9.2f} "
+                  f"{r['end'] - r['start']:>9.2f}  {r['outcome']}")
+    path = critical_path(records)
+    print(f"Total: {end - origin:.2f}s, critical path: "
+          f"{' -> '.join(r['job'] + '/' + r['step'] for r in path)}")
+
+
+if __name__ == "__main__":
+    namespace = sys.argv[1] if len(sys.argv) > 1 else os.getenv("KUBE_NAMESPACE", "default")
+    try:
+        config.load_incluster_config()
+    except config.ConfigException:
+        config.load_kube_config()
+    timeline = client.CoreV1Api().read_namespaced_config_map(TIMELINE_CONFIGMAP, namespace)
+    report(merge(timeline.data))
@@ -0,0 +1,192 @@
+import base64
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from kubernetes import client, dynamic
+
+################### Kubernetes Apply ############################
+#
+# Shared by the bootstrap jobs (keycloak_init, registry-init and the CKAN
+# setup) for the Secrets and ConfigMaps they produce. Each job builds its
+# image from its own directory, so this file is copied there; keycloak_init
+# holds the reference copy (see `make sync-shared` and `make check-shared`).
+#
+# The objects of a job are collected and applied together with server-side
+# apply, so an object that exists is updated (e.g., a rotated client secret)
+# instead of being rejected with 409. Every object carries a hash of its
+# content; one list call per kind and namespace finds the objects whose
+# hash is unchanged, and these are not sent at all.
+#################################################################
+
+FIELD_MANAGER = "stelar-bootstrap"
+HASH_ANNOTATION = "stelar.gr/content-hash"
+
+
+def secret(name, namespace, data_dict):
+    """
+    Returns an Opaque Secret with the given (plain text) values.
+    """
+    return {
+        "apiVersion": "v1",
+        "kind": "Secret",
+        "metadata": {"name": name, "namespace": namespace},
+        "type": "Opaque",
+        "data": {
+            k: base64.b64encode(v.encode("utf-8")).decode("utf-8")
+            for k, v in data_dict.items()
+        },
+    }
+
+
+def config_map(name, namespace, data_dict):
+    """
+    Returns a ConfigMap with the given values.
+    """
+    return {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {"name": name, "namespace": namespace},
+        "data": data_dict,
+    }
+
+
+def content_hash(obj):
+    """
+    Returns the digest of the content of an object (its type and data, not its metadata).
+    """
+    content = {k: obj.get(k) for k in ("kind", "type", "data", "binaryData")}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+class ApplyError(Exception):
+    """
+    Raised when some of the collected objects could not be applied.
+
+    Args:
+        outcomes (dict): The outcome of every object, by (kind, namespace, name).
+    """
+
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+        self.failed = sorted(key for key, outcome in outcomes.items() if outcome == "failed")
+        super().__init__(
+            "Failed to apply " + ", ".join(f"{kind} '{name}' in namespace '{namespace}'"
+                                           for kind, namespace, name in self.failed)
+        )
+
+
+class Applier:
+    """
+    Collects Secrets and ConfigMaps, and applies the changed ones in parallel.
+
+    Args:
+        field_manager (str): The owner of the applied fields.
+        max_workers (int): The maximum number of concurrent apply requests.
+    """
+
+    LISTS = {
+        "Secret": "list_namespaced_secret",
+        "ConfigMap": "list_namespaced_config_map",
+    }
+
+    def __init__(self, field_manager=FIELD_MANAGER, max_workers=8):
+        self.field_manager = field_manager
+        self.max_workers = max_workers
+        self.objects = []
+
+    def add(self, obj):
+        """
+        Adds an object to apply, stamped with the hash of its content.
+
+        Returns:
+            dict: The object.
+        """
+        if obj["kind"] not in self.LISTS:
+            raise ValueError(f"Unsupported kind {obj['kind']}")
+        annotations = obj["metadata"].setdefault("annotations", {})
+        annotations[HASH_ANNOTATION] = content_hash(obj)
+        self.objects.append(obj)
+        return obj
+
+    def _current_hashes(self, kind, namespace):
+        """ Returns the content hashes of the existing objects of a kind, by name (None if not stamped). """
+        try:
+            items = getattr(client.CoreV1Api(), self.LISTS[kind])(namespace).items
+        except client.exceptions.ApiException as e:
+            # Without the permission to list, every object is applied
+            print(f"Cannot list {kind}s in '{namespace}' ({e.status}), applying all of them")
+            return {}
+        return {
+            item.metadata.name: (item.metadata.annotations or {}).get(HASH_ANNOTATION)
+            for item in items
+        }
+
+    def _diff(self, objects):
+        """ Returns the outcomes of the unchanged objects, and the changed objects with the outcome of applying them. """
+        # The last object added under a name wins
+        latest = {(o["kind"], o["metadata"]["namespace"], o["metadata"]["name"]): o for o in objects}
+
+        current = {}
+        for kind, namespace in {(kind, namespace) for kind, namespace, _ in latest}:
+            current[kind, namespace] = self._current_hashes(kind, namespace)
+
+        outcomes, changed = {}, []
+        for key, obj in latest.items():
+            kind, namespace, name = key
+            existing = current[kind, namespace]
+            if existing.get(name) == obj["metadata"]["annotations"][HASH_ANNOTATION]:
+                outcomes[key] = "unchanged"
+            else:
+                changed.append((key, obj, "updated" if name in existing else "created"))
+        return outcomes, changed
+
+    def plan(self):
+        """
+        Finds out what applying the collected objects would do, without writing (or forgetting) them.
+
+        Returns:
+            dict: The outcome ('created', 'updated' or 'unchanged') every object would have,
+                by (kind, namespace, name).
+        """
+        outcomes, changed = self._diff(self.objects)
+        outcomes.update((key, outcome) for key, _, outcome in changed)
+        return outcomes
+
+    def apply(self):
+        """
+        Applies the collected objects whose content has changed, and forgets all of them.
+
+        Returns:
+            dict: The outcome ('created', 'updated' or 'unchanged') of every object,
+                by (kind, namespace, name).
+
+        Raises:
+            ApplyError: If some objects could not be applied (the others are applied all the same).
+        """
+        objects, self.objects = self.objects, []
+        outcomes, changed = self._diff(objects)
+
+        if changed:
+            # Discovery costs a few requests, so it is only done when something must be applied
+            dyn = dynamic.DynamicClient(client.ApiClient())
+            resources = {kind: dyn.resources.get(api_version="v1", kind=kind) for kind in self.LISTS}
+
+            def apply_one(key, obj, outcome):
+                try:
+                    dyn.server_side_apply(
+                        resources[obj["kind"]], body=obj, field_manager=self.field_manager, force_conflicts=True
+                    )
+                    return key, outcome
+                except client.exceptions.ApiException as e:
+                    print(f"Failed to apply {key[0]} '{key[2]}' in namespace '{key[1]}': {e.status} {e.reason}")
+                    return key, "failed"
+
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                outcomes.update(pool.map(lambda args: apply_one(*args), changed))
+
+        for (kind, namespace, name), outcome in sorted(outcomes.items()):
+            print(f"{kind} '{name}' in namespace '{namespace}': {outcome}")
+        if "failed" in outcomes.values():
+            raise ApplyError(outcomes)
+        return outcomes
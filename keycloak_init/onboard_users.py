@@ -0,0 +1,250 @@
+import argparse
+import csv
+import json
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from run import MINIO_CLIENT, QUAY_PULLERS_ROLE, initialize_keycloak_admin
+
+################### Bulk User Onboarding ############################
+#
+# Creates the users listed in a CSV or JSONL file in the STELAR realm, e.g.,
+# the participants of a workshop:
+#
+#   python onboard_users.py cohort.csv --concurrency 8 --report outcome.jsonl
+#
+# Every record has a username, and optionally: email, first_name, last_name,
+# password (set as temporary), realm_roles and minio_roles (separated by ';'
+# in CSV files, lists in JSONL files) and is_admin. Users without realm roles
+# get the Quay pullers role.
+#
+# New users are created in batches through partial imports, each carrying
+# the roles and the is_admin attribute of its users, so a batch costs one
+# request. Users that already exist are brought up to date one by one, so
+# the tool can be re-run safely on the same file.
+#####################################################################
+
+TRUE_VALUES = {"true", "1", "yes", "y"}
+
+
+def split_list(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [v.strip() for v in value.split(";") if v.strip()]
+
+
+def read_users(path):
+    """
+    Reads the users to onboard from a CSV (with a header) or JSONL file.
+
+    Returns:
+        list: The users as dicts with username, email, firstName, lastName, password,
+            realmRoles, minioRoles and is_admin.
+    """
+    with open(path, newline="") as f:
+        if path.endswith(".jsonl") or path.endswith(".json"):
+            records = [json.loads(line) for line in f if line.strip()]
+        else:
+            records = list(csv.DictReader(f))
+
+    users = []
+    for record in records:
+        username = (record.get("username") or "").strip().lower()  # Keycloak stores usernames in lowercase
+        if not username:
+            raise ValueError(f"Record without a username in {path}: {record}")
+        users.append({
+            "username": username,
+            "email": record.get("email") or None,
+            "firstName": record.get("first_name") or None,
+            "lastName": record.get("last_name") or None,
+            "password": record.get("password") or None,
+            "realmRoles": split_list(record.get("realm_roles")) or [QUAY_PULLERS_ROLE],
+            "minioRoles": split_list(record.get("minio_roles")),
+            "is_admin": str(record.get("is_admin", "")).strip().lower() in TRUE_VALUES,
+        })
+    return users
+
+
+def user_representation(user):
+    """
+    Returns the UserRepresentation of a user to onboard, with its roles by name.
+    """
+    representation = {
+        "username": user["username"],
+        "enabled": True,
+        "attributes": {"is_admin": [str(user["is_admin"]).lower()]},
+        "realmRoles": user["realmRoles"],
+        "clientRoles": {MINIO_CLIENT: user["minioRoles"]} if user["minioRoles"] else {},
+    }
+    for key in ("email", "firstName", "lastName"):
+        if user[key]:
+            representation[key] = user[key]
+    if user["password"]:
+        representation["credentials"] = [{"type": "password", "value": user["password"], "temporary": True}]
+    return representation
+
+
+def differs(actual, fields, attributes):
+    """
+    Checks whether a UserRepresentation lacks some of the given fields or attributes.
+    """
+    actual_attributes = actual.get("attributes") or {}
+    return any(actual.get(k) != v for k, v in fields.items()) or any(
+        actual_attributes.get(k) != v for k, v in attributes.items()
+    )
+
+
+class Onboarding:
+    """
+    Idempotent creation of many users, with bounded parallelism.
+
+    Args:
+        keycloak_admin (KeycloakAdmin): The admin client of the realm.
+        concurrency (int): The maximum number of concurrent admin requests.
+        batch_size (int): The number of new users created by each partial import.
+    """
+
+    def __init__(self, keycloak_admin, concurrency=8, batch_size=50):
+        self.keycloak_admin = keycloak_admin
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.outcomes = []
+        self._lock = threading.Lock()
+
+        # Roles are resolved once, to assign them to existing users
+        self.minio_client_id = keycloak_admin.get_client_id(MINIO_CLIENT)
+        self.realm_roles = {r["name"]: r for r in keycloak_admin.get_realm_roles()}
+        self.minio_roles = {r["name"]: r for r in keycloak_admin.get_client_roles(self.minio_client_id)}
+
+    def _record(self, user, outcome, detail=None):
+        with self._lock:
+            self.outcomes.append({"username": user["username"], "outcome": outcome, "detail": detail})
+
+    def run(self, users):
+        """
+        Onboards the given users.
+
+        Returns:
+            list: The outcome ('created', 'updated', 'unchanged' or 'failed') of every user.
+        """
+        unknown = {r for u in users for r in u["realmRoles"]} - set(self.realm_roles)
+        unknown |= {r for u in users for r in u["minioRoles"]} - set(self.minio_roles)
+        if unknown:
+            raise ValueError(f"Unknown roles: {sorted(unknown)}")
+
+        users = list({u["username"]: u for u in users}.values())  # The last record of a user wins
+        existing = {u["username"]: u for u in self.keycloak_admin.get_users({})}
+        new_users = [u for u in users if u["username"] not in existing]
+        batches = [new_users[i:i + self.batch_size] for i in range(0, len(new_users), self.batch_size)]
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = [pool.submit(self._import_batch, batch) for batch in batches]
+            futures += [
+                pool.submit(self._update_existing, u, existing[u["username"]])
+                for u in users if u["username"] in existing
+            ]
+            for future in futures:
+                future.result()
+        return self.outcomes
+
+    def _import_batch(self, batch):
+        try:
+            response = self.keycloak_admin.partial_import_realm(
+                self.keycloak_admin.connection.realm_name,
+                {"ifResourceExists": "SKIP", "users": [user_representation(u) for u in batch]},
+            )
+        except Exception as e:
+            # Find out which users fail, by creating them one at a time
+            print(f"Batch of {len(batch)} users failed ({e}), retrying them one by one")
+            for user in batch:
+                self._create_user(user)
+            return
+
+        actions = {r.get("resourceName"): r.get("action") for r in response.get("results", [])}
+        for user in batch:
+            # A user created concurrently (e.g., by another run) is skipped by the import
+            action = actions.get(user["username"])
+            self._record(user, "unchanged" if action == "SKIPPED" else "created")
+
+    def _create_user(self, user):
+        try:
+            representation = user_representation(user)
+            representation.pop("realmRoles")
+            representation.pop("clientRoles")
+            user_id = self.keycloak_admin.create_user(representation, exist_ok=True)
+            self._assign_roles(user, user_id, set(), set())
+            self._record(user, "created")
+        except Exception as e:
+            self._record(user, "failed", str(e))
+
+    def _assign_roles(self, user, user_id, realm_roles, minio_roles):
+        """ Assigns the roles of a user that are not among the given ones, each kind in one request. """
+        missing = [self.realm_roles[r] for r in user["realmRoles"] if r not in realm_roles]
+        if missing:
+            self.keycloak_admin.assign_realm_roles(user_id, missing)
+        missing_minio = [self.minio_roles[r] for r in user["minioRoles"] if r not in minio_roles]
+        if missing_minio:
+            self.keycloak_admin.assign_client_role(user_id, self.minio_client_id, missing_minio)
+        return bool(missing or missing_minio)
+
+    def _update_existing(self, user, actual):
+        try:
+            changed = False
+            wanted = user_representation(user)
+            fields = {k: wanted[k] for k in ("email", "firstName", "lastName") if k in wanted}
+            if differs(actual, fields, wanted["attributes"]):
+                # Keycloak replaces the user with the representation sent (with the user profile,
+                # missing attributes are removed), so the changes are merged into the full one
+                full = self.keycloak_admin.get_user(actual["id"])
+                if differs(full, fields, wanted["attributes"]):
+                    attributes = dict(full.get("attributes") or {}, **wanted["attributes"])
+                    self.keycloak_admin.update_user(actual["id"], dict(full, **fields, attributes=attributes))
+                    changed = True
+
+            realm_roles = {r["name"] for r in self.keycloak_admin.get_realm_roles_of_user(actual["id"])}
+            minio_roles = set()
+            if user["minioRoles"]:
+                minio_roles = {
+                    r["name"] for r in self.keycloak_admin.get_client_roles_of_user(actual["id"], self.minio_client_id)
+                }
+            changed |= self._assign_roles(user, actual["id"], realm_roles, minio_roles)
+            self._record(user, "updated" if changed else "unchanged")
+        except Exception as e:
+            self._record(user, "failed", str(e))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Onboard users to the STELAR realm from a CSV or JSONL file.")
+    parser.add_argument("users", help="The CSV (with a header) or JSONL file of the users")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum number of concurrent admin requests")
+    parser.add_argument("--batch-size", type=int, default=50, help="Number of new users created per request")
+    parser.add_argument("--report", default=None, help="Write the outcome of every user to this JSONL file")
+    args = parser.parse_args(argv)
+
+    users = read_users(args.users)
+    start = time.time()
+    onboarding = Onboarding(initialize_keycloak_admin(), args.concurrency, args.batch_size)
+    outcomes = onboarding.run(users)
+    elapsed = time.time() - start
+
+    for outcome in outcomes:
+        if outcome["outcome"] == "failed":
+            print(f"{outcome['username']}: failed: {outcome['detail']}")
+    if args.report:
+        with open(args.report, "w") as f:
+            for outcome in outcomes:
+                f.write(json.dumps(outcome) + "\n")
+
+    counts = Counter(o["outcome"] for o in outcomes)
+    print(", ".join(f"{count} {outcome}" for outcome, count in sorted(counts.items())))
+    print(f"{len(outcomes)} users in {elapsed:.1f}s ({len(outcomes) / elapsed:.1f} users/s)")
+    if counts["failed"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
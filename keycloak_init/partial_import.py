@@ -0,0 +1,108 @@
+from keycloak.keycloak_admin import KeycloakAdmin
+
+from reconcile import Reconciler
+
+################### Partial Import Bootstrap ############################
+#
+# Alternative to the object-by-object reconciliation of reconcile.py for
+# cold clusters: the clients (with their default scopes and service
+# accounts), the realm roles and the client roles of the realm spec are
+# rendered into one PartialImportRepresentation and applied with a single
+# admin call. The generated client secrets are then read back in one pass.
+#
+# Keycloak's partial import does not cover client scopes or the user
+# profile, so these are reconciled beforehand; on a realm that already has
+# them, this costs only the bulk reads of the reconciler.
+##########################################################################
+
+# What the partial import does with objects that already exist
+IF_RESOURCE_EXISTS = ["SKIP", "OVERWRITE", "FAIL"]
+
+
+def render_partial_import(spec: dict, if_resource_exists="SKIP", realm_default_scopes=(), realm_optional_scopes=()):
+    """
+    Renders the clients and roles of a realm spec into a partial import document.
+
+    Args:
+        spec (dict): The desired state of the realm (see reconcile.py).
+        if_resource_exists (str): One of IF_RESOURCE_EXISTS. Note that OVERWRITE replaces
+            existing clients, with new ids and secrets.
+        realm_default_scopes (list): The names of the default client scopes of the realm. An imported
+            client gets only the default scopes it lists, so these are added to every client.
+        realm_optional_scopes (list): The names of the optional client scopes of the realm, added likewise.
+
+    Returns:
+        dict: The PartialImportRepresentation.
+    """
+    if if_resource_exists not in IF_RESOURCE_EXISTS:
+        raise ValueError(f"Invalid policy {if_resource_exists}, expected one of {IF_RESOURCE_EXISTS}")
+
+    clients = []
+    client_roles = {}
+    for client in spec.get("clients", []):
+        representation = {k: v for k, v in client.items() if k != "roles"}
+        # A scope the client lists as optional is not made default, and vice versa
+        optional = client.get("optionalClientScopes", [])
+        representation["defaultClientScopes"] = [
+            scope for scope in dict.fromkeys(list(realm_default_scopes) + client.get("defaultClientScopes", []))
+            if scope not in optional
+        ]
+        representation["optionalClientScopes"] = [
+            scope for scope in dict.fromkeys(list(realm_optional_scopes) + optional)
+            if scope not in representation["defaultClientScopes"]
+        ]
+        clients.append(representation)
+        if client.get("roles"):
+            client_roles[client["clientId"]] = [
+                {"name": role, "clientRole": True} for role in client["roles"]
+            ]
+
+    return {
+        "ifResourceExists": if_resource_exists,
+        "clients": clients,
+        "roles": {
+            "realm": list(spec.get("realmRoles", [])),
+            "client": client_roles,
+        },
+    }
+
+
+def bootstrap(keycloak_admin: KeycloakAdmin, spec: dict, if_resource_exists="SKIP"):
+    """
+    Applies a realm spec through a partial import.
+
+    Args:
+        keycloak_admin (KeycloakAdmin): The admin client of the realm.
+        spec (dict): The desired state of the realm (see reconcile.py).
+        if_resource_exists (str): One of IF_RESOURCE_EXISTS.
+
+    Returns:
+        dict: The representations of the clients of the spec by client name, including their 'secret'.
+    """
+    # Client scopes must exist before the clients referencing them are imported
+    Reconciler(
+        keycloak_admin,
+        {
+            "clientScopes": spec.get("clientScopes", []),
+            "userProfileAttributes": spec.get("userProfileAttributes", []),
+        },
+    ).reconcile()
+
+    realm_default_scopes = [scope["name"] for scope in keycloak_admin.get_default_default_client_scopes()]
+    realm_optional_scopes = [scope["name"] for scope in keycloak_admin.get_default_optional_client_scopes()]
+    document = render_partial_import(spec, if_resource_exists, realm_default_scopes, realm_optional_scopes)
+    response = keycloak_admin.partial_import_realm(keycloak_admin.connection.realm_name, document)
+    print(
+        f"Partial import: {response.get('added', 0)} added, {response.get('overwritten', 0)} overwritten, "
+        f"{response.get('skipped', 0)} skipped."
+    )
+    for result in response.get("results", []):
+        print(f"  {result.get('action')} {result.get('resourceType')} {result.get('resourceName')}")
+
+    # The representations listed to an admin include the secrets of confidential clients
+    wanted = {client["clientId"] for client in spec.get("clients", [])}
+    clients = {c["clientId"]: c for c in keycloak_admin.get_clients() if c["clientId"] in wanted}
+    for client in clients.values():
+        if not client.get("secret"):
+            client["secret"] = keycloak_admin.get_client_secrets(client["id"])["value"]
+    return clients
@@ -0,0 +1,182 @@
+import random
+import time
+
+import requests
+from kubernetes import client, watch
+
+################### Service Readiness ############################
+#
+# Shared by keycloak_init and registry-init; keycloak_init holds the
+# reference copy (see `make sync-shared`).
+#
+# Keycloak takes 30-90s to boot, Quay even longer. Rather than crashing on
+# the first request and leaving it to the (escalating) restart backoff of
+# Kubernetes, or sleeping in fixed steps, the bootstrap waits for a service
+# and proceeds the moment it answers.
+##################################################################
+
+
+def backoff_delays(initial=0.5, cap=8.0):
+    """
+    Yields the delays of capped exponential backoff with full jitter.
+
+    Args:
+        initial (float): The upper bound of the first delay, in seconds.
+        cap (float): The maximum upper bound of a delay, in seconds.
+    """
+    bound = initial
+    while True:
+        yield random.uniform(0, bound)
+        bound = min(cap, bound * 2)
+
+
+def wait_for_keycloak(server_url, realm, username, password, timeout=300, client_id="admin-cli"):
+    """
+    Waits until Keycloak serves the realm and accepts the admin credentials.
+
+    The realm's OpenID configuration is polled until it is served; then one password
+    grant checks the credentials, since waiting cannot fix wrong ones.
+
+    Args:
+        server_url (str): The URL of Keycloak.
+        realm (str): The realm the admin authenticates in.
+        username (str): The admin username.
+        password (str): The admin password.
+        timeout (float): The maximum time to wait, in seconds.
+        client_id (str): The client of the password grant.
+
+    Returns:
+        float: The time waited, in seconds.
+
+    Raises:
+        PermissionError: If Keycloak rejects the admin credentials.
+        TimeoutError: If Keycloak is not ready within the timeout.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    realm_url = f"{server_url}/realms/{realm}"
+    attempts = 0
+    last_error = None
+
+    for delay in backoff_delays():
+        attempts += 1
+        try:
+            response = requests.get(f"{realm_url}/.well-known/openid-configuration", timeout=5)
+            if response.status_code == 200:
+                token = requests.post(
+                    f"{realm_url}/protocol/openid-connect/token",
+                    data={"grant_type": "password", "client_id": client_id,
+                          "username": username, "password": password},
+                    timeout=10,
+                )
+                if token.status_code == 200:
+                    waited = time.monotonic() - start
+                    print(f"Keycloak is ready after {waited:.1f}s ({attempts} attempts).")
+                    return waited
+                if token.status_code in (400, 401, 403):
+                    raise PermissionError(
+                        f"Keycloak rejected the admin credentials of '{username}': {token.status_code} {token.text}"
+                    )
+                last_error = f"token request returned {token.status_code}"
+            else:
+                last_error = f"realm returned {response.status_code}"
+        except requests.exceptions.RequestException as e:
+            last_error = type(e).__name__  # e.g., ConnectionError while the service has no endpoints
+
+        if time.monotonic() + delay > deadline:
+            break
+        print(f"Waiting for Keycloak ({last_error}), retrying in {delay:.1f}s...")
+        time.sleep(delay)
+
+    raise TimeoutError(f"Keycloak was not ready within {timeout}s ({attempts} attempts): {last_error}")
+
+
+def wait_for_endpoints(service, namespace, timeout=300):
+    """
+    Waits until a Service has a ready endpoint, i.e., one of its pods passes its readiness probe.
+
+    The Endpoints of the Service are watched, so the wait ends as soon as Kubernetes marks a pod ready.
+
+    Args:
+        service (str): The name of the Service.
+        namespace (str): The namespace of the Service.
+        timeout (float): The maximum time to wait, in seconds.
+
+    Returns:
+        float: The time waited, in seconds, or None if the Endpoints cannot be watched (e.g., no permission).
+
+    Raises:
+        TimeoutError: If no endpoint is ready within the timeout.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    core = client.CoreV1Api()
+    selector = f"metadata.name={service}"
+
+    def ready(endpoints):
+        return any(subset.addresses for subset in endpoints.subsets or [])
+
+    while True:
+        try:
+            listed = core.list_namespaced_endpoints(namespace, field_selector=selector)
+            if any(ready(endpoints) for endpoints in listed.items):
+                return time.monotonic() - start
+            remaining = int(deadline - time.monotonic())
+            if remaining <= 0:
+                raise TimeoutError(f"Service {service} had no ready endpoint within {timeout}s")
+
+            # The watch ends when the server closes it; then the Endpoints are listed again
+            stream = watch.Watch()
+            for event in stream.stream(
+                core.list_namespaced_endpoints,
+                namespace,
+                field_selector=selector,
+                resource_version=listed.metadata.resource_version,
+                timeout_seconds=remaining,
+            ):
+                if event["type"] in ("ADDED", "MODIFIED") and ready(event["object"]):
+                    stream.stop()
+                    return time.monotonic() - start
+        except client.exceptions.ApiException as e:
+            if e.status == 410:  # The listed version expired during the watch
+                continue
+            print(f"Cannot watch the endpoints of {service} ({e.status} {e.reason}), probing it instead")
+            return None
+
+
+def wait_for_http(url, timeout=60, initial=0.05, cap=0.5):
+    """
+    Polls a URL until it returns 200, with a fast backoff for services that are about to be ready.
+
+    Args:
+        url (str): The URL to probe.
+        timeout (float): The maximum time to wait, in seconds.
+        initial (float): The upper bound of the first delay, in seconds.
+        cap (float): The maximum upper bound of a delay, in seconds.
+
+    Returns:
+        float: The time waited, in seconds.
+
+    Raises:
+        TimeoutError: If the URL does not return 200 within the timeout.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    attempts = 0
+    last_error = None
+
+    for delay in backoff_delays(initial, cap):
+        attempts += 1
+        try:
+            response = requests.get(url, timeout=5)
+            if response.status_code == 200:
+                return time.monotonic() - start
+            last_error = f"status {response.status_code}"
+        except requests.exceptions.RequestException as e:
+            last_error = type(e).__name__
+
+        if time.monotonic() + delay > deadline:
+            break
+        time.sleep(delay)
+
+    raise TimeoutError(f"{url} was not ready within {timeout}s ({attempts} attempts): {last_error}")
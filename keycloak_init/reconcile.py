@@ -0,0 +1,312 @@
+from collections import namedtuple
+
+from keycloak.keycloak_admin import KeycloakAdmin
+
+from taskgraph import TaskGraph
+
+################### Declarative Reconciliation ############################
+#
+# The desired state of the realm is a spec in the Keycloak representation:
+#
+#   {
+#       "realmRoles": [RoleRepresentation, ...],
+#       "clientScopes": [ClientScopeRepresentation (with protocolMappers), ...],
+#       "clients": [ClientRepresentation (with defaultClientScopes,
+#                   optionalClientScopes and the names of its client
+#                   "roles"), ...],
+#       "userProfileAttributes": [UserProfileAttribute, ...],
+#   }
+#
+# The actual state is fetched with a few bulk list calls, the two are diffed,
+# and only the missing or changed objects are written. Objects are compared
+# on the properties given in the spec only, so the defaults and ids Keycloak
+# adds to them never count as changes.
+#
+# Reconciliation only adds and updates: objects of the realm missing from the
+# spec (e.g., a client scope dropped from it, or a scope no longer assigned to
+# a client) are never removed, and must be deleted by hand.
+############################################################################
+
+# kind: 'realm-role', 'client-scope', 'mapper', 'client', 'client-role', 'default-scope', 'optional-scope'
+#       or 'profile-attribute'
+# name: the name of the object; for objects inside another one, '<owner>/<name>'
+# action: 'create', 'update' or 'noop'
+Change = namedtuple("Change", ["kind", "name", "action", "payload"])
+
+# Order in which the kinds of changes are applied, so that every object exists before it is referenced
+APPLY_ORDER = [
+    "realm-role", "client-scope", "mapper", "client", "client-role", "default-scope", "optional-scope", "profile-attribute"
+]
+
+
+def matches(desired, actual):
+    """
+    Checks whether the actual representation of an object has all the properties of the desired one.
+
+    Args:
+        desired: The desired representation (or value).
+        actual: The actual representation (or value), as returned by Keycloak.
+
+    Returns:
+        bool: True if no property of the desired representation differs.
+    """
+    if isinstance(desired, dict):
+        actual = {} if actual is None else actual  # Keycloak omits empty maps
+        return isinstance(actual, dict) and all(
+            matches(value, actual.get(key)) for key, value in desired.items()
+        )
+    # The attributes of users are lists of values
+    if isinstance(actual, list) and not isinstance(desired, list) and len(actual) == 1:
+        actual = actual[0]
+    # Keycloak returns the values of attributes and mapper configs as strings
+    if isinstance(desired, bool) and isinstance(actual, str):
+        return str(desired).lower() == actual
+    return desired == actual
+
+
+class RealmState:
+    """
+    The actual state of the objects of a realm that a spec refers to.
+
+    Args:
+        keycloak_admin (KeycloakAdmin): The admin client of the realm.
+        spec (dict): The desired state; the roles of its clients are only fetched for existing clients.
+    """
+
+    def __init__(self, keycloak_admin: KeycloakAdmin, spec: dict):
+        self.clients = {c["clientId"]: c for c in keycloak_admin.get_clients()}
+        self.client_scopes = {s["name"]: s for s in keycloak_admin.get_client_scopes()}
+        self.realm_roles = {r["name"]: r for r in keycloak_admin.get_realm_roles()}
+        self.profile = keycloak_admin.get_realm_users_profile()
+        self.client_roles = {}
+        for client in spec.get("clients", []):
+            existing = self.clients.get(client["clientId"])
+            if existing is not None and client.get("roles"):
+                self.client_roles[client["clientId"]] = {
+                    r["name"] for r in keycloak_admin.get_client_roles(existing["id"])
+                }
+
+    def profile_attributes(self):
+        return {a["name"]: a for a in self.profile.get("attributes", [])}
+
+
+def diff(spec: dict, state: RealmState):
+    """
+    Computes the changes that bring the actual state of the realm to the desired one.
+
+    Only the objects of the spec are considered; those missing from it are never removed.
+
+    Args:
+        spec (dict): The desired state.
+        state (RealmState): The actual state.
+
+    Returns:
+        list: The changes (including no-ops), in the order they must be applied.
+    """
+    changes = []
+
+    for role in spec.get("realmRoles", []):
+        actual = state.realm_roles.get(role["name"])
+        changes.append(Change("realm-role", role["name"], "create" if actual is None else "noop", role))
+
+    for scope in spec.get("clientScopes", []):
+        actual = state.client_scopes.get(scope["name"])
+        representation = {k: v for k, v in scope.items() if k != "protocolMappers"}
+        if actual is None:
+            changes.append(Change("client-scope", scope["name"], "create", representation))
+        else:
+            changes.append(Change("client-scope", scope["name"],
+                                  "noop" if matches(representation, actual) else "update", representation))
+
+        actual_mappers = {m["name"]: m for m in (actual or {}).get("protocolMappers", [])}
+        for mapper in scope.get("protocolMappers", []):
+            name = f'{scope["name"]}/{mapper["name"]}'
+            current = actual_mappers.get(mapper["name"])
+            if current is None:
+                changes.append(Change("mapper", name, "create", mapper))
+            elif not matches(mapper, current):
+                changes.append(Change("mapper", name, "update", dict(mapper, id=current["id"])))
+            else:
+                changes.append(Change("mapper", name, "noop", mapper))
+
+    for client in spec.get("clients", []):
+        client_id = client["clientId"]
+        representation = {
+            k: v for k, v in client.items() if k not in ("roles", "defaultClientScopes", "optionalClientScopes")
+        }
+        actual = state.clients.get(client_id)
+        if actual is None:
+            changes.append(Change("client", client_id, "create", representation))
+        elif not matches(representation, actual):
+            changes.append(Change("client", client_id, "update", representation))
+        else:
+            changes.append(Change("client", client_id, "noop", representation))
+
+        existing_roles = state.client_roles.get(client_id, set())
+        for role in client.get("roles", []):
+            changes.append(Change("client-role", f"{client_id}/{role}",
+                                  "noop" if role in existing_roles else "create", {"name": role}))
+
+        # The representation of a client lists the names of its default and optional scopes; a scope
+        # assigned the other way is moved
+        assigned = {
+            "default": set((actual or {}).get("defaultClientScopes", [])),
+            "optional": set((actual or {}).get("optionalClientScopes", [])),
+        }
+        for kind, other in (("default", "optional"), ("optional", "default")):
+            for scope in client.get(f"{kind}ClientScopes", []):
+                payload = {"client": client_id, "scope": scope, "moved": scope in assigned[other]}
+                changes.append(Change(f"{kind}-scope", f"{client_id}/{scope}",
+                                      "noop" if scope in assigned[kind] else "create", payload))
+
+    attributes = state.profile_attributes()
+    for attribute in spec.get("userProfileAttributes", []):
+        actual = attributes.get(attribute["name"])
+        if actual is None:
+            action = "create"
+        else:
+            action = "noop" if matches(attribute, actual) else "update"
+        changes.append(Change("profile-attribute", attribute["name"], action, attribute))
+
+    return sorted(changes, key=lambda change: APPLY_ORDER.index(change.kind))
+
+
+class Reconciler:
+    """
+    Applies the changes computed by diff() to a realm.
+
+    Args:
+        keycloak_admin (KeycloakAdmin): The admin client of the realm.
+        spec (dict): The desired state.
+    """
+
+    def __init__(self, keycloak_admin: KeycloakAdmin, spec: dict):
+        self.keycloak_admin = keycloak_admin
+        self.spec = spec
+        self.state = None
+
+    def plan(self):
+        """
+        Fetches the actual state of the realm and computes the changes, without writing anything.
+
+        Returns:
+            list: The changes (including no-ops).
+        """
+        self.state = RealmState(self.keycloak_admin, self.spec)
+        return diff(self.spec, self.state)
+
+    def client_uuid(self, client_id):
+        """
+        Returns the internal id of a client of the spec, e.g., to fetch its secret.
+        """
+        return self.state.clients[client_id]["id"]
+
+    def reconcile(self, max_workers=8):
+        """
+        Brings the realm to the desired state, writing only the missing or changed objects.
+
+        Changes that do not depend on each other (e.g., different clients) are applied concurrently.
+
+        Args:
+            max_workers (int): The maximum number of concurrent admin requests.
+
+        Returns:
+            list: The changes that were applied.
+        """
+        changes = [change for change in self.plan() if change.action != "noop"]
+        if not changes:
+            print("Realm is up to date, nothing to change.")
+            return changes
+
+        graph = TaskGraph(max_workers)
+        steps = {}
+        for change in changes:
+            step = f"{change.kind} {change.name}"
+            after = [steps[dep] for dep in self._dependencies(change) if dep in steps]
+            if change.kind == "profile-attribute":
+                # The user profile is written as a whole, so its changes are serialized
+                after += [s for (kind, _), s in steps.items() if kind == "profile-attribute"][-1:]
+            steps[(change.kind, change.name)] = graph.add(step, self._apply, change, after=after)
+        graph.run()
+        return changes
+
+    @staticmethod
+    def _dependencies(change):
+        """ Returns the (kind, name) of the objects a change refers to. """
+        if change.kind == "mapper":
+            return [("client-scope", change.name.split("/")[0])]
+        if change.kind == "client-role":
+            return [("client", change.name.split("/")[0])]
+        if change.kind in ("default-scope", "optional-scope"):
+            return [("client", change.payload["client"]), ("client-scope", change.payload["scope"])]
+        return []
+
+    def _apply(self, change):
+        print(f"[{change.action}] {change.kind} {change.name}")
+        getattr(self, "_apply_" + change.kind.replace("-", "_"))(change)
+
+    # The state is updated as objects are created, to resolve the ids referenced by later changes
+
+    def _apply_realm_role(self, change):
+        self.keycloak_admin.create_realm_role(change.payload, skip_exists=True)
+
+    def _apply_client_scope(self, change):
+        if change.action == "create":
+            scope_id = self.keycloak_admin.create_client_scope(change.payload, skip_exists=True)
+            self.state.client_scopes[change.name] = dict(change.payload, id=scope_id, protocolMappers=[])
+        else:
+            scope = self.state.client_scopes[change.name]
+            self.keycloak_admin.update_client_scope(scope["id"], dict(scope, **change.payload))
+
+    def _apply_mapper(self, change):
+        scope_id = self.state.client_scopes[change.name.split("/")[0]]["id"]
+        if change.action == "create":
+            self.keycloak_admin.add_mapper_to_client_scope(scope_id, change.payload)
+        else:
+            self.keycloak_admin.update_mapper_in_client_scope(scope_id, change.payload["id"], change.payload)
+
+    def _apply_client(self, change):
+        if change.action == "create":
+            uuid = self.keycloak_admin.create_client(change.payload, skip_exists=True)
+            self.state.clients[change.name] = dict(change.payload, id=uuid)
+        else:
+            actual = self.state.clients[change.name]
+            merged = dict(actual, **change.payload)
+            self.keycloak_admin.update_client(actual["id"], merged)
+            self.state.clients[change.name] = merged
+
+    def _apply_client_role(self, change):
+        client_id = change.name.split("/")[0]
+        self.keycloak_admin.create_client_role(self.client_uuid(client_id), change.payload, skip_exists=True)
+
+    def _apply_default_scope(self, change):
+        client_id, scope = change.payload["client"], change.payload["scope"]
+        scope_id = self.state.client_scopes[scope]["id"]
+        if change.payload["moved"]:
+            self.keycloak_admin.delete_client_optional_client_scope(self.client_uuid(client_id), scope_id)
+        self.keycloak_admin.add_client_default_client_scope(
+            self.client_uuid(client_id),
+            scope_id,
+            {"realm": self.keycloak_admin.connection.realm_name, "client": client_id, "clientScopeId": scope_id},
+        )
+
+    def _apply_optional_scope(self, change):
+        client_id, scope = change.payload["client"], change.payload["scope"]
+        scope_id = self.state.client_scopes[scope]["id"]
+        if change.payload["moved"]:
+            self.keycloak_admin.delete_client_default_client_scope(self.client_uuid(client_id), scope_id)
+        self.keycloak_admin.add_client_optional_client_scope(
+            self.client_uuid(client_id),
+            scope_id,
+            {"realm": self.keycloak_admin.connection.realm_name, "client": client_id, "clientScopeId": scope_id},
+        )
+
+    def _apply_profile_attribute(self, change):
+        # The attributes are replaced as a whole, so the profile is updated in place
+        attributes = [
+            change.payload if a["name"] == change.name else a for a in self.state.profile.get("attributes", [])
+        ]
+        if change.action == "create":
+            attributes.append(change.payload)
+        self.state.profile = dict(self.state.profile, attributes=attributes)
+        self.keycloak_admin.update_realm_users_profile(self.state.profile)
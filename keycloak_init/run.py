@@ -1,18 +1,31 @@
 from keycloak.keycloak_admin import KeycloakAdmin, KeycloakPostError
 from kubernetes import client, config  # need to pip install
-import base64
-import yaml
+import argparse
+import contextlib
+import json
 import os
-import subprocess
-
-config.load_incluster_config()
+import sys
+from collections import Counter
+from datetime import datetime, timezone
+
+import k8s_apply
+from k8s_apply import Applier
+from minio_admin import MinioConnection, MinioSetupError, config_fingerprint
+from partial_import import bootstrap
+from readiness import wait_for_keycloak
+from reconcile import Reconciler, matches
+from taskgraph import TaskGraph
+from timeline import Ledger
+from token_provider import TokenProvider
 
 # Keycloak admin credentials
 KEYCLOAK_ADMIN_USERNAME = os.getenv("KEYCLOAK_ADMIN")
 KEYCLOAK_ADMIN_PASSWORD = os.getenv("KEYCLOAK_ADMIN_PASSWORD")
 KEYCLOAK_ADMIN_EMAIL = os.getenv("KEYCLOAK_ADMIN_EMAIL", "info@stelar.gr")
 KEYCLOAK_REALM = os.getenv("KEYCLOAK_REALM")
-KEYCLOAK_URL = "http://keycloak:" + os.getenv("KEYCLOAK_PORT")
+KEYCLOAK_URL = "http://keycloak:" + os.getenv("KEYCLOAK_PORT", "8080")
+# Maximum time (seconds) to wait for Keycloak to be ready
+KEYCLOAK_READY_TIMEOUT = float(os.getenv("KEYCLOAK_READY_TIMEOUT", "300"))
 
 KUBE_NAMESPACE = os.getenv("KUBE_NAMESPACE")
 
@@ -37,72 +50,79 @@ API_CLIENT_ROOT_URL = os.getenv("KC_API_CLIENT_ROOT_URL", API_CLIENT_HOME_URL)
 MINIO_CLIENT_ROOT_URL = os.getenv("KC_MINIO_CLIENT_ROOT_URL", MINIO_CLIENT_HOME_URL)
 CKAN_CLIENT_ROOT_URL = os.getenv("KC_CKAN_CLIENT_ROOT_URL", CKAN_CLIENT_HOME_URL)
 
+# The client scopes whose claims the API client puts in its tokens. Scopes listed in KC_API_OPTIONAL_SCOPES
+# (comma separated) are only added when the token is requested with them, e.g. scope="openid minio_auth_scope"
+# for MinIO, keeping the default token lean. By default, the scopes with the heavy claims (the MinIO policies
+# and the registry roles) are optional; set KC_API_OPTIONAL_SCOPES="" to put every claim in every token.
+API_CLIENT_SCOPES = ["minio_auth_scope", "registry_scope", "admin_attr_scope"]
+API_OPTIONAL_SCOPES = [
+    s.strip() for s in os.getenv("KC_API_OPTIONAL_SCOPES", "minio_auth_scope,registry_scope").split(",") if s.strip()
+]
+
 # QUAY REGISTRY ROLES
 QUAY_PUSHERS_ROLE = os.getenv("KC_QUAY_PUSHERS")
 QUAY_PULLERS_ROLE = os.getenv("KC_QUAY_PULLERS")
 QUAY_CLAIM_NAME = os.getenv("KC_QUAY_GROUP_CLAIM")
 
-################### Keycloak Section ############################
-
+# BOOTSTRAP MODE: "reconcile" (object by object) or "import" (a single partial import)
+BOOTSTRAP_MODE = os.getenv("KC_BOOTSTRAP_MODE", "reconcile")
+# What the partial import does with existing objects: SKIP, OVERWRITE or FAIL
+IMPORT_IF_EXISTS = os.getenv("KC_IMPORT_IF_EXISTS", "SKIP")
+# How MinIO is restarted when its identity provider changes: service, rollout or never
+MINIO_RESTART_POLICY = os.getenv("MINIO_RESTART_POLICY", "service")
+MINIO_WORKLOAD = os.getenv("MINIO_WORKLOAD", "statefulset/minio")
+# Number of bootstrap steps running concurrently
+BOOTSTRAP_WORKERS = int(os.getenv("KC_BOOTSTRAP_WORKERS", "8"))
 
-# Function to initialize Keycloak Admin client
-def initialize_keycloak_admin():
-    return KeycloakAdmin(
-        server_url=KEYCLOAK_URL,
-        username=KEYCLOAK_ADMIN_USERNAME,
-        password=KEYCLOAK_ADMIN_PASSWORD,
-        realm_name=KEYCLOAK_REALM,
-        verify=False,
-    )
-
-
-def create_administrative_user_spec(keycloak_admin: KeycloakAdmin):
-    
-    # Define the new user attribute to be added
-    new_attribute = {
-        "name": "is_admin",
-        "displayName": "Is Administrator",
-        "validations": {},
-        "annotations": {},
-        "permissions": {
-            "view": [
-                "admin"
-            ],
-            "edit": [
-                "admin"
-            ]
-        },
-        "multivalued": False
-    }
+################### Keycloak Section ############################
 
-    # Retrieve the existing realm user profile which holds the attributes list
-    profile = keycloak_admin.get_realm_users_profile()
-    attributes = profile.get("attributes", [])
 
-    # Check if an attribute with the same name already exists in the list
-    if any(attr.get("name") == new_attribute["name"] for attr in attributes):
-        print(f'Attribute "{new_attribute["name"]}" already exists in realm "{KEYCLOAK_REALM}".')
-    else:
-        # Append the new attribute and update the realm configuration
-        attributes.append(new_attribute)
-        keycloak_admin.update_realm_users_profile({"attributes": attributes})
-        print(f'User attribute "{new_attribute["name"]}" created successfully.')
+# The admin token, shared by every admin client of the process and refreshed before it expires
+admin_tokens = TokenProvider(
+    KEYCLOAK_URL,
+    KEYCLOAK_REALM,
+    username=KEYCLOAK_ADMIN_USERNAME,
+    password=KEYCLOAK_ADMIN_PASSWORD,
+    verify=False,
+)
 
 
-def create_realm_role(keycloak_admin, role_name):
-    realm_role = {
+# Function to initialize Keycloak Admin client
+def initialize_keycloak_admin():
+    return KeycloakAdmin(connection=admin_tokens.connection())
+
+
+# The user attribute marking the administrators of STELAR
+ADMIN_ATTRIBUTE = {
+    "name": "is_admin",
+    "displayName": "Is Administrator",
+    "validations": {},
+    "annotations": {},
+    "permissions": {
+        "view": [
+            "admin"
+        ],
+        "edit": [
+            "admin"
+        ]
+    },
+    "multivalued": False
+}
+
+
+def realm_role_representation(role_name):
+    return {
         "name": role_name,
         "composite": True,
         "clientRole": False,
         "containerId": KEYCLOAK_REALM,
     }
-    keycloak_admin.create_realm_role(realm_role, skip_exists=True)
-
-    return role_name
 
 
-# Function to create a client
-def create_client(keycloak_admin, client_name, home_url, root_url):
+# Representation of a client; the client roles and client scopes are given by name
+def client_representation(
+    client_name, home_url, root_url, service_account=False, roles=(), default_scopes=(), optional_scopes=()
+):
     client_representation = {
         "clientId": client_name,
         "enabled": True,
@@ -111,17 +131,18 @@ def create_client(keycloak_admin, client_name, home_url, root_url):
         "redirectUris": ["*"],
         "attributes": {"post.logout.redirect.uris": "+"},
         "directAccessGrantsEnabled": True,
+        "roles": list(roles),
+        "defaultClientScopes": list(default_scopes),
+        "optionalClientScopes": list(optional_scopes),
     }
-
-    client_id = keycloak_admin.create_client(client_representation, skip_exists=True)
-    print(f'Client "{client_name}" created successfully with ID: {client_id}')
-    return client_id
+    if service_account:
+        client_representation["serviceAccountsEnabled"] = True
+        client_representation["authorizationServicesEnabled"] = True
+    return client_representation
 
 
-# Function creating a keycloak client scope
-def create_client_scope(
-    keycloak_admin,
-    client_id,
+# Representation of a keycloak client scope, with the protocol mapper of its claim
+def client_scope_representation(
     name,
     claim_name,
     mapper_name,
@@ -134,7 +155,6 @@ def create_client_scope(
         "name": mapper_name,
         "protocol": "openid-connect",
         "protocolMapper": mapper_type,
-        "consentRequired": False,
         "config": {
             "claim.name": claim_name,
             "jsonType.label": type,
@@ -148,52 +168,66 @@ def create_client_scope(
         protocol_mapper["config"]["user.attribute"] = attribute_name
         protocol_mapper["config"]["userinfo.token.claim"] = "true"
 
-    scope = {
+    return {
         "name": name,
         "protocol": "openid-connect",
+        "protocolMappers": [protocol_mapper],
     }
-    try:
-        client_scope_id = keycloak_admin.create_client_scope(scope, skip_exists=True)
-        keycloak_admin.add_mapper_to_client_scope(client_scope_id, protocol_mapper)
-
-        keycloak_admin.add_client_default_client_scope(
-            client_id,
-            client_scope_id,
-            {
-                "realm": "master",
-                "client": MINIO_CLIENT,
-                "clientScopeId": "minio_auth_scope",
-            },
-        )
-    except Exception as e:
-        print(f"Error creating client scope: {e}")
 
 
-# Function to create a keycloak client role
-def create_client_role(keycloak_admin, client_name, client_id, role_name):
-    print(client_id)
-    keycloak_admin.create_client_role(client_id, {"name": role_name}, skip_exists=True)
-    print(f'Role "{role_name}" created successfully for client "{client_name}".')
-    return role_name
+# The desired state of the realm accommodating STELAR (see reconcile.py)
+def realm_spec():
+    return {
+        "realmRoles": [
+            # The realm roles for registry access
+            realm_role_representation(QUAY_PUSHERS_ROLE),
+            realm_role_representation(QUAY_PULLERS_ROLE),
+        ],
+        "clientScopes": [
+            client_scope_representation("minio_auth_scope", "policy", "client_role_mapper"),
+            # The scope for mapping the registry roles in the token
+            client_scope_representation(
+                "registry_scope",
+                QUAY_CLAIM_NAME,
+                "registry_mapper",
+                "oidc-usermodel-realm-role-mapper",
+            ),
+            client_scope_representation(
+                "admin_attr_scope",
+                "is_admin",
+                "admin_attr_mapper",
+                "oidc-usermodel-attribute-mapper",
+                "is_admin",
+                "boolean",
+                "false",
+            ),
+        ],
+        "clients": [
+            client_representation(
+                API_CLIENT,
+                API_CLIENT_HOME_URL,
+                API_CLIENT_ROOT_URL,
+                service_account=True,
+                default_scopes=[s for s in API_CLIENT_SCOPES if s not in API_OPTIONAL_SCOPES],
+                optional_scopes=[s for s in API_CLIENT_SCOPES if s in API_OPTIONAL_SCOPES],
+            ),
+            client_representation(
+                MINIO_CLIENT,
+                MINIO_CLIENT_HOME_URL,
+                MINIO_CLIENT_ROOT_URL,
+                service_account=True,
+                roles=["consoleAdmin"],
+                default_scopes=["minio_auth_scope"],
+            ),
+            client_representation(CKAN_CLIENT, CKAN_CLIENT_HOME_URL, CKAN_CLIENT_ROOT_URL),
+        ],
+        "userProfileAttributes": [ADMIN_ATTRIBUTE],
+    }
 
 
-# Enables service account to a client in keycloak
-def enable_service_account(keycloak_admin, client_id):
+# Assigns the realm admin role to the service account of a client
+def assign_service_account_admin_role(keycloak_admin, client_id, role):
     try:
-        # Retrieve the client configuration
-        client_representation = keycloak_admin.get_client(client_id)
-
-        # Update the configuration to enable service accounts
-        client_representation["serviceAccountsEnabled"] = True
-        client_representation["authorizationServicesEnabled"] = True
-
-        # Update the client with the modified configuration
-        keycloak_admin.update_client(client_id, client_representation)
-        print(f"Service account enabled for client with ID: {client_id}")
-
-        role = keycloak_admin.get_realm_role("admin")
-        print(f"Retrieved existing role: {role}")
-
         service_account_user = keycloak_admin.get_client_service_account_user(client_id)
         service_account_user_id = service_account_user["id"]
 
@@ -202,284 +236,374 @@ def enable_service_account(keycloak_admin, client_id):
         print(f"Admin role assigned to service account for client ID: {client_id}")
 
     except KeycloakPostError as e:
-        print(f"Failed to enable service account: {e}")
+        print(f"Failed to assign the admin role to the service account: {e}")
         raise
 
 
-# creates an open id configuration between keycloak and minIO
-def minio_openID_config(keycloak_admin, client_id):
-    # Base command for setting the alias
-    alias_command = (
-        "mc alias set myminio "
-        + os.getenv("MINIO_API_DOMAIN")
-        + " "
-        + os.getenv("MINIO_ROOT_USER")
-        + " "
-        + os.getenv("MINIO_ROOT_PASSWORD")
+# Creates or updates the objects of the realm spec
+def setup_realm(keycloak_admin):
+    if BOOTSTRAP_MODE == "import":
+        # Create the clients and roles with a single partial import, and read back their secrets
+        return bootstrap(keycloak_admin, realm_spec(), IMPORT_IF_EXISTS)
+
+    # Create or update the clients, roles, scopes and user attributes that are missing or changed
+    reconciler = Reconciler(keycloak_admin, realm_spec())
+    reconciler.reconcile(BOOTSTRAP_WORKERS)
+    clients = {}
+    for client_name in (API_CLIENT, MINIO_CLIENT, CKAN_CLIENT):
+        client_id = reconciler.client_uuid(client_name)
+        clients[client_name] = {
+            "id": client_id,
+            "secret": keycloak_admin.get_client_secrets(client_id)["value"],
+        }
+    return clients
+
+
+# Publishes the secret of a client to the namespace
+def apply_client_secret(client_name, client_secret):
+    print(client_name + " Secret:", client_secret)
+
+    secret_name = client_name + "-client-secret"
+    secret = create_k8s_secret(
+        secret_name, KUBE_NAMESPACE, {"secret": client_secret}
     )
+    apply_secret_to_cluster(secret)
 
-    # Check if MINIO_INSECURE_MC is set to True and append --insecure. Used for minikube deployment
-    if os.getenv("MINIO_INSECURE_MC", "False").lower() == "true":
-        alias_command += " --insecure"
-
-    subprocess.run(alias_command, shell=True, check=True)
-
-    client_secret = keycloak_admin.get_client_secrets(client_id)
-    client_secr_value = client_secret.get("value")
-
-    command = (
-        "mc idp openid add myminio stelar-sso "
-        "client_id="
-        + MINIO_CLIENT
-        + " client_secret="
-        + client_secr_value
-        + " config_url="
-        + KEYCLOAK_URL
-        + "/realms/master/.well-known/openid-configuration "
-        'claim_name=policy display_name="STELAR SSO" scopes=openid '
-        "redirect_uri=" + os.getenv("KC_MINIO_CLIENT_REDIRECT")
-    )
 
-    # Check if MINIO_INSECURE_MC is set to True and append --insecure. Used for minikube deployment
-    if os.getenv("MINIO_INSECURE_MC", "False").lower() == "true":
-        print("Entering insecure mode...")
-        command += " --insecure"
+# The attribute and the details of the admin user
+def admin_user_settings():
+    return {
+        "attributes": {"is_admin": True},
+        "firstName": "STELAR",
+        "lastName": "Administrator",
+        "email": KEYCLOAK_ADMIN_EMAIL,
+    }
+
+
+# Sets the attribute and the details of the admin user
+def configure_admin_user(keycloak_admin, admin_id):
+    admin_rep = keycloak_admin.get_user(admin_id)
+    admin_rep.update(admin_user_settings())
+    keycloak_admin.update_user(admin_id, admin_rep)
+    return admin_rep
 
-    print("Executing IDP setup command...")
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
 
-    print("Output:", result.stdout)
-    if result.stderr:
-        print("Error:", result.stderr)
+# The settings of the realm accomodating STELAR
+REALM_SETTINGS = {
+    "displayName": "STELAR SSO",
+    "accessTokenLifespan": int(os.getenv("KC_ACCESS_TOKEN_LIFESPAN", "10800")),
+    "loginTheme": "keycloakify-starter",
+}
 
-    # Restart MinIO service and capture output
-    print("Attempting to restart MinIO service...")
-    restart_command = "mc admin service restart myminio"
-    # Check if MINIO_INSECURE_MC is set to True and append --insecure
-    if os.getenv("MINIO_INSECURE_MC", "False").lower() == "true":
-        print("Entering insecure mode...")
-        restart_command += " --insecure"
 
-    restart_result = subprocess.run(
-        f'script -q -c "{restart_command}"', shell=True, check=True
-    )
+# Sets the configuration for the realm accomodating STELAR
+def configure_realm(keycloak_admin):
+    realm_rep = keycloak_admin.get_realm(KEYCLOAK_REALM)
+    realm_rep.update(REALM_SETTINGS)
+    keycloak_admin.update_realm(KEYCLOAK_REALM, realm_rep)
+
+
+# creates an open id configuration between keycloak and minIO
+# MinIO is only reconfigured and restarted when the configuration has changed
+def minio_openID_config(minio: MinioConnection, keycloak_admin, client_id):
+    idp_config = minio_idp_config(keycloak_admin.get_client_secrets(client_id).get("value"))
+    if not minio_idp_changed(minio, idp_config):
+        print(f"MinIO identity provider is up to date ({idp_config['comment']}), no restart needed.")
+        return False
+
+    print("Executing IDP setup...")
+    result = minio.set_openid_provider("stelar-sso", idp_config)
+    print("Output:", result)
+
+    # Restart MinIO service, to enable the identity provider
+    restart_minio(minio)
+    return True
+
+
+# The configuration of the identity provider of MinIO, stamped with its fingerprint
+def minio_idp_config(client_secr_value):
+    idp_config = {
+        "client_id": MINIO_CLIENT,
+        "client_secret": client_secr_value,
+        "config_url": KEYCLOAK_URL + "/realms/master/.well-known/openid-configuration",
+        "claim_name": "policy",
+        "display_name": "STELAR SSO",
+        "scopes": "openid",
+        "redirect_uri": os.getenv("KC_MINIO_CLIENT_REDIRECT"),
+    }
+    # The fingerprint covers the secret, which MinIO may not return as set
+    idp_config["comment"] = config_fingerprint(idp_config)
+    return idp_config
 
-    print("Restart Command Output:", restart_result.stdout)
-    if restart_result.stderr:
-        print("Restart Command Error:", restart_result.stderr)
 
+# Checks whether the identity provider of MinIO differs from the given configuration
+def minio_idp_changed(minio: MinioConnection, idp_config):
+    current = minio.openid_provider("stelar-sso")
+    return current is None or any(
+        current.get(key) != value for key, value in idp_config.items() if key != "client_secret"
+    )
 
-def create_bucket(bucket_name: str):
-    # Create the bucket using MinIO client
-    command = f"mc mb myminio/{bucket_name}"
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
 
-    if result.returncode == 0:
-        print(f"Bucket '{bucket_name}' created successfully.")
+# Restarts MinIO according to MINIO_RESTART_POLICY:
+#   service: restart through the admin API (every server at once)
+#   rollout: rolling restart of the MinIO workload (MINIO_WORKLOAD, e.g. statefulset/minio),
+#            keeping a replicated MinIO serving throughout
+#   never:   leave the restart to the operator
+def restart_minio(minio: MinioConnection):
+    if MINIO_RESTART_POLICY == "never":
+        print("MinIO configuration changed; a restart is pending (MINIO_RESTART_POLICY=never).")
+    elif MINIO_RESTART_POLICY == "rollout":
+        kind, name = MINIO_WORKLOAD.split("/")
+        patch = {
+            "spec": {
+                "template": {
+                    "metadata": {
+                        "annotations": {"kubectl.kubernetes.io/restartedAt": datetime.now(timezone.utc).isoformat()}
+                    }
+                }
+            }
+        }
+        apps = client.AppsV1Api()
+        if kind == "statefulset":
+            apps.patch_namespaced_stateful_set(name, KUBE_NAMESPACE, patch)
+        else:
+            apps.patch_namespaced_deployment(name, KUBE_NAMESPACE, patch)
+        print(f"Rolling restart of {MINIO_WORKLOAD} requested.")
     else:
-        print(f"Failed to create bucket '{bucket_name}': {result.stderr}")
+        print("Attempting to restart MinIO service...")
+        minio.restart()
+        print("MinIO service restarted.")
 
 
-################### Secret Creation ############################
+def create_bucket(minio: MinioConnection, bucket_name: str):
+    try:
+        if minio.make_bucket(bucket_name):
+            print(f"Bucket '{bucket_name}' created successfully.")
+        else:
+            print(f"Bucket '{bucket_name}' already exists.")
+    except MinioSetupError as e:
+        print(f"Failed to create bucket '{bucket_name}': {e}")
 
 
-def create_k8s_secret(secret_name, namespace, data_dict):
-    # Encode data to base64 as required by Kubernetes secrets
-    encoded_data = {
-        k: base64.b64encode(v.encode("utf-8")).decode("utf-8")
-        for k, v in data_dict.items()
-    }
+################### Secret Creation ############################
 
-    # Define the secret structure
-    secret = {
-        "apiVersion": "v1",
-        "kind": "Secret",
-        "metadata": {
-            "name": secret_name,
-            "namespace": namespace,
-        },
-        "type": "Opaque",
-        "data": encoded_data,
-    }
+# The Secrets produced by the bootstrap steps, applied together once they are done
+k8s_objects = Applier()
 
-    # Output YAML for verification
-    print("Generated Kubernetes Secret YAML:")
-    print(yaml.dump(secret))
 
-    return secret
+def create_k8s_secret(secret_name, namespace, data_dict):
+    return k8s_apply.secret(secret_name, namespace, data_dict)
 
 
 # Function to apply the secret to the Kubernetes cluster
 def apply_secret_to_cluster(secret):
-    # Initialize Kubernetes client
-    v1 = client.CoreV1Api()
+    k8s_objects.add(secret)
+    print(f"Secret '{secret['metadata']['name']}' will be applied to namespace '{secret['metadata']['namespace']}'.")
 
-    # Create the secret in the specified namespace
-    try:
-        v1.create_namespaced_secret(
-            namespace=secret["metadata"]["namespace"], body=secret
-        )
-        print(
-            f"Secret '{secret['metadata']['name']}' created in namespace '{secret['metadata']['namespace']}'."
-        )
-    except client.exceptions.ApiException as e:
-        if e.status == 409:
-            print(f"Secret '{secret['metadata']['name']}' already exists.")
-        else:
-            print(f"Failed to create secret: {e}")
 
+############################## PLAN ################################
 
-############################## MAIN ################################
 
+# Computes the changes the bootstrap would make, reading Keycloak, MinIO and the namespace only
+def plan(keycloak_admin):
+    changes = [
+        dict(kind=c.kind, name=c.name, action=c.action, **({"payload": c.payload} if c.action != "noop" else {}))
+        for c in Reconciler(keycloak_admin, realm_spec()).plan()
+    ]
 
-def main():
+    def change(kind, name, up_to_date, exists=True):
+        action = "noop" if up_to_date else "update" if exists else "create"
+        changes.append({"kind": kind, "name": name, "action": action})
 
-    keycloak_admin = initialize_keycloak_admin()
+    realm_rep = keycloak_admin.get_realm(KEYCLOAK_REALM)
+    change("realm-settings", KEYCLOAK_REALM, matches(REALM_SETTINGS, realm_rep))
 
-    clients_name_list = [
-        {
-            "name": API_CLIENT,
-            "home_url": API_CLIENT_HOME_URL,
-            "root_url": API_CLIENT_ROOT_URL,
-        },
-        {
-            "name": MINIO_CLIENT,
-            "home_url": MINIO_CLIENT_HOME_URL,
-            "root_url": MINIO_CLIENT_ROOT_URL,
-        },
-        {
-            "name": CKAN_CLIENT,
-            "home_url": CKAN_CLIENT_HOME_URL,
-            "root_url": CKAN_CLIENT_ROOT_URL,
-        },
-    ]
-    for client in clients_name_list:
-        print(client)
+    admin_id = keycloak_admin.get_user_id("admin")
+    admin_rep = keycloak_admin.get_user(admin_id) if admin_id else None
+    change("admin-user", "admin", matches(admin_user_settings(), admin_rep))
+
+    # The clients that do not exist yet get new secrets, so whatever depends on them changes too
+    clients = {c["clientId"]: c for c in keycloak_admin.get_clients()}
+    secrets = {
+        name: keycloak_admin.get_client_secrets(clients[name]["id"]).get("value")
+        for name in (API_CLIENT, MINIO_CLIENT, CKAN_CLIENT) if name in clients
+    }
+
+    console_admin = set()
+    if admin_id and MINIO_CLIENT in clients:
+        console_admin = {r["name"] for r in keycloak_admin.get_client_roles_of_user(admin_id, clients[MINIO_CLIENT]["id"])}
+    change("role-mapping", f"admin/{MINIO_CLIENT}/consoleAdmin", "consoleAdmin" in console_admin, False)
+    for client_name in (API_CLIENT, MINIO_CLIENT):
+        realm_roles, minio_roles = set(), set()
+        if client_name in clients:
+            account_id = keycloak_admin.get_client_service_account_user(clients[client_name]["id"])["id"]
+            realm_roles = {r["name"] for r in keycloak_admin.get_realm_roles_of_user(account_id)}
+            if client_name == API_CLIENT and MINIO_CLIENT in clients:
+                minio_roles = {
+                    r["name"] for r in keycloak_admin.get_client_roles_of_user(account_id, clients[MINIO_CLIENT]["id"])
+                }
+        # A mapping that is not there is created
+        change("role-mapping", f"service-account-{client_name}/admin", "admin" in realm_roles, False)
+        if client_name == API_CLIENT:
+            change(
+                "role-mapping", f"service-account-{client_name}/{MINIO_CLIENT}/consoleAdmin",
+                "consoleAdmin" in minio_roles, False,
+            )
+
+    minio = MinioConnection.from_env()
+    idp_changed = MINIO_CLIENT not in secrets or minio_idp_changed(minio, minio_idp_config(secrets[MINIO_CLIENT]))
+    change("minio-idp", "stelar-sso", not idp_changed)
+    bucket_exists = minio.s3.bucket_exists("registry")
+    change("bucket", "registry", bucket_exists, bucket_exists)
+
+    planned = Applier()
+    for client_name, client_secret in secrets.items():
+        planned.add(create_k8s_secret(client_name + "-client-secret", KUBE_NAMESPACE, {"secret": client_secret}))
+    if admin_id:
+        planned.add(create_k8s_secret("stelar-admin-id", KUBE_NAMESPACE, {"id": admin_id}))
+    actions = {"created": "create", "updated": "update", "unchanged": "noop"}
+    for (kind, namespace, name), outcome in sorted(planned.plan().items()):
+        changes.append({"kind": kind, "name": f"{namespace}/{name}", "action": actions[outcome]})
+    for client_name in {API_CLIENT, MINIO_CLIENT, CKAN_CLIENT} - set(secrets):
+        changes.append({"kind": "Secret", "name": f"{KUBE_NAMESPACE}/{client_name}-client-secret", "action": "create"})
+
+    summary = Counter(c["action"] for c in changes)
+    return {
+        "realm": KEYCLOAK_REALM,
+        "changes": changes,
+        "summary": {action: summary[action] for action in ("create", "update", "noop")},
+        "apply_needed": summary["noop"] < len(changes),
+        "minio_restart": idp_changed and MINIO_RESTART_POLICY != "never",
+    }
 
-        client_id = create_client(
-            keycloak_admin, client["name"], client["home_url"], client["root_url"]
-        )
 
-        # keycloak API client initializations
-        if client["name"] == API_CLIENT:
-            enable_service_account(keycloak_admin, client_id)
-
-        # keycloak MinIO client initializations
-        if client["name"] == MINIO_CLIENT:
-            enable_service_account(keycloak_admin, client_id)
-
-            try:
-                create_client_scope(
-                    keycloak_admin,
-                    client_id,
-                    "minio_auth_scope",
-                    "policy",
-                    "client_role_mapper",
-                )
-
-            except KeycloakPostError as err:
-                print("This client scope already Exists")
-
-            try:
-                scopeData = keycloak_admin.get_client_scope_by_name("minio_auth_scope")
-                api_client_id = keycloak_admin.get_client_id(API_CLIENT)
-                keycloak_admin.add_client_default_client_scope(
-                    api_client_id,
-                    scopeData["id"],
-                    {
-                        "realm": "master",
-                        "client": API_CLIENT,
-                        "clientScopeId": "minio_auth_scope",
-                    },
-                )
-            except:
-                print("Scope already assigned")
-
-            create_client_role(keycloak_admin, MINIO_CLIENT, client_id, "consoleAdmin")
-            keycloak_admin.assign_client_role(
-                keycloak_admin.get_user_id("admin"),
-                client_id,
-                keycloak_admin.get_client_role(client_id, "consoleAdmin"),
+############################## MAIN ################################
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bootstrap the STELAR realm, its MinIO identity provider and secrets.")
+    parser.add_argument(
+        "--plan", action="store_true", help="Print the changes the bootstrap would make as JSON, without making them"
+    )
+    args = parser.parse_args(argv)
+
+    config.load_incluster_config()
+
+    if args.plan:
+        # The log goes to stderr, so that stdout carries only the change set
+        with contextlib.redirect_stdout(sys.stderr):
+            wait_for_keycloak(
+                KEYCLOAK_URL, KEYCLOAK_REALM, KEYCLOAK_ADMIN_USERNAME, KEYCLOAK_ADMIN_PASSWORD, KEYCLOAK_READY_TIMEOUT
             )
+            change_set = plan(initialize_keycloak_admin())
+        print(json.dumps(change_set, indent=2))
+        return
 
-        client_secret_info = keycloak_admin.get_client_secrets(client_id)
-        client_secret = client_secret_info["value"]
+    # The timings of the steps are published to the bootstrap timeline, even if a step fails
+    ledger = Ledger("keycloak-init")
+    try:
+        bootstrap_keycloak(ledger)
+    finally:
+        ledger.publish(KUBE_NAMESPACE)
 
-        print(client["name"] + " Secret:", client_secret)
 
-        secret_name = client["name"] + "-client-secret"
-        secret = create_k8s_secret(
-            secret_name, KUBE_NAMESPACE, {"secret": client_secret}
+def bootstrap_keycloak(ledger):
+    # Wait for Keycloak to boot, instead of crashing and being restarted by Kubernetes
+    with ledger.step("keycloak-ready"):
+        wait_for_keycloak(
+            KEYCLOAK_URL, KEYCLOAK_REALM, KEYCLOAK_ADMIN_USERNAME, KEYCLOAK_ADMIN_PASSWORD, KEYCLOAK_READY_TIMEOUT
         )
-        apply_secret_to_cluster(secret)
-
-    minio_client_id = keycloak_admin.get_client_id(MINIO_CLIENT)
-    client_role = keycloak_admin.get_client_role(minio_client_id, "consoleAdmin")
-    print(f"Retrieved existing role: {client_role}")
+    keycloak_admin = initialize_keycloak_admin()
 
-    api_client_id = keycloak_admin.get_client_id(API_CLIENT)
-    service_account_user = keycloak_admin.get_client_service_account_user(api_client_id)
-    service_account_user_id = service_account_user["id"]
+    # Independent steps run concurrently; every step waits for the steps listed in its 'after'
+    graph = TaskGraph(BOOTSTRAP_WORKERS)
+    results = graph.results
+
+    def client_id(client_name):
+        return results["realm"][client_name]["id"]
+
+    graph.add("realm", setup_realm, keycloak_admin)
+    graph.add("admin-role", keycloak_admin.get_realm_role, "admin")
+    graph.add("admin-user-id", keycloak_admin.get_user_id, "admin")
+
+    # Assign the realm admin role to the service accounts of the API and MinIO clients
+    for client_name in (API_CLIENT, MINIO_CLIENT):
+        graph.add(
+            f"service-account-admin {client_name}",
+            lambda client_name=client_name: assign_service_account_admin_role(
+                keycloak_admin, client_id(client_name), results["admin-role"]
+            ),
+            after=["realm", "admin-role"],
+        )
 
-    # Assign the admin role to the service account user
-    keycloak_admin.assign_client_role(
-        service_account_user_id, minio_client_id, [client_role]
-    )
-    print(
-        f"ConsoleAdmin role assigned to service account for client ID: {api_client_id}"
+    # Assign the consoleAdmin role of MinIO to the admin user and the service account of the API client
+    graph.add(
+        "console-admin-role",
+        lambda: keycloak_admin.get_client_role(client_id(MINIO_CLIENT), "consoleAdmin"),
+        after=["realm"],
     )
-
-    # minio_client_id = keycloak_admin.get_client_id(MINIO_CLIENT)
-    minio_openID_config(keycloak_admin, minio_client_id)
-
-    # Create the realm roles for registry access and the scope for mapping them in the token
-    create_realm_role(keycloak_admin, QUAY_PUSHERS_ROLE)
-    create_realm_role(keycloak_admin, QUAY_PULLERS_ROLE)
-    create_client_scope(
-        keycloak_admin,
-        api_client_id,
-        "registry_scope",
-        QUAY_CLAIM_NAME,
-        "registry_mapper",
-        "oidc-usermodel-realm-role-mapper",
+    graph.add(
+        "console-admin admin",
+        lambda: keycloak_admin.assign_client_role(
+            results["admin-user-id"], client_id(MINIO_CLIENT), [results["console-admin-role"]]
+        ),
+        after=["console-admin-role", "admin-user-id"],
     )
-
-    # Create the administrative user spec
-    create_administrative_user_spec(keycloak_admin)
-    create_client_scope(
-        keycloak_admin,
-        api_client_id,
-        "admin_attr_scope",
-        "is_admin",
-        "admin_attr_mapper",
-        "oidc-usermodel-attribute-mapper",
-        "is_admin",
-        "boolean",
-        "false",
+    graph.add(
+        f"console-admin {API_CLIENT}",
+        lambda: keycloak_admin.assign_client_role(
+            keycloak_admin.get_client_service_account_user(client_id(API_CLIENT))["id"],
+            client_id(MINIO_CLIENT),
+            [results["console-admin-role"]],
+        ),
+        after=["console-admin-role"],
     )
 
-    # Set the attribute for the admin user
-    admin_id = keycloak_admin.get_user_id("admin")
-    admin_rep = keycloak_admin.get_user(admin_id)
-    admin_rep['attributes'] = {'is_admin': True}  
-    admin_rep['firstName'] = 'STELAR'
-    admin_rep['lastName'] = 'Administrator'
-    admin_rep['email'] = KEYCLOAK_ADMIN_EMAIL
-    keycloak_admin.update_user(admin_id, admin_rep)
+    for client_name in (API_CLIENT, MINIO_CLIENT, CKAN_CLIENT):
+        graph.add(
+            f"client-secret {client_name}",
+            lambda client_name=client_name: apply_client_secret(
+                client_name, results["realm"][client_name]["secret"]
+            ),
+            after=["realm"],
+        )
 
+    minio = MinioConnection.from_env()
+    graph.add(
+        "minio-idp",
+        lambda: minio_openID_config(minio, keycloak_admin, client_id(MINIO_CLIENT)),
+        after=["realm"],
+    )
+    # Create the registry bucket, once MinIO is back from its restart
+    graph.add("registry-bucket", create_bucket, minio, "registry", after=["minio-idp"])
+
+    # The admin user gets the is_admin attribute, once the user profile declares it
+    graph.add(
+        "admin-user",
+        lambda: configure_admin_user(keycloak_admin, results["admin-user-id"]),
+        after=["realm", "admin-user-id"],
+    )
     # Create the secret for the admin user ID to be available to the namespace
     # This ensures that the user created as CKAN admin has the same UUID as the Keycloak Admin.
-    apply_secret_to_cluster(create_k8s_secret("stelar-admin-id", KUBE_NAMESPACE, {"id":admin_rep['id']}))
+    graph.add(
+        "admin-id-secret",
+        lambda: apply_secret_to_cluster(
+            create_k8s_secret("stelar-admin-id", KUBE_NAMESPACE, {"id": results["admin-user"]["id"]})
+        ),
+        after=["admin-user"],
+    )
 
-    # Set the configuration for the realm accomodating STELAR
-    realm_rep = keycloak_admin.get_realm(KEYCLOAK_REALM)
-    realm_rep["displayName"] = "STELAR SSO"
-    realm_rep["accessTokenLifespan"] = 10800
-    realm_rep["loginTheme"] = "keycloakify-starter"
-    keycloak_admin.update_realm(KEYCLOAK_REALM, realm_rep)
+    graph.add("realm-settings", configure_realm, keycloak_admin, after=["realm"])
+
+    # Apply the collected Secrets; only those that are new or changed are sent
+    secret_steps = [step for step in graph.tasks if step.startswith("client-secret ")] + ["admin-id-secret"]
+    graph.add("k8s-apply", k8s_objects.apply, after=secret_steps)
 
-    # Create the registry bucket
-    create_bucket("registry")
+    try:
+        graph.run()
+    finally:
+        graph.report()
+        ledger.extend(graph.timings.values())
 
 
 if __name__ == "__main__":
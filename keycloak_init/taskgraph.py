@@ -0,0 +1,137 @@
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+################### Bootstrap Task Graph ############################
+#
+# The steps of a bootstrap are added to a graph along with the steps they
+# depend on. Steps whose dependencies are done run concurrently on a thread
+# pool, so the total time is that of the critical path rather than the sum
+# of all steps. If a step fails, the steps depending on it are skipped, the
+# independent ones still run, and the error is raised at the end.
+#####################################################################
+
+# outcome: 'ok', 'failed' or 'skipped'; start and end are epoch seconds (None if skipped)
+StepTiming = namedtuple("StepTiming", ["name", "start", "end", "outcome", "after"])
+
+
+class TaskGraph:
+    """
+    A set of steps with dependencies, run on a thread pool.
+
+    Args:
+        max_workers (int): The maximum number of steps running at the same time.
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.tasks = {}
+        self.results = {}
+        self.timings = {}
+
+    def add(self, name, fn, *args, after=(), **kwargs):
+        """
+        Adds a step to the graph.
+
+        Args:
+            name (str): The unique name of the step.
+            fn (callable): The function of the step, called with the given arguments; its
+                return value is kept in results[name].
+            after (list): The names of the steps that must complete before this one.
+
+        Returns:
+            str: The name of the step, to be used in the 'after' of other steps.
+        """
+        if name in self.tasks:
+            raise ValueError(f"Step {name} is already in the graph")
+        missing = [dep for dep in after if dep not in self.tasks]
+        if missing:
+            raise ValueError(f"Step {name} depends on unknown steps: {missing}")
+        self.tasks[name] = (fn, args, kwargs, tuple(after))
+        return name
+
+    def _timed(self, name, fn, args, kwargs):
+        start = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.timings[name] = StepTiming(name, start, time.time(), None, self.tasks[name][3])
+
+    def run(self):
+        """
+        Runs all the steps, each as soon as the steps it depends on are done.
+
+        Returns:
+            dict: The results of the steps by name.
+
+        Raises:
+            The exception of the first step that failed, once no more steps can run.
+        """
+        pending = dict(self.tasks)
+        done, failed = set(), {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                for name, (fn, args, kwargs, after) in list(pending.items()):
+                    if any(dep in failed for dep in after):
+                        # Skipped steps count as failed, so that their own dependents are skipped too
+                        failed[name] = None
+                        self.timings[name] = StepTiming(name, None, None, "skipped", after)
+                        print(f"[skip] {name}: a step it depends on failed")
+                        del pending[name]
+                    elif all(dep in done for dep in after):
+                        running[pool.submit(self._timed, name, fn, args, kwargs)] = name
+                        del pending[name]
+                if not running:
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    timing = self.timings[name]
+                    try:
+                        self.results[name] = future.result()
+                        done.add(name)
+                        self.timings[name] = timing._replace(outcome="ok")
+                    except Exception as e:
+                        failed[name] = e
+                        self.timings[name] = timing._replace(outcome="failed")
+                        print(f"[fail] {name}: {e}")
+
+        errors = [error for error in failed.values() if error is not None]
+        if errors:
+            raise errors[0]
+        return self.results
+
+    def critical_path(self):
+        """
+        Returns the chain of steps that determined the total time, ending with the step that finished last.
+        """
+        finished = {name: t for name, t in self.timings.items() if t.end is not None}
+        if not finished:
+            return []
+        path = [max(finished.values(), key=lambda t: t.end)]
+        while True:
+            deps = [finished[dep] for dep in path[-1].after if dep in finished]
+            if not deps:
+                break
+            path.append(max(deps, key=lambda t: t.end))
+        return [t.name for t in reversed(path)]
+
+    def report(self):
+        """
+        Prints the duration of every step, in the order they started, and the critical path.
+        """
+        timings = sorted(self.timings.values(), key=lambda t: (t.start is None, t.start or 0))
+        started = [t.start for t in timings if t.start is not None]
+        if not started:
+            return
+        origin = min(started)
+        end = max(t.end for t in timings if t.end is not None)
+        print(f"{'step':<32} {'start (s)':>9} {'time (s)':>9}  outcome")
+        for t in timings:
+            if t.start is None:
+                print(f"{t.name:<32} {'-':>9} {'-':>9}  {t.outcome}")
+            else:
+                print(f"{t.name:<32} {t.start - origin:>9.2f} {t.end - t.start:>9.2f}  {t.outcome}")
+        print(f"Total: {end - origin:.2f}s, critical path: {' -> '.join(self.critical_path())}")
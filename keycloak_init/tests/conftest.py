@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of the job are imported by their plain names, as in its image
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,122 @@
+from types import SimpleNamespace
+
+import pytest
+
+import k8s_apply
+from k8s_apply import HASH_ANNOTATION, Applier, ApplyError, config_map, content_hash, secret
+
+
+class FakeCoreV1Api:
+    """ Lists the existing objects, by kind and namespace. """
+
+    existing = {}
+
+    def _list(self, kind, namespace):
+        return SimpleNamespace(items=[
+            SimpleNamespace(metadata=SimpleNamespace(name=name, annotations=annotations))
+            for name, annotations in self.existing.get((kind, namespace), {}).items()
+        ])
+
+    def list_namespaced_secret(self, namespace):
+        return self._list("Secret", namespace)
+
+    def list_namespaced_config_map(self, namespace):
+        return self._list("ConfigMap", namespace)
+
+
+class FakeDynamicClient:
+    """ Records the applied objects, failing for the names in 'rejected'. """
+
+    applied = []
+    rejected = set()
+
+    def __init__(self, api_client):
+        self.resources = SimpleNamespace(get=lambda api_version, kind: kind)
+
+    def server_side_apply(self, resource, body, field_manager, force_conflicts):
+        if body["metadata"]["name"] in self.rejected:
+            raise k8s_apply.client.exceptions.ApiException(status=422, reason="Invalid")
+        self.applied.append((resource, body["metadata"]["name"]))
+
+
+@pytest.fixture(autouse=True)
+def fake_cluster(monkeypatch):
+    FakeCoreV1Api.existing = {}
+    FakeDynamicClient.applied = []
+    FakeDynamicClient.rejected = set()
+    monkeypatch.setattr(k8s_apply.client, "CoreV1Api", FakeCoreV1Api)
+    monkeypatch.setattr(k8s_apply.client, "ApiClient", lambda: None)
+    monkeypatch.setattr(k8s_apply.dynamic, "DynamicClient", FakeDynamicClient)
+
+
+def test_the_content_hash_ignores_the_metadata():
+    one = config_map("a", "ns", {"k": "v"})
+    other = dict(config_map("b", "other", {"k": "v"}), metadata={"labels": {"x": "y"}})
+    assert content_hash(one) == content_hash(other)
+    assert content_hash(one) != content_hash(config_map("a", "ns", {"k": "w"}))
+
+
+def test_objects_with_an_unchanged_hash_are_not_applied():
+    unchanged = config_map("same", "ns", {"k": "v"})
+    FakeCoreV1Api.existing = {
+        ("ConfigMap", "ns"): {"same": {HASH_ANNOTATION: content_hash(unchanged)}, "stale": None},
+    }
+    applier = Applier()
+    applier.add(unchanged)
+    applier.add(config_map("stale", "ns", {"k": "v"}))
+    applier.add(secret("new", "ns", {"password": "p"}))
+    expected = {
+        ("ConfigMap", "ns", "same"): "unchanged",
+        ("ConfigMap", "ns", "stale"): "updated",
+        ("Secret", "ns", "new"): "created",
+    }
+    assert applier.plan() == expected
+    assert FakeDynamicClient.applied == []
+    assert applier.apply() == expected
+    assert sorted(FakeDynamicClient.applied) == [("ConfigMap", "stale"), ("Secret", "new")]
+    assert applier.objects == []
+
+
+def test_nothing_is_sent_when_everything_is_unchanged(monkeypatch):
+    obj = secret("same", "ns", {"password": "p"})
+    FakeCoreV1Api.existing = {("Secret", "ns"): {"same": {HASH_ANNOTATION: content_hash(obj)}}}
+    monkeypatch.setattr(k8s_apply.dynamic, "DynamicClient", None)
+    applier = Applier()
+    applier.add(obj)
+    assert applier.apply() == {("Secret", "ns", "same"): "unchanged"}
+
+
+def test_the_last_object_added_under_a_name_wins():
+    applier = Applier()
+    applier.add(config_map("a", "ns", {"k": "old"}))
+    applier.add(config_map("a", "ns", {"k": "new"}))
+    applier.apply()
+    assert FakeDynamicClient.applied == [("ConfigMap", "a")]
+
+
+def test_failed_objects_raise_an_apply_error_after_the_others_are_applied():
+    FakeDynamicClient.rejected = {"bad"}
+    applier = Applier()
+    applier.add(config_map("bad", "ns", {"k": "v"}))
+    applier.add(config_map("good", "ns", {"k": "v"}))
+    with pytest.raises(ApplyError) as raised:
+        applier.apply()
+    assert raised.value.failed == [("ConfigMap", "ns", "bad")]
+    assert raised.value.outcomes[("ConfigMap", "ns", "good")] == "created"
+    assert FakeDynamicClient.applied == [("ConfigMap", "good")]
+    assert "ConfigMap 'bad' in namespace 'ns'" in str(raised.value)
+
+
+def test_unsupported_kinds_are_rejected():
+    with pytest.raises(ValueError):
+        Applier().add({"kind": "Pod", "metadata": {"name": "p", "namespace": "ns"}})
+
+
+def test_every_object_is_applied_without_the_permission_to_list(monkeypatch):
+    def forbidden(self, namespace):
+        raise k8s_apply.client.exceptions.ApiException(status=403, reason="Forbidden")
+    monkeypatch.setattr(FakeCoreV1Api, "list_namespaced_secret", forbidden)
+    applier = Applier()
+    applier.add(secret("s", "ns", {"password": "p"}))
+    assert applier.apply() == {("Secret", "ns", "s"): "created"}
+    assert FakeDynamicClient.applied == [("Secret", "s")]
@@ -0,0 +1,39 @@
+import pytest
+from minio.error import MinioAdminException
+
+from minio_admin import MinioConnection
+
+
+@pytest.fixture
+def connection():
+    return MinioConnection("http://localhost:9000", "root", "password")
+
+
+def failing_request(error):
+    def url_open(**kwargs):
+        raise error
+    return url_open
+
+
+def test_a_failed_configuration_read_is_reported_as_missing(connection, capsys):
+    # In minio 7.2.20 the admin error arrives as the context of an UnboundLocalError
+    connection.admin._url_open = failing_request(MinioAdminException("403", "Access Denied"))
+    assert connection.openid_provider("stelar") is None
+    assert "Access Denied" in capsys.readouterr().out
+
+
+def test_other_unbound_local_errors_are_raised(connection, monkeypatch):
+    def broken(key):
+        raise UnboundLocalError("a bug of our own")
+    monkeypatch.setattr(connection.admin, "config_get", broken)
+    with pytest.raises(UnboundLocalError):
+        connection.openid_provider("stelar")
+
+
+def test_the_parameters_of_a_provider_are_parsed(connection, monkeypatch):
+    text = 'identity_openid:stelar client_id=minio config_url="http://kc/realms/master" scopes=openid'
+    monkeypatch.setattr(connection.admin, "config_get", lambda key: text)
+    assert connection.openid_provider("stelar") == {
+        "client_id": "minio", "config_url": "http://kc/realms/master", "scopes": "openid",
+    }
+    assert connection.openid_provider("other") is None
@@ -0,0 +1,128 @@
+from reconcile import Change, diff, matches
+
+
+class FakeState:
+    """ The actual state of a realm, as RealmState holds it, without Keycloak. """
+
+    def __init__(self, realm_roles=(), client_scopes=(), clients=(), client_roles=None, profile=None):
+        self.realm_roles = {r["name"]: r for r in realm_roles}
+        self.client_scopes = {s["name"]: s for s in client_scopes}
+        self.clients = {c["clientId"]: c for c in clients}
+        self.client_roles = client_roles or {}
+        self.profile = profile or {"attributes": []}
+
+    def profile_attributes(self):
+        return {a["name"]: a for a in self.profile.get("attributes", [])}
+
+
+def actions(changes):
+    return {(c.kind, c.name): c.action for c in changes}
+
+
+def test_matches_ignores_properties_missing_from_the_desired_representation():
+    assert matches({"name": "a"}, {"name": "a", "id": "1", "description": "added by Keycloak"})
+    assert not matches({"name": "a", "description": "x"}, {"name": "a"})
+
+
+def test_matches_compares_bools_with_the_strings_keycloak_returns():
+    assert matches(True, "true")
+    assert matches(False, "false")
+    assert not matches(True, "false")
+    assert matches({"config": {"multivalued": True}}, {"config": {"multivalued": "true"}})
+
+
+def test_matches_unwraps_single_valued_attribute_lists():
+    assert matches({"attributes": {"is_admin": "true"}}, {"attributes": {"is_admin": ["true"]}})
+    assert not matches({"attributes": {"is_admin": "true"}}, {"attributes": {"is_admin": ["true", "false"]}})
+
+
+def test_matches_compares_lists_in_order():
+    assert matches({"redirectUris": ["a", "b"]}, {"redirectUris": ["a", "b"]})
+    assert not matches({"redirectUris": ["a", "b"]}, {"redirectUris": ["b", "a"]})
+
+
+def test_matches_recurses_into_nested_dicts():
+    desired = {"attributes": {"post.logout.redirect.uris": "+"}, "name": "c"}
+    assert matches(desired, {"name": "c", "attributes": {"post.logout.redirect.uris": "+", "other": "x"}})
+    assert not matches(desired, {"name": "c", "attributes": {"post.logout.redirect.uris": "-"}})
+
+
+def test_matches_treats_an_omitted_map_as_empty():
+    assert matches({"attributes": {}}, {"name": "c"})
+    assert not matches({"attributes": {"a": "1"}}, {"name": "c"})
+
+
+MAPPER = {"name": "roles", "protocol": "openid-connect", "config": {"claim.name": "roles", "multivalued": "true"}}
+SPEC = {
+    "realmRoles": [{"name": "pullers"}, {"name": "pushers"}],
+    "clientScopes": [{"name": "minio", "protocol": "openid-connect", "protocolMappers": [MAPPER]}],
+    "clients": [{
+        "clientId": "api", "enabled": True, "roles": ["admin"],
+        "defaultClientScopes": ["minio"], "optionalClientScopes": ["email"],
+    }],
+    "userProfileAttributes": [{"name": "is_admin", "permissions": {"view": ["admin"]}}],
+}
+
+
+def test_diff_creates_everything_in_an_empty_realm():
+    changes = diff(SPEC, FakeState())
+    assert set(actions(changes).values()) == {"create"}
+    assert [c.kind for c in changes] == sorted(
+        (c.kind for c in changes),
+        key=["realm-role", "client-scope", "mapper", "client", "client-role", "default-scope",
+             "optional-scope", "profile-attribute"].index,
+    )
+    client = next(c for c in changes if c.kind == "client")
+    assert "roles" not in client.payload and "defaultClientScopes" not in client.payload
+
+
+def test_diff_is_a_noop_on_a_realm_in_the_desired_state():
+    state = FakeState(
+        realm_roles=[{"name": "pullers", "id": "1"}, {"name": "pushers", "id": "2"}],
+        client_scopes=[{"name": "minio", "id": "s", "protocol": "openid-connect",
+                        "protocolMappers": [dict(MAPPER, id="m")]}],
+        clients=[{"clientId": "api", "id": "c", "enabled": True,
+                  "defaultClientScopes": ["minio", "profile"], "optionalClientScopes": ["email"]}],
+        client_roles={"api": {"admin"}},
+        profile={"attributes": [{"name": "is_admin", "permissions": {"view": ["admin"], "edit": ["admin"]}}]},
+    )
+    assert set(actions(diff(SPEC, state)).values()) == {"noop"}
+
+
+def test_diff_updates_what_differs_with_the_ids_of_the_actual_objects():
+    state = FakeState(
+        client_scopes=[{"name": "minio", "id": "s", "protocol": "openid-connect",
+                        "protocolMappers": [dict(MAPPER, id="m", config={"claim.name": "groups"})]}],
+        clients=[{"clientId": "api", "id": "c", "enabled": False}],
+    )
+    changes = diff(SPEC, state)
+    assert actions(changes)[("mapper", "minio/roles")] == "update"
+    assert actions(changes)[("client", "api")] == "update"
+    mapper = next(c for c in changes if c.kind == "mapper")
+    assert mapper.payload["id"] == "m"
+
+
+def test_diff_moves_a_scope_assigned_the_other_way():
+    state = FakeState(clients=[{"clientId": "api", "id": "c", "enabled": True,
+                                "defaultClientScopes": ["email"], "optionalClientScopes": ["minio"]}])
+    changes = {(c.kind, c.name): c for c in diff(SPEC, state)}
+    assert changes[("default-scope", "api/minio")] == Change(
+        "default-scope", "api/minio", "create", {"client": "api", "scope": "minio", "moved": True})
+    assert changes[("optional-scope", "api/email")].payload["moved"]
+
+
+def test_diff_never_removes_objects_dropped_from_the_spec():
+    state = FakeState(
+        realm_roles=[{"name": "pullers"}, {"name": "pushers"}, {"name": "legacy"}],
+        client_scopes=[
+            {"name": "minio", "id": "s", "protocol": "openid-connect", "protocolMappers": [dict(MAPPER, id="m")]},
+            {"name": "dropped", "id": "d", "protocolMappers": [{"name": "old", "id": "o"}]},
+        ],
+        clients=[{"clientId": "api", "id": "c", "enabled": True,
+                  "defaultClientScopes": ["minio", "dropped"], "optionalClientScopes": ["email"]}],
+        client_roles={"api": {"admin"}},
+    )
+    changes = diff(SPEC, state)
+    names = {c.name for c in changes}
+    assert not any("dropped" in name or "legacy" in name for name in names)
+    assert {c.action for c in changes} <= {"create", "update", "noop"}
@@ -0,0 +1,27 @@
+import os
+import re
+
+import pytest
+
+# The bootstrap modules copied into the directories of the other images (see the Makefile)
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOT = os.path.dirname(HERE)
+
+
+def shared(variable):
+    with open(os.path.join(HERE, "Makefile")) as f:
+        return re.search(rf"^{variable}=(.*)$", f.read(), re.MULTILINE).group(1).split()
+
+
+COPIES = [(module, "registry-init") for module in shared("SHARED") + shared("REGISTRY_SHARED")] + [
+    (module, os.path.join("ckan-k8s", "setup")) for module in shared("SHARED")
+]
+
+
+@pytest.mark.parametrize("module, directory", COPIES)
+def test_the_copies_of_the_shared_modules_are_identical(module, directory):
+    with open(os.path.join(HERE, module), "rb") as f:
+        reference = f.read()
+    with open(os.path.join(ROOT, directory, module), "rb") as f:
+        copy = f.read()
+    assert copy == reference, f"{directory}/{module} differs; run 'make -C keycloak_init sync-shared'"
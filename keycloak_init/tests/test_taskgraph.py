@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+
+from taskgraph import StepTiming, TaskGraph
+
+
+def test_steps_run_after_their_dependencies_and_results_are_kept():
+    order = []
+    lock = threading.Lock()
+
+    def step(name):
+        with lock:
+            order.append(name)
+        return name.upper()
+
+    graph = TaskGraph()
+    graph.add("a", step, "a")
+    graph.add("b", step, "b", after=["a"])
+    graph.add("c", step, "c", after=["b"])
+    assert graph.run() == {"a": "A", "b": "B", "c": "C"}
+    assert order == ["a", "b", "c"]
+
+
+def test_unknown_and_duplicate_steps_are_rejected():
+    graph = TaskGraph()
+    graph.add("a", lambda: None)
+    with pytest.raises(ValueError):
+        graph.add("a", lambda: None)
+    with pytest.raises(ValueError):
+        graph.add("b", lambda: None, after=["missing"])
+
+
+def test_a_failed_step_skips_its_dependents_but_not_the_independent_steps():
+    ran = []
+
+    def fail():
+        raise RuntimeError("boom")
+
+    graph = TaskGraph()
+    graph.add("fails", fail)
+    graph.add("child", ran.append, "child", after=["fails"])
+    graph.add("grandchild", ran.append, "grandchild", after=["child"])
+    graph.add("independent", ran.append, "independent")
+    with pytest.raises(RuntimeError):
+        graph.run()
+
+    assert ran == ["independent"]
+    outcomes = {name: t.outcome for name, t in graph.timings.items()}
+    assert outcomes == {"fails": "failed", "child": "skipped", "grandchild": "skipped", "independent": "ok"}
+    assert graph.timings["child"].start is None
+
+
+def test_the_error_of_the_first_failed_step_is_raised_once_all_steps_ran():
+    ran = []
+
+    def fail(message, delay):
+        time.sleep(delay)
+        raise ValueError(message)
+
+    graph = TaskGraph()
+    graph.add("first", fail, "first", 0.0)
+    graph.add("second", fail, "second", 0.2)
+    graph.add("slow", lambda: (time.sleep(0.3), ran.append("slow")))
+    with pytest.raises(ValueError, match="first"):
+        graph.run()
+    assert ran == ["slow"]
+
+
+def test_the_critical_path_of_a_diamond_follows_the_slowest_branch():
+    graph = TaskGraph()
+    graph.add("root", lambda: None)
+    graph.add("fast", lambda: None, after=["root"])
+    graph.add("slow", time.sleep, 0.2, after=["root"])
+    graph.add("join", lambda: None, after=["fast", "slow"])
+    graph.run()
+    assert graph.critical_path() == ["root", "slow", "join"]
+
+
+def test_the_critical_path_ignores_skipped_steps():
+    graph = TaskGraph()
+    graph.timings = {
+        "a": StepTiming("a", 0.0, 1.0, "ok", ()),
+        "b": StepTiming("b", 1.0, 5.0, "ok", ("a",)),
+        "c": StepTiming("c", 1.0, 2.0, "failed", ("a",)),
+        "d": StepTiming("d", None, None, "skipped", ("c",)),
+        "e": StepTiming("e", 5.0, 6.0, "ok", ("b", "c")),
+    }
+    assert graph.critical_path() == ["a", "b", "e"]
+    assert TaskGraph().critical_path() == []
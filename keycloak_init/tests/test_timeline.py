@@ -0,0 +1,65 @@
+import json
+
+from timeline import Ledger, critical_path, merge
+
+
+def timeline_data(ledger):
+    return ledger.config_map("ns")["data"]
+
+
+def timeline(*ledgers):
+    data = {}
+    for ledger in ledgers:
+        data.update(timeline_data(ledger))
+    return merge(data)
+
+
+def test_merge_tags_the_records_with_their_job_in_start_order():
+    a, b = Ledger("a"), Ledger("b")
+    a.record("late", 5, 6, "ok")
+    b.record("early", 1, 2, "ok")
+    b.record("skipped", None, None, "skipped")
+    records = merge(dict(timeline_data(a), **timeline_data(b), notes="not a ledger"))
+    assert [(r["job"], r["step"]) for r in records] == [("b", "early"), ("a", "late"), ("b", "skipped")]
+
+
+def test_the_critical_path_follows_the_steps_of_a_job():
+    job = Ledger("job")
+    job.record("root", 0, 1, "ok")
+    job.record("fast", 1, 2, "ok", after=["root"])
+    job.record("slow", 1, 5, "ok", after=["root"])
+    job.record("join", 5, 6, "ok", after=["fast", "slow"])
+    assert [r["step"] for r in critical_path(timeline(job))] == ["root", "slow", "join"]
+    assert critical_path([]) == []
+
+
+def test_the_critical_path_crosses_jobs_through_qualified_steps():
+    kc, registry = Ledger("keycloak-init"), Ledger("registry-init")
+    kc.record("realm", 0, 2, "ok")
+    kc.record("k8s-apply", 2, 3, "ok", after=["realm"])
+    kc.record("realm-settings", 2, 4, "ok", after=["realm"])
+    registry.record("config", 3, 5, "ok", after=["keycloak-init/k8s-apply"])
+    registry.record("quay", 5, 9, "ok", after=["config"])
+    path = critical_path(timeline(kc, registry))
+    assert [(r["job"], r["step"]) for r in path] == [
+        ("keycloak-init", "realm"), ("keycloak-init", "k8s-apply"),
+        ("registry-init", "config"), ("registry-init", "quay"),
+    ]
+
+
+def test_a_job_may_wait_for_the_steps_of_another_job_as_a_whole():
+    kc, ckan = Ledger("keycloak-init"), Ledger("ckan-setup", after=["keycloak-init/k8s-apply"])
+    kc.record("k8s-apply", 0, 3, "ok")
+    with ckan.step("setup"):
+        pass
+    [record] = json.loads(timeline_data(ckan)["ckan-setup.json"])
+    assert record["after"] == ["keycloak-init/k8s-apply"]
+    assert [r["step"] for r in critical_path(timeline(kc, ckan))] == ["k8s-apply", "setup"]
+
+
+def test_the_critical_path_ignores_steps_that_did_not_run_and_cycles():
+    job = Ledger("job")
+    job.record("a", 0, 1, "ok", after=["b", "missing"])
+    job.record("b", 1, 2, "ok", after=["a", "skipped"])
+    job.record("skipped", None, None, "skipped")
+    assert [r["step"] for r in critical_path(timeline(job))] == ["a", "b"]
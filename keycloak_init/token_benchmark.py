@@ -0,0 +1,107 @@
+import argparse
+import base64
+import getpass
+import json
+import os
+import time
+
+import requests
+from jwcrypto import jwk, jwt
+
+from run import API_CLIENT, API_CLIENT_SCOPES, KEYCLOAK_REALM, KEYCLOAK_URL, initialize_keycloak_admin
+
+################### Token Cost Benchmark ############################
+#
+# Measures what the claims of the API client cost to the services that
+# receive its access tokens: the size of the token (sent with every request)
+# and the time to decode and to verify it (done on every request by Quay,
+# MinIO and the API). A token is issued for a user with the default scopes
+# only ('lean'), with each scope of the API client, and with all of them
+# ('full', the token every request carried before the scopes were optional):
+#
+#   python token_benchmark.py --username alice
+#
+# The password of the user is read from TOKEN_BENCHMARK_PASSWORD, or asked
+# for, so that it is not left in the shell history or the process list.
+# Requested scopes that are default already make no difference, so run it
+# with KC_API_OPTIONAL_SCOPES set to "" and unset to compare the two.
+#####################################################################
+
+
+def issue_token(client_secret, username, password, scopes):
+    """
+    Issues an access token of the API client for a user, with the given scopes besides openid.
+    """
+    response = requests.post(
+        f"{KEYCLOAK_URL}/realms/{KEYCLOAK_REALM}/protocol/openid-connect/token",
+        data={
+            "grant_type": "password",
+            "client_id": API_CLIENT,
+            "client_secret": client_secret,
+            "username": username,
+            "password": password,
+            "scope": " ".join(["openid", *scopes]),
+        },
+        timeout=30,
+    )
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+def decode_claims(token):
+    """ Decodes the claims of a JWT without verifying it. """
+    payload = token.split(".")[1]
+    return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+
+
+def per_call_us(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def measure(token, keys, iterations):
+    """
+    Returns the size, the number of claims and the decode and verify times (microseconds) of a token.
+    """
+    return {
+        "bytes": len(token),
+        "claims": len(decode_claims(token)),
+        "decode_us": per_call_us(lambda: decode_claims(token), iterations),
+        "verify_us": per_call_us(lambda: jwt.JWT(jwt=token, key=keys, expected_type="JWS"), iterations),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the size and decode cost of the access tokens of the API client.")
+    parser.add_argument("--username", required=True, help="The user the tokens are issued for")
+    parser.add_argument("--iterations", type=int, default=2000, help="Decodes and verifications per token")
+    parser.add_argument("--report", default=None, help="Write the measurements to this JSON file")
+    args = parser.parse_args(argv)
+    password = os.getenv("TOKEN_BENCHMARK_PASSWORD") or getpass.getpass(f"Password of {args.username}: ")
+
+    keycloak_admin = initialize_keycloak_admin()
+    client_secret = keycloak_admin.get_client_secrets(keycloak_admin.get_client_id(API_CLIENT))["value"]
+    keys = jwk.JWKSet.from_json(
+        requests.get(f"{KEYCLOAK_URL}/realms/{KEYCLOAK_REALM}/protocol/openid-connect/certs", timeout=30).text
+    )
+
+    profiles = [("lean", [])] + [(scope, [scope]) for scope in API_CLIENT_SCOPES] + [("full", API_CLIENT_SCOPES)]
+    results = {}
+    for name, scopes in profiles:
+        token = issue_token(client_secret, args.username, password, scopes)
+        results[name] = dict(measure(token, keys, args.iterations), scopes=scopes)
+
+    lean = results["lean"]
+    print(f"{'token':<20} {'bytes':>7} {'claims':>7} {'decode (us)':>12} {'verify (us)':>12} {'+bytes':>7}")
+    for name, r in results.items():
+        print(f"{name:<20} {r['bytes']:>7} {r['claims']:>7} {r['decode_us']:>12.1f} {r['verify_us']:>12.1f} "
+              f"{r['bytes'] - lean['bytes']:>+7}")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
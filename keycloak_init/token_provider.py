@@ -0,0 +1,147 @@
+import threading
+import time
+
+import requests
+from keycloak.openid_connection import KeycloakOpenIDConnection
+
+################### Shared Token Provider ############################
+#
+# Shared by the bootstrap jobs (keycloak_init and registry-init), like
+# k8s_apply.py; keycloak_init holds the reference copy.
+#
+# One provider per identity caches the access token and refreshes it with
+# the refresh token shortly before it expires, falling back to a new grant
+# when the refresh token has expired too. Refreshing is serialized, so
+# threads sharing the provider never stampede the token endpoint: the
+# first one refreshes, and the others wait for the new token.
+######################################################################
+
+
+class TokenProvider:
+    """
+    A thread-safe source of access tokens for one identity.
+
+    With a username and password the token is obtained with a password grant, otherwise
+    with the client credentials grant of a confidential client.
+
+    Args:
+        server_url (str): The URL of Keycloak.
+        realm (str): The realm of the identity.
+        client_id (str): The client requesting the tokens.
+        username (str): The username, for a password grant.
+        password (str): The password, for a password grant.
+        client_secret (str): The secret of a confidential client.
+        verify (bool): Verify the TLS certificate of Keycloak.
+        refresh_margin (float): Refresh tokens this many seconds before they expire.
+    """
+
+    def __init__(self, server_url, realm, client_id="admin-cli", username=None, password=None,
+                 client_secret=None, verify=True, refresh_margin=30):
+        self.server_url = server_url
+        self.realm = realm
+        self.client_id = client_id
+        self.username = username
+        self.password = password
+        self.client_secret = client_secret
+        self.verify = verify
+        self.refresh_margin = refresh_margin
+        self.session = requests.Session()
+        self.grants = 0
+        self.refreshes = 0
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0
+        self._refresh_expires_at = 0
+
+    @property
+    def token_url(self):
+        return f"{self.server_url}/realms/{self.realm}/protocol/openid-connect/token"
+
+    def token(self, stale=None):
+        """
+        Returns a valid token response (access_token, refresh_token, expires_in, ...).
+
+        Args:
+            stale (str): An access token that was rejected; if it is still the current one,
+                a new token is obtained even though it has not expired.
+        """
+        with self._lock:
+            now = time.monotonic()
+            current = self._token
+            if current is not None and now < self._expires_at - self.refresh_margin and (
+                stale is None or current["access_token"] != stale
+            ):
+                return current
+
+            if current is not None and current.get("refresh_token") and now < self._refresh_expires_at - 1:
+                try:
+                    self._store(self._request({"grant_type": "refresh_token",
+                                               "refresh_token": current["refresh_token"]}))
+                    self.refreshes += 1
+                    return self._token
+                except requests.HTTPError as e:
+                    # The session of the token may have ended; start a new one
+                    print(f"Could not refresh the token of {self.username or self.client_id}: {e}")
+
+            if self.username:
+                data = {"grant_type": "password", "username": self.username, "password": self.password}
+            else:
+                data = {"grant_type": "client_credentials"}
+            self._store(self._request(data))
+            self.grants += 1
+            return self._token
+
+    def access_token(self, stale=None):
+        """ Returns a valid access token. """
+        return self.token(stale)["access_token"]
+
+    def _request(self, data):
+        data = dict(data, client_id=self.client_id)
+        if self.client_secret:
+            data["client_secret"] = self.client_secret
+        response = self.session.post(self.token_url, data=data, verify=self.verify, timeout=30)
+        response.raise_for_status()
+        return response.json()
+
+    def _store(self, token):
+        now = time.monotonic()
+        self._token = token
+        self._expires_at = now + token["expires_in"]
+        # A refresh_expires_in of 0 means the refresh token does not expire (e.g., offline tokens)
+        refresh_expires_in = token.get("refresh_expires_in", 0)
+        self._refresh_expires_at = now + refresh_expires_in if refresh_expires_in else float("inf")
+
+    def connection(self, realm_name=None, **kwargs):
+        """
+        Returns a connection for KeycloakAdmin (or KeycloakUMA) authenticated by this provider.
+
+        Args:
+            realm_name (str): The realm administered, by default the realm of the identity.
+            kwargs: Other arguments of KeycloakOpenIDConnection, e.g., timeout.
+        """
+        return SharedTokenConnection(self, realm_name=realm_name or self.realm, verify=self.verify, **kwargs)
+
+
+class SharedTokenConnection(KeycloakOpenIDConnection):
+    """
+    A python-keycloak connection taking its tokens from a TokenProvider, instead of
+    refreshing them on its own (which is not safe across threads).
+    """
+
+    def __init__(self, provider: TokenProvider, **kwargs):
+        self.provider = provider
+        super().__init__(server_url=provider.server_url, client_id=provider.client_id,
+                         user_realm_name=provider.realm, **kwargs)
+
+    def get_token(self):
+        self.token = self.provider.token()
+
+    def _refresh_if_required(self):
+        token = self.provider.token()
+        if token is not self.token:
+            self.token = token
+
+    def refresh_token(self):
+        # Called after a request was rejected with the current token
+        rejected = self.token["access_token"] if self.token else None
+        self.token = self.provider.token(stale=rejected)
@@ -0,0 +1,242 @@
+import hashlib
+import json
+import os
+import secrets
+import shlex
+import string
+from urllib.parse import urlsplit
+
+import urllib3
+from minio import Minio, MinioAdmin
+from minio.credentials import StaticProvider
+from minio.error import MinioAdminException, S3Error
+
+################### MinIO Administration ############################
+#
+# The admin (identity provider, restart) and S3 (buckets) operations on
+# MinIO, done in-process over one authenticated, pooled connection instead
+# of invoking the `mc` client, so that no secret lands on a command line.
+#####################################################################
+
+
+class MinioSetupError(Exception):
+    """
+    Raised when a MinIO operation of the bootstrap fails.
+
+    Args:
+        operation (str): The operation that failed.
+        cause (Exception): The error returned by MinIO.
+    """
+
+    def __init__(self, operation, cause):
+        self.operation = operation
+        self.cause = cause
+        super().__init__(f"MinIO {operation} failed: {cause}")
+
+
+def generate_access_key_pair():
+    """
+    Generates a random access key (20 characters) and secret key (40 characters), like `mc admin accesskey create`.
+
+    Returns:
+        dict: The 'access_key' and 'secret_key'.
+    """
+    alphabet = string.ascii_letters + string.digits
+    return {
+        "access_key": "".join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(20)),
+        "secret_key": "".join(secrets.choice(alphabet) for _ in range(40)),
+    }
+
+
+def config_fingerprint(config):
+    """
+    Returns a digest of configuration parameters, to detect changes without comparing secrets.
+    """
+    canonical = json.dumps(config, sort_keys=True, separators=(",", ":"))
+    return "sha256:" + hashlib.sha256(canonical.encode()).hexdigest()[:32]
+
+
+class MinioConnection:
+    """
+    Admin and S3 clients of a MinIO server, sharing one connection pool.
+
+    Args:
+        url (str): The URL of the MinIO API, e.g., https://minio.example.org.
+        access_key (str): The root user.
+        secret_key (str): The root password.
+        insecure (bool): Skip the verification of the TLS certificate (e.g., for minikube).
+    """
+
+    def __init__(self, url, access_key, secret_key, insecure=False):
+        parts = urlsplit(url if "://" in url else "https://" + url)
+        secure = parts.scheme == "https"
+        self.endpoint = parts.netloc
+        self.secure = secure
+        self.insecure = insecure
+
+        # Requests are retried while MinIO restarts, e.g., after its identity providers change
+        self.http = urllib3.PoolManager(
+            cert_reqs="CERT_NONE" if insecure else "CERT_REQUIRED",
+            retries=urllib3.Retry(
+                total=6, backoff_factor=0.25, status_forcelist=[500, 502, 503, 504]
+            ),
+        )
+        self.admin = MinioAdmin(
+            endpoint=self.endpoint,
+            credentials=StaticProvider(access_key, secret_key),
+            secure=secure,
+            cert_check=not insecure,
+            http_client=self.http,
+        )
+        self.s3 = Minio(
+            self.endpoint,
+            access_key=access_key,
+            secret_key=secret_key,
+            secure=secure,
+            cert_check=not insecure,
+            http_client=self.http,
+        )
+
+    @classmethod
+    def from_env(cls):
+        """
+        Connects with the root credentials given in the environment of the bootstrap job.
+        """
+        return cls(
+            os.getenv("MINIO_API_DOMAIN"),
+            os.getenv("MINIO_ROOT_USER"),
+            os.getenv("MINIO_ROOT_PASSWORD"),
+            insecure=os.getenv("MINIO_INSECURE_MC", "False").lower() == "true",
+        )
+
+    def openid_provider(self, name):
+        """
+        Reads the configuration of an OpenID identity provider.
+
+        Args:
+            name (str): The name of the provider configuration.
+
+        Returns:
+            dict: The parameters of the provider, or None if it is not configured (or cannot be read).
+        """
+        key = f"identity_openid:{name}"
+        try:
+            text = self.admin.config_get(key)
+        except (MinioAdminException, urllib3.exceptions.HTTPError, UnboundLocalError) as e:
+            # When the request fails, config_get of minio 7.2.20 (pinned in requirements.txt) closes
+            # a response it never got, so the admin error arrives as the context of an UnboundLocalError
+            error = e.__context__ if isinstance(e, UnboundLocalError) else e
+            if not isinstance(error, (MinioAdminException, urllib3.exceptions.HTTPError)):
+                raise
+            print(f"Could not read the MinIO configuration {key}: {error}")
+            return None
+        for line in text.splitlines():
+            tokens = shlex.split(line)
+            if tokens and tokens[0] == key:
+                return dict(token.split("=", 1) for token in tokens[1:] if "=" in token)
+        return None
+
+    def set_openid_provider(self, name, config):
+        """
+        Adds (or replaces) an OpenID identity provider, like `mc idp openid add`.
+
+        Args:
+            name (str): The name of the provider configuration.
+            config (dict): The parameters of the provider (client_id, client_secret, config_url, ...).
+
+        Returns:
+            str: The response of MinIO.
+        """
+        # Values are separated by spaces in the configuration syntax of MinIO
+        params = {
+            key: f'"{value}"' if " " in str(value) else str(value) for key, value in config.items()
+        }
+        try:
+            return self.admin.config_set(f"identity_openid:{name}", params)
+        except (MinioAdminException, urllib3.exceptions.HTTPError) as e:
+            raise MinioSetupError(f"identity provider {name} setup", e) from e
+
+    def restart(self):
+        """
+        Restarts the MinIO service, to apply configuration changes that require it.
+        """
+        try:
+            return self.admin.service_restart()
+        except (MinioAdminException, urllib3.exceptions.HTTPError) as e:
+            raise MinioSetupError("restart", e) from e
+
+    def make_bucket(self, bucket_name):
+        """
+        Creates a bucket unless it exists.
+
+        Returns:
+            bool: True if the bucket was created.
+        """
+        try:
+            if self.s3.bucket_exists(bucket_name):
+                return False
+            self.s3.make_bucket(bucket_name)
+            return True
+        except (S3Error, urllib3.exceptions.HTTPError) as e:
+            raise MinioSetupError(f"creation of bucket {bucket_name}", e) from e
+
+    def add_access_key(self, access_key, secret_key, name=None, description=None):
+        """
+        Adds an access key (service account) of the root user, inheriting its permissions.
+
+        Args:
+            access_key (str): The access key.
+            secret_key (str): The secret key.
+            name (str): A name for the key, shown by MinIO (at most 32 characters).
+            description (str): A description of the key, shown by MinIO.
+        """
+        try:
+            self.admin.add_service_account(
+                access_key=access_key, secret_key=secret_key, name=name, description=description
+            )
+        except (MinioAdminException, urllib3.exceptions.HTTPError) as e:
+            raise MinioSetupError(f"creation of access key {access_key}", e) from e
+
+    def delete_access_key(self, access_key):
+        """
+        Deletes (revokes) an access key.
+
+        Returns:
+            bool: True if the key was deleted, False if it did not exist.
+        """
+        try:
+            self.admin.delete_service_account(access_key)
+            return True
+        except MinioAdminException as e:
+            if "NotFound" in str(e._body) or str(e._code) == "404":
+                return False
+            raise MinioSetupError(f"deletion of access key {access_key}", e) from e
+        except urllib3.exceptions.HTTPError as e:
+            raise MinioSetupError(f"deletion of access key {access_key}", e) from e
+
+    def credentials_valid(self, access_key, secret_key):
+        """
+        Checks whether MinIO accepts a key pair, with one S3 request signed by it.
+
+        Returns:
+            bool: False if MinIO does not know the access key or the secret key does not match it.
+        """
+        s3 = Minio(
+            self.endpoint,
+            access_key=access_key,
+            secret_key=secret_key,
+            secure=self.secure,
+            cert_check=not self.insecure,
+            http_client=self.http,
+        )
+        try:
+            s3.list_buckets()
+            return True
+        except S3Error as e:
+            if e.code in ("InvalidAccessKeyId", "SignatureDoesNotMatch"):
+                return False
+            if e.code == "AccessDenied":  # Known, but not allowed to list the buckets
+                return True
+            raise MinioSetupError("validation of access key", e) from e
+        except urllib3.exceptions.HTTPError as e:
+            raise MinioSetupError("validation of access key", e) from e
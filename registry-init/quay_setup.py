@@ -0,0 +1,198 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from taskgraph import TaskGraph
+
+#----------------- QUAY ORGANIZATION SETUP -----------------
+#
+# The organization of STELAR in Quay, its teams, the syncing of the teams
+# with the Keycloak roles, and the default permissions (prototypes) of the
+# teams on new repositories.
+#
+# The current state is read with one round of concurrent requests, and only
+# what is missing or different is written: the organization, then the teams,
+# then their syncing and prototypes, each level concurrently. A re-run on a
+# configured Quay only reads.
+#-----------------------------------------------------------
+
+# kind: 'organization', 'team', 'team-sync' or 'prototype'
+# action: 'create', 'update' or 'noop'
+Operation = namedtuple("Operation", ["kind", "name", "action", "payload"])
+
+
+class QuaySetupError(Exception):
+    """
+    Raised when Quay rejects a request of the setup.
+    """
+
+    def __init__(self, method, path, response):
+        self.status_code = response.status_code
+        super().__init__(f"{method} {path} returned {response.status_code}: {response.text}")
+
+
+class QuayOrganization:
+    """
+    Reconciles an organization of Quay with the desired teams.
+
+    Args:
+        base_url (str): The URL of Quay, e.g., http://quay.example.org.
+        tokens (TokenProvider): The provider of the tokens of a Quay administrator.
+        org (str): The name of the organization.
+        teams (dict): The desired teams by name, each a dict with the 'role' of the team
+            (member, creator or admin), the Keycloak 'group' synced to it and the 'prototype'
+            role (read, write or admin) of the team on new repositories.
+        max_workers (int): The maximum number of concurrent requests.
+    """
+
+    def __init__(self, base_url, tokens, org, teams, max_workers=8):
+        self.api = f"{base_url}/api/v1"
+        self.tokens = tokens
+        self.org = org
+        self.teams = teams
+        self.max_workers = max_workers
+        self.session = requests.Session()
+        self.session.verify = False
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=max_workers))
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=max_workers))
+
+    def request(self, method, path, expected=(200, 201, 204), **kwargs):
+        """
+        Sends an authenticated request to the Quay API.
+
+        Returns:
+            requests.Response: The response, if its status is expected.
+
+        Raises:
+            QuaySetupError: If the status of the response is not expected.
+        """
+        token = self.tokens.access_token()
+        response = self.session.request(
+            method, self.api + path, headers={"Authorization": f"Bearer {token}"}, allow_redirects=True, **kwargs
+        )
+        if response.status_code == 401:
+            token = self.tokens.access_token(stale=token)
+            response = self.session.request(
+                method, self.api + path, headers={"Authorization": f"Bearer {token}"}, allow_redirects=True, **kwargs
+            )
+        if response.status_code not in expected:
+            raise QuaySetupError(method, path, response)
+        return response
+
+    def state(self):
+        """
+        Reads the organization, the members (and syncing) of its teams, and its prototypes concurrently.
+
+        Returns:
+            dict: The 'organization' (None if missing), the 'teams' by name (None if missing)
+                and the 'prototypes' (empty if the organization is missing).
+        """
+        org_path = f"/organization/{self.org}"
+
+        def read(path):
+            response = self.request("GET", path, expected=(200, 404))
+            return None if response.status_code == 404 else response.json()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            organization = pool.submit(read, org_path)
+            prototypes = pool.submit(read, f"{org_path}/prototypes")
+            members = {name: pool.submit(read, f"{org_path}/team/{name}/members") for name in self.teams}
+            organization, prototypes = organization.result(), prototypes.result()
+            members = {name: future.result() for name, future in members.items()}
+
+        # The roles of the teams are listed by the organization, their syncing by their members
+        roles = {name: team.get("role") for name, team in (organization or {}).get("teams", {}).items()}
+        return {
+            "organization": organization,
+            "teams": {
+                name: None if team is None else dict(team, role=roles.get(name)) for name, team in members.items()
+            },
+            "prototypes": (prototypes or {}).get("prototypes", []),
+        }
+
+    def plan(self):
+        """
+        Computes the operations that bring the organization to the desired state, without writing anything.
+
+        Returns:
+            list: The operations (including no-ops).
+        """
+        state = self.state()
+        operations = [
+            Operation("organization", self.org, "noop" if state["organization"] else "create", {"name": self.org})
+        ]
+        prototypes = {
+            p["delegate"]["name"]: p for p in state["prototypes"] if p.get("delegate", {}).get("kind") == "team"
+        }
+        for name, team in self.teams.items():
+            actual = state["teams"][name]
+            if actual is None:
+                action = "create"
+            else:
+                action = "noop" if actual.get("role") == team["role"] else "update"
+            operations.append(Operation("team", name, action, {"name": name, "role": team["role"]}))
+
+            synced = ((actual or {}).get("synced") or {}).get("config", {}).get("group_name")
+            if synced is None:
+                action = "create"
+            else:
+                action = "noop" if synced == team["group"] else "update"
+            operations.append(Operation("team-sync", name, action, {"group_name": team["group"]}))
+
+            prototype = prototypes.get(name)
+            payload = {
+                "delegate": {"name": name, "kind": "team", "is_robot": False, "is_org_member": True},
+                "role": team["prototype"],
+            }
+            if prototype is None:
+                action = "create"
+            else:
+                action = "noop" if prototype["role"] == team["prototype"] else "update"
+                payload["id"] = prototype["id"]
+            operations.append(Operation("prototype", name, action, payload))
+        return operations
+
+    def reconcile(self):
+        """
+        Creates or updates what is missing or different, each level of dependent operations concurrently.
+
+        Returns:
+            TaskGraph: The graph of the applied operations, with their timings.
+
+        Raises:
+            QuaySetupError: If an operation fails (the operations not depending on it are still applied).
+        """
+        operations = [op for op in self.plan() if op.action != "noop"]
+        graph = TaskGraph(self.max_workers)
+        steps = {}
+        for op in operations:
+            if op.kind == "organization":
+                after = []
+            elif op.kind == "team":
+                after = [steps[k] for k in [("organization", self.org)] if k in steps]
+            else:
+                after = [steps[k] for k in [("organization", self.org), ("team", op.name)] if k in steps]
+            steps[(op.kind, op.name)] = graph.add(f"{op.kind} {op.name}", self._apply, op, after=after)
+        if not operations:
+            print(f"[SETUP] Organization '{self.org}' is up to date.")
+        graph.run()
+        return graph
+
+    def _apply(self, op):
+        org_path = f"/organization/{self.org}"
+        if op.kind == "organization":
+            self.request("POST", "/organization/", json=op.payload, expected=(201,))
+        elif op.kind == "team":
+            self.request("PUT", f"{org_path}/team/{op.name}", json=op.payload)
+        elif op.kind == "team-sync":
+            if op.action == "update":
+                self.request("DELETE", f"{org_path}/team/{op.name}/syncing")
+            self.request("POST", f"{org_path}/team/{op.name}/syncing", json=op.payload)
+        elif op.kind == "prototype":
+            if op.action == "update":
+                self.request("PUT", f"{org_path}/prototypes/{op.payload['id']}", json={"role": op.payload["role"]})
+            else:
+                self.request("POST", f"{org_path}/prototypes", json=op.payload)
+        print(f"[SETUP] {op.action} {op.kind} {op.name}")
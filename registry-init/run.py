@@ -1,11 +1,16 @@
 from kubernetes import client, config
-from keycloak import KeycloakOpenID
+import base64
 import yaml
 import os
-import subprocess
-import re
 import time
-import requests
+
+import k8s_apply
+from k8s_apply import Applier
+from minio_admin import MinioConnection, generate_access_key_pair
+from quay_setup import QuayOrganization
+from readiness import wait_for_endpoints, wait_for_http
+from timeline import Ledger
+from token_provider import TokenProvider
 
 config.load_incluster_config()
 KUBE_NAMESPACE = os.getenv("KUBE_NAMESPACE")
@@ -19,6 +24,16 @@ KC_PULLERS_ROLE_NAME = os.getenv("KC_QUAY_PULLERS")
 KC_ADMIN_USER = os.getenv("KC_ADMIN_USER")
 KC_ADMIN_PASSWORD = os.getenv("KC_ADMIN_PASSWORD")
 KC_REALM = os.getenv("KC_REALM")
+# The token of the administrator in Quay, obtained through the Quay client and refreshed before it expires
+quay_admin_tokens = TokenProvider(
+    "http://keycloak:8080",
+    KC_REALM,
+    client_id=KC_QUAY_CLIENT_NAME,
+    client_secret=KC_QUAY_CLIENT_SECRET,
+    username=KC_ADMIN_USER,
+    password=KC_ADMIN_PASSWORD,
+    verify=False,
+)
 
 # Database Configuration Params
 DB_HOST = os.getenv("DB_HOST")
@@ -33,32 +48,24 @@ MINIO_ROOT_USER = os.getenv("MINIO_ROOT_USER")
 MINIO_ROOT_PASS = os.getenv("MINIO_ROOT_PASSWORD")
 MINIO_INSECURE = os.getenv("MC_INSECURE") == "true"
 MINIO_BUCKET = os.getenv("MINIO_REGISTRY_BUCKET")
+# The Secret keeping the MinIO keys of Quay across runs; MINIO_ROTATE_KEYS=true replaces them
+MINIO_KEYS_SECRET = os.getenv("MINIO_REGISTRY_KEYS_SECRET", "registry-minio-keys")
+MINIO_ROTATE_KEYS = os.getenv("MINIO_ROTATE_KEYS", "false").lower() == "true"
 
 # Generic Params
 QUAY_SERVER_HOSTNAME = os.getenv("QUAY_SERVER_HOSTNAME")
 QUAY_REDIS_HOSTNAME = os.getenv("QUAY_REDIS_HOSTNAME")
 QUAY_REDIS_PORT = os.getenv("QUAY_REDIS_PORT")
+QUAY_SERVICE = os.getenv("QUAY_SERVICE", "quay")
+# Maximum time (seconds) to wait for Quay to be ready
+QUAY_READY_TIMEOUT = float(os.getenv("QUAY_READY_TIMEOUT", "300"))
 
-
-#----------------- KEYCLOAK -----------------
-def mc_setup():
-    subprocess.run(
-        [
-            "mc",
-            "alias",
-            "set",
-            "myminio",
-            MINIO_HOST,
-            MINIO_ROOT_USER,
-            MINIO_ROOT_PASS,
-        ],
-        capture_output=True,
-        text=True,
-        check=True,
-    )
+# The timings of the setup steps, published to the bootstrap timeline
+ledger = Ledger("registry-init")
 
 
 #----------------- Tool Registry Configuration -----------------
+@ledger.wrap
 def generate_tool_registry_configuration():
     registry_config_yaml = "config.yaml"
     if KUBE_NAMESPACE:
@@ -124,252 +131,148 @@ def generate_tool_registry_configuration():
             f"[SETUP] Generated YAML succesfully, will apply it to the K8s namespace '{KUBE_NAMESPACE}'"
         )
 
-        try:
-            apply_configmap_to_k8s_cluster(cmap)
-            print("[SETUP] Applied ConfigMap To K8s namespace '{KUBE_NAMESPACE}'")
-        except Exception as e:
-            print(f"[FATAL] Failed to apply ConfigMap to Kubernetes cluster: {str(e)}")
+        # An ApplyError fails the job, as Quay cannot start without its configuration
+        apply_configmap_to_k8s_cluster(cmap)
+        print(f"[SETUP] Applied ConfigMap To K8s namespace '{KUBE_NAMESPACE}'")
 
         print("[SETUP] Will wait for QUAY to come up, to configure orgs and teams...")
+        wait_for_quay()
 
-        timeout = 300  # 5 minutes
-        interval = 10
-        elapsed = 0
-        quay_url = "http://quay:8080/api/v1/discovery"
-        print(f"[SETUP] Checking QUAY status at {quay_url}")
-
-        while elapsed < timeout:
-            try:
-                response = requests.get(quay_url)
-                if response.status_code == 200:
-                    print("[SETUP] QUAY is up and running.")
-                    break
-                else:
-                    print(f"[SETUP] QUAY returned status code {response.status_code}")
-            except requests.exceptions.RequestException:
-                print("[SETUP] Waiting for QUAY to come up...")
-
-            time.sleep(interval)
-            elapsed += interval
-        else:
-            raise Exception(
-                "[FATAL] QUAY did not come up within 3 minutes. Aborting configuration, good luck!"
-            )
+        # Create the organization, its teams, their syncing and default permissions, if missing
+        configure_quay_organization()
 
-        # Issue a token for the administrator account to create orgs and teams
-        try:
-            kopenid = KeycloakOpenID(
-                server_url="http://keycloak:8080",
-                realm_name=KC_REALM,
-                client_id=KC_QUAY_CLIENT_NAME,
-                client_secret_key=KC_QUAY_CLIENT_SECRET,
-                verify=False,
-            )
+    else:
+        raise Exception("[FATAL] NAMESPACE NOT DEFINED IN ENV VARS.")
 
-            token = kopenid.token(
-                username=KC_ADMIN_USER,
-                password=KC_ADMIN_PASSWORD,
-                grant_type="password",
-            )
-        except Exception as e:
-            print(
-                f"[FATAL] Could not acquire OAuth2.0 due to unexpected error: {str(e)}"
-            )
 
-        tkn = token.get("access_token", None)
-        if tkn:
-            
-            #----------------- ORGANIZATION CREATION -----------------
-            # Create organization STELAR
-            org_url = f"http://{QUAY_SERVER_HOSTNAME}/api/v1/organization"
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {tkn}",
-            }
-            data = {"name": "stelar"}
-            try:
-                response = requests.post(org_url, headers=headers, json=data, allow_redirects=True, verify=False)
-                if response.status_code == 201:
-                    print("[SETUP] Organization 'stelar' created successfully.")
-                else:
-                    print(
-                        f"[FATAL] Failed to create organization. Status code: {response.status_code}, Response: {response.text}"
-                    )
-                    return
-            except requests.exceptions.RequestException as e:
-                print(f"[FATAL] Request to create organization failed: {str(e)}")
-                return
-
-            #----------------- TEAM CREATION -----------------
-            # Create pullers team
-            team_url = f"http://{QUAY_SERVER_HOSTNAME}/api/v1/organization/stelar/team/{KC_PULLERS_ROLE_NAME}"
-            team_data = {"name": KC_PULLERS_ROLE_NAME, "role": "member"}
-            try:
-                response = requests.put(team_url, headers=headers, json=team_data, allow_redirects=True, verify=False)
-                if response.status_code == 200:
-                    print(f"[SETUP] Team {KC_PULLERS_ROLE_NAME} created successfully.")
-                else:
-                    print(
-                        f"[FATAL] Failed to create team. Status code: {response.status_code}, Response: {response.text}"
-                    )
-                    return
-            except requests.exceptions.RequestException as e:
-                print(f"[FATAL] Request to create team failed: {str(e)}")
-                return
-
-            # Create pushers team
-            team_url = f"http://{QUAY_SERVER_HOSTNAME}/api/v1/organization/stelar/team/{KC_PUSHERS_ROLE_NAME}"
-            team_data = {"name": KC_PUSHERS_ROLE_NAME, "role": "creator"}
-            try:
-                response = requests.put(team_url, headers=headers, json=team_data, allow_redirects=True, verify=False)
-                if response.status_code == 200:
-                    print(f"[SETUP] Team {KC_PUSHERS_ROLE_NAME} created successfully.")
-                else:
-                    print(
-                        f"[FATAL] Failed to create team. Status code: {response.status_code}, Response: {response.text}"
-                    )
-                    return
-            except requests.exceptions.RequestException as e:
-                print(f"[FATAL] Request to create team failed: {str(e)}")
-                return
-            
-            #----------------- TEAM SYNCING -----------------
-
-            # Enable team syncing with OIDC for pushers
-            sync_url = f"http://{QUAY_SERVER_HOSTNAME}/api/v1/organization/stelar/team/{KC_PUSHERS_ROLE_NAME}/syncing"
-            sync_data = {"group_name": KC_PUSHERS_ROLE_NAME}
-            try:
-                response = requests.post(sync_url, headers=headers, json=sync_data, allow_redirects=True, verify=False)
-                if response.status_code == 200:
-                    print(
-                        f"[SETUP] Team syncing enabled successfully for {KC_PUSHERS_ROLE_NAME}."
-                    )
-                else:
-                    print(
-                        f"[FATAL] Failed to enable team syncing. Status code: {response.status_code}, Response: {response.text}"
-                    )
-                    return
-            except requests.exceptions.RequestException as e:
-                print(f"[FATAL] Request to enable team syncing failed: {str(e)}")
-                return
-
-            # Enable team syncing with OIDC for pullers
-            sync_url = f"http://{QUAY_SERVER_HOSTNAME}/api/v1/organization/stelar/team/{KC_PULLERS_ROLE_NAME}/syncing"
-            sync_data = {"group_name": KC_PULLERS_ROLE_NAME}
-            try:
-                response = requests.post(sync_url, headers=headers, json=sync_data, allow_redirects=True, verify=False)
-                if response.status_code == 200:
-                    print(
-                        f"[SETUP] Team syncing enabled successfully for {KC_PULLERS_ROLE_NAME}."
-                    )
-                else:
-                    print(
-                        f"[FATAL] Failed to enable team syncing. Status code: {response.status_code}, Response: {response.text}"
-                    )
-                    return
-            except requests.exceptions.RequestException as e:
-                print(f"[FATAL] Request to enable team syncing failed: {str(e)}")
-                return
-                      
-            #----------------- REPOSITORY DELEGATION -----------------
-
-            # Enable org repository default delegation permissions for pushers
-            delegation_url = f"http://{QUAY_SERVER_HOSTNAME}/api/v1/organization/stelar/prototypes"
-            delegation_data = {
-                "delegate": {
-                    "name": KC_PUSHERS_ROLE_NAME,
-                    "kind": "team",
-                    "is_robot": False,
-                    "is_org_member": True,
-                },
-                "role": "write",
-            }
-            try:
-                response = requests.post(delegation_url, headers=headers, json=delegation_data, allow_redirects=True, verify=False)
-                if response.status_code == 200:
-                    print(f"[SETUP] Default delegation permissions set successfully for {KC_PUSHERS_ROLE_NAME}.")
-                else:
-                    print(
-                        f"[FATAL] Failed to set default delegation permissions. Status code: {response.status_code}, Response: {response.text}"
-                    )
-                    return
-            except requests.exceptions.RequestException as e:
-                print(f"[FATAL] Request to set default delegation permissions failed: {str(e)}")
-                return
-
-            # Enable org repository default delegation permissions for pullers
-            delegation_url = f"http://{QUAY_SERVER_HOSTNAME}/api/v1/organization/stelar/prototypes"
-            delegation_data = {
-                "delegate": {
-                    "name": KC_PULLERS_ROLE_NAME,
-                    "kind": "team",
-                    "is_robot": False,
-                    "is_org_member": True,
-                },
-                "role": "read",
-            }
-            try:
-                response = requests.post(delegation_url, headers=headers, json=delegation_data, allow_redirects=True, verify=False)
-                if response.status_code == 200:
-                    print(f"[SETUP] Default delegation permissions set succesfully for {KC_PULLERS_ROLE_NAME}.")
-                else:
-                    print(
-                        f"[FATAL] Failed to set default delegation permissions. Status code: {response.status_code}, Response: {response.text}"
-                    )
-                    return
-            except requests.exceptions.RequestException as e:
-                print(f"[FATAL] Request to set default delegation permissions failed: {str(e)}")
-                return
-            
-            print(f"[SETUP] Configuration Completed")
-
-        else:
-            print(f"[FATAL] Could not find OAuth2.0 in the KC response")
+#----------------- QUAY ORGANIZATION -----------------
+@ledger.wrap
+def configure_quay_organization():
+    """
+    Brings the organization 'stelar' to its desired state: the pushers and pullers teams, synced
+    with the Keycloak roles of the same name, with write and read permissions on new repositories.
 
-    else:
-        raise Exception("[FATAL] NAMESPACE NOT DEFINED IN ENV VARS.")
+    Raises:
+        Exception: If an operation fails; the setup is idempotent, so the job can simply be re-run.
+    """
+    quay = QuayOrganization(
+        f"http://{QUAY_SERVER_HOSTNAME}",
+        quay_admin_tokens,
+        "stelar",
+        {
+            KC_PUSHERS_ROLE_NAME: {"role": "creator", "group": KC_PUSHERS_ROLE_NAME, "prototype": "write"},
+            KC_PULLERS_ROLE_NAME: {"role": "member", "group": KC_PULLERS_ROLE_NAME, "prototype": "read"},
+        },
+    )
+    try:
+        graph = quay.reconcile()
+    except Exception as e:
+        raise Exception(f"[FATAL] Failed to configure the Quay organization: {str(e)}")
+    ledger.extend(graph.timings.values())
+    print("[SETUP] Configuration Completed")
 
 
-def get_minio_keys():
+#----------------- QUAY READINESS -----------------
+@ledger.wrap
+def wait_for_quay():
+    """
+    Waits until Quay accepts requests: first for its pod to pass its readiness probe (watched,
+    so there is no polling interval to lose), then for its API to answer.
+
+    Returns:
+        float: The time waited, in seconds.
+
+    Raises:
+        Exception: If Quay is not ready within QUAY_READY_TIMEOUT.
+    """
+    start = time.monotonic()
+    quay_url = f"http://{QUAY_SERVICE}:8080/api/v1/discovery"
     try:
-        result = subprocess.run(
-            ["mc", "admin", "accesskey", "create", "myminio/"],
-            capture_output=True,
-            text=True,
-            check=True,
+        pod_ready = wait_for_endpoints(QUAY_SERVICE, KUBE_NAMESPACE, QUAY_READY_TIMEOUT)
+        if pod_ready is not None:
+            print(f"[SETUP] QUAY pod is ready after {pod_ready:.1f}s, checking {quay_url}")
+        wait_for_http(quay_url, QUAY_READY_TIMEOUT - (time.monotonic() - start))
+    except TimeoutError as e:
+        raise Exception(
+            f"[FATAL] QUAY did not come up within {QUAY_READY_TIMEOUT:.0f}s ({e}). Aborting configuration, good luck!"
         )
+    waited = time.monotonic() - start
+    print(f"[SETUP] QUAY is up and running after {waited:.1f}s.")
+    return waited
 
-        access_key_match = re.search(r"Access Key:\s*(\S+)", result.stdout)
-        secret_key_match = re.search(r"Secret Key:\s*(\S+)", result.stdout)
 
-        if access_key_match and secret_key_match:
-            return {
-                "access_key": access_key_match.group(1),
-                "secret_key": secret_key_match.group(1),
-            }
-        else:
-            print("[FATAL] Failed to generate S3 credentials set")
-    except Exception as e:
-        print(f"[FATAL] Failed to generate S3 credentials set: {str(e)}")
+#----------------- MINIO KEYS -----------------
+@ledger.wrap
+def get_minio_keys():
+    """
+    Returns the MinIO key pair of Quay, kept in the Secret MINIO_KEYS_SECRET across runs.
+
+    The stored pair is reused while MinIO accepts it. A new pair is generated (and stored) on the
+    first run, when MinIO rejects the stored one, or when MINIO_ROTATE_KEYS is true; the old
+    access key is then revoked, so that keys do not pile up in MinIO.
+
+    Returns:
+        dict: The 'access_key' and 'secret_key'.
+    """
+    minio = MinioConnection(MINIO_HOST, MINIO_ROOT_USER, MINIO_ROOT_PASS, insecure=MINIO_INSECURE)
+    stored = read_k8s_secret(MINIO_KEYS_SECRET, KUBE_NAMESPACE)
+    if stored and not MINIO_ROTATE_KEYS:
+        if minio.credentials_valid(stored["access_key"], stored["secret_key"]):
+            print(f"[SETUP] Reusing the MinIO access key {stored['access_key']} of Secret '{MINIO_KEYS_SECRET}'")
+            return stored
+        print(f"[SETUP] MinIO rejects the access key {stored['access_key']}, generating a new one")
+
+    keys = generate_access_key_pair()
+    minio.add_access_key(
+        keys["access_key"], keys["secret_key"], name="stelar-registry", description="Storage of the tool registry"
+    )
+    # The new pair is stored before the old one is revoked, so a failure never leaves no valid key
+    applier = Applier()
+    applier.add(k8s_apply.secret(MINIO_KEYS_SECRET, KUBE_NAMESPACE, keys))
+    try:
+        applier.apply()
+    except k8s_apply.ApplyError as e:
+        minio.delete_access_key(keys["access_key"])
+        raise Exception(f"[FATAL] Could not store the MinIO keys in Secret '{MINIO_KEYS_SECRET}'") from e
+    print(f"[SETUP] Created the MinIO access key {keys['access_key']}")
+
+    if stored and stored["access_key"] != keys["access_key"]:
+        if minio.delete_access_key(stored["access_key"]):
+            print(f"[SETUP] Revoked the MinIO access key {stored['access_key']}")
+    return keys
+
 
-    return None
+def read_k8s_secret(secret_name, namespace):
+    """
+    Reads the values of a Secret.
+
+    Returns:
+        dict: The (decoded) values, or None if the Secret does not exist.
+    """
+    try:
+        secret = client.CoreV1Api().read_namespaced_secret(secret_name, namespace)
+    except client.exceptions.ApiException as e:
+        if e.status == 404:
+            return None
+        raise
+    return {k: base64.b64decode(v).decode("utf-8") for k, v in (secret.data or {}).items()}
 
 
 #----------------- ConfigMap Generation -----------------
+@ledger.wrap
 def apply_configmap_to_k8s_cluster(configmap):
     """
-    Applies a Kubernetes ConfigMap to the specified namespace.
+    Applies a Kubernetes ConfigMap to the specified namespace, updating it if it exists.
 
     Args:
         configmap (dict): ConfigMap structure to apply.
+
+    Raises:
+        ApplyError: If the ConfigMap could not be applied.
     """
-    v1 = client.CoreV1Api()
-    try:
-        v1.create_namespaced_config_map(
-            namespace=configmap["metadata"]["namespace"], body=configmap
-        )
-    except Exception:
-        raise
+    applier = Applier()
+    applier.add(configmap)
+    applier.apply()
 
 
 def generate_k8s_configmap(configmap_name, namespace, data_dict):
@@ -384,20 +287,12 @@ def generate_k8s_configmap(configmap_name, namespace, data_dict):
     Returns:
         dict: ConfigMap structure.
     """
-    configmap = {
-        "apiVersion": "v1",
-        "kind": "ConfigMap",
-        "metadata": {
-            "name": configmap_name,
-            "namespace": namespace,
-        },
-        "data": data_dict,
-    }
-
-    return configmap
+    return k8s_apply.config_map(configmap_name, namespace, data_dict)
 
 
 #----------------- MAIN -----------------
 if __name__ == "__main__":
-    mc_setup()
-    generate_tool_registry_configuration()
+    try:
+        generate_tool_registry_configuration()
+    finally:
+        ledger.publish(KUBE_NAMESPACE)